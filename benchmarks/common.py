@@ -0,0 +1,31 @@
+import os, sys, timeit
+
+# Make sure we pick up this checkout of django-scrape.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+## Configure Django for a benchmark.
+# Uses an in-memory SQLite database unless told otherwise.
+def setup_django(**options):
+    from django.conf import settings
+    if not settings.configured:
+        config = {
+            'DATABASES': {
+                'default': {
+                    'ENGINE': 'django.db.backends.sqlite3',
+                    'NAME': ':memory:',
+                },
+            },
+            'INSTALLED_APPS': ['scrape'],
+        }
+        config.update(options)
+        settings.configure(**config)
+
+
+## Time a function, returning the best average of a few runs in microseconds.
+def time_per_call(func, number=10000, repeat=3):
+    return min(timeit.repeat(func, number=number, repeat=repeat))*1e6/number
+
+
+def report(name, before, after):
+    print '%-30s %10.2fus %10.2fus %8.2fx'%(name, before, after, before/after)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+## End to end benchmark of DjangoItemPipeline.
+# Pushes synthetic items for a chain of ScrapeModels (Country <- City <- Venue <-
+# Event, plus Genre through a many-to-many) through "process_item", with related
+# items arriving out of order so some have to wait on others. Events have a
+# poster file. Nothing touches the network.
+#
+# Reports items per second, queries per item and peak RSS, and appends the
+# results to "results.jsonl" alongside this script so they can be compared
+# between releases. Uses an SQLite file in a temporary directory by default, or
+# the PostgreSQL database named by BENCH_PG_NAME (with BENCH_PG_USER,
+# BENCH_PG_PASSWORD, BENCH_PG_HOST and BENCH_PG_PORT) when BENCH_DB=postgres.
+#
+# Each run covers one configuration, since the reactor can't be restarted:
+#
+#   python benchmarks/pipeline.py --items 10000 --batch-size 500
+import os, json, random, shutil, tempfile, resource, subprocess, time
+from datetime import datetime, timedelta
+from optparse import OptionParser
+from common import setup_django
+
+work_dir = tempfile.mkdtemp(prefix='django-scrape-bench-')
+if os.environ.get('BENCH_DB') == 'postgres':
+    database = {
+        'ENGINE': 'django.db.backends.postgresql_psycopg2',
+        'NAME': os.environ['BENCH_PG_NAME'],
+        'USER': os.environ.get('BENCH_PG_USER', ''),
+        'PASSWORD': os.environ.get('BENCH_PG_PASSWORD', ''),
+        'HOST': os.environ.get('BENCH_PG_HOST', ''),
+        'PORT': os.environ.get('BENCH_PG_PORT', ''),
+    }
+else:
+    database = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(work_dir, 'bench.sqlite'),
+    }
+setup_django(DATABASES={'default': database}, MEDIA_ROOT=os.path.join(work_dir, 'media'))
+
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredList, maybeDeferred
+from scrapy.conf import settings
+from scrapy.item import Field
+from scrapy.spider import BaseSpider
+from scrapy.stats import stats
+from django.db import connection, models
+from django.core.management.color import no_style
+from scrape.models import ScrapeModel
+from scrape.scrapy.items import DjangoItem
+
+
+class Country(ScrapeModel):
+    name = models.CharField(max_length=100, unique=True)
+
+    class Meta:
+        app_label = 'bench'
+
+
+class City(ScrapeModel):
+    name = models.CharField(max_length=100)
+    country = models.ForeignKey(Country)
+
+    class Meta:
+        app_label = 'bench'
+        unique_together = (('name', 'country'),)
+
+
+class Venue(ScrapeModel):
+    name = models.CharField(max_length=100, unique=True)
+    capacity = models.IntegerField(blank=True, null=True)
+    city = models.ForeignKey(City)
+
+    class Meta:
+        app_label = 'bench'
+
+
+class Genre(ScrapeModel):
+    name = models.CharField(max_length=100, unique=True)
+
+    class Meta:
+        app_label = 'bench'
+
+
+class Event(ScrapeModel):
+    title = models.CharField(max_length=100)
+    start = models.DateTimeField()
+    price = models.FloatField(blank=True, null=True)
+    description = models.TextField(blank=True)
+    venue = models.ForeignKey(Venue)
+    genres = models.ManyToManyField(Genre, blank=True)
+    poster = models.FileField(upload_to='posters', blank=True)
+
+    class Meta:
+        app_label = 'bench'
+        unique_together = (('title', 'start', 'venue'),)
+
+
+MODELS = [Country, City, Venue, Genre, Event]
+
+
+class CountryItem(DjangoItem):
+    django_model = Country
+
+
+class CityItem(DjangoItem):
+    django_model = City
+
+
+class VenueItem(DjangoItem):
+    django_model = Venue
+
+
+class GenreItem(DjangoItem):
+    django_model = Genre
+
+
+class EventItem(DjangoItem):
+    django_model = Event
+    images = Field()
+
+
+def create_tables():
+    style = no_style()
+    cursor = connection.cursor()
+    known = set()
+    for model in MODELS:
+        sql, references = connection.creation.sql_create_model(model, style, known)
+        for statement in sql + connection.creation.sql_for_many_to_many(model, style):
+            cursor.execute(statement)
+        known.add(model)
+    connection.commit_unless_managed()
+
+
+def drop_tables():
+    cursor = connection.cursor()
+    for model in reversed(MODELS):
+        for field in model._meta.many_to_many:
+            cursor.execute('DROP TABLE %s'%connection.ops.quote_name(field.m2m_db_table()))
+        cursor.execute('DROP TABLE %s'%connection.ops.quote_name(model._meta.db_table))
+    connection.commit_unless_managed()
+
+
+## Build the items to push through the pipeline.
+# Roughly one venue for every ten events, a city for every five venues and a
+# country for every five cities, so parent rows are shared. Items are shuffled
+# so children often turn up before their parents.
+def make_items(num_items, images_dir, seed=0):
+    rnd = random.Random(seed)
+    url = 'http://example.com/%s/%d'
+    num_venues = max(1, num_items/10)
+    num_cities = max(1, num_venues/5)
+    num_countries = max(1, num_cities/5)
+    num_genres = 20
+    items = []
+    for ii in xrange(num_countries):
+        items.append(CountryItem(id=url%('country', ii), scrape_url=url%('country', ii),
+                                 name=u'Country %d'%ii))
+    for ii in xrange(num_cities):
+        items.append(CityItem(id=url%('city', ii), scrape_url=url%('city', ii),
+                              name=u'City %d'%ii, country=url%('country', ii%num_countries)))
+    for ii in xrange(num_venues):
+        items.append(VenueItem(id=url%('venue', ii), scrape_url=url%('venue', ii),
+                               name=u'Venue %d'%ii, capacity=100 + ii,
+                               city=url%('city', ii%num_cities)))
+    for ii in xrange(num_genres):
+        items.append(GenreItem(id=url%('genre', ii), scrape_url=url%('genre', ii),
+                               name=u'Genre %d'%ii))
+    posters = []
+    for ii in xrange(10):
+        path = 'poster%d.jpg'%ii
+        with open(os.path.join(images_dir, path), 'wb') as f:
+            f.write(os.urandom(4096))
+        posters.append(path)
+    start = datetime(2012, 1, 1, 20)
+    for ii in xrange(num_items - len(items)):
+        items.append(EventItem(
+            id=url%('event', ii), scrape_url=url%('event', ii),
+            title=u'Event %d'%ii, start=start + timedelta(days=ii%365),
+            price=float(ii%50), description=u'An event. '*20,
+            venue=url%('venue', ii%num_venues),
+            genres=[url%('genre', g) for g in rnd.sample(xrange(num_genres), 3)],
+            poster='images', images=[{'path': posters[ii%len(posters)]}],
+        ))
+    rnd.shuffle(items)
+    return items
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except Exception:
+        return None
+
+
+def run(options):
+    from scrape.scrapy.pipelines import DjangoItemPipeline
+
+    images_dir = os.path.join(work_dir, 'images')
+    os.makedirs(images_dir)
+    settings.overrides.update({
+        'IMAGES_STORE': images_dir,
+        'DJANGO_ITEM_BATCH_SIZE': options.batch_size,
+        'DJANGO_ITEM_DB_THREADS': options.db_threads,
+        'DJANGO_ITEM_IDENTITY_CACHE_SIZE': options.identity_cache,
+        'DJANGO_ITEM_TRANSACTION_SIZE': options.transaction_size,
+        'DJANGO_ITEM_COUNT_QUERIES': True,
+        'DJANGO_ITEM_METRICS_INTERVAL': 0,
+    })
+    create_tables()
+    items = make_items(options.items, images_dir)
+
+    spider = BaseSpider('bench')
+    stats.open_spider(spider)
+    pipeline = DjangoItemPipeline()
+    result = {}
+
+    def started():
+        result['started'] = time.time()
+        pipeline.open_spider(spider)
+        dfds = [maybeDeferred(pipeline.process_item, item, spider) for item in items]
+        dfd = DeferredList(dfds, consumeErrors=1)
+        dfd.addCallback(count_saved)
+        dfd.addCallback(lambda _: pipeline.close_spider(spider))
+        dfd.addBoth(finished)
+
+    def count_saved(results):
+        result['saved'] = len([ok for ok, r in results if ok])
+
+    def finished(failure):
+        result['seconds'] = time.time() - result['started']
+        if failure is not None:
+            failure.printTraceback()
+        reactor.stop()
+
+    reactor.callWhenRunning(started)
+    reactor.run()
+
+    metrics = pipeline.metrics
+    num_saved = sum(metrics.items.values())
+    num_queries = sum(metrics.queries.values())
+    stats.close_spider(spider, 'finished')
+    drop_tables()
+    return {
+        'date': datetime.now().isoformat(),
+        'revision': git_revision(),
+        'database': database['ENGINE'].rsplit('.', 1)[-1],
+        'items': len(items),
+        'saved': result['saved'],
+        'batch_size': options.batch_size,
+        'db_threads': options.db_threads,
+        'identity_cache': options.identity_cache,
+        'transaction_size': options.transaction_size,
+        'seconds': round(result['seconds'], 3),
+        'items_per_sec': round(len(items)/result['seconds'], 1),
+        'queries_per_item': round(float(num_queries)/num_saved, 2) if num_saved else None,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'stages': metrics.summary(),
+    }
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('--items', type='int', default=5000, help='Number of items to push.')
+    parser.add_option('--batch-size', type='int', default=0, help='DJANGO_ITEM_BATCH_SIZE.')
+    parser.add_option('--db-threads', type='int', default=0, help='DJANGO_ITEM_DB_THREADS.')
+    parser.add_option('--identity-cache', type='int', default=0, help='DJANGO_ITEM_IDENTITY_CACHE_SIZE.')
+    parser.add_option('--transaction-size', type='int', default=0, help='DJANGO_ITEM_TRANSACTION_SIZE.')
+    parser.add_option('--results', default=os.path.join(os.path.dirname(__file__), 'results.jsonl'),
+                      help='File to append results to.')
+    parser.add_option('--no-save', action='store_true', help="Don't record the results.")
+    options, args = parser.parse_args()
+    if options.db_threads and database['ENGINE'].endswith('sqlite3'):
+        parser.error('SQLite is locked by one writer at a time, use BENCH_DB=postgres with --db-threads.')
+
+    try:
+        result = run(options)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    for line in result.pop('stages'):
+        print '  %s'%line
+    print '%(items)d items (%(saved)d saved) in %(seconds).2fs: %(items_per_sec).1f items/s, ' \
+        '%(queries_per_item)s queries/item, peak RSS %(peak_rss_kb)d KB'%result
+    if not options.no_save:
+        with open(options.results, 'a') as f:
+            f.write(json.dumps(result, sort_keys=True) + '\n')
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+## Input processor throughput on fields with thousands of values.
+# Compares the default text chain as it was, MapCompose over list-building
+# processors, against the fused chain DjangoItemMeta now uses, and the same
+# chain in lazy mode for a field whose output processor is TakeFirst.
+from common import time_per_call
+
+from scrapy.contrib.loader.processor import MapCompose, TakeFirst
+from scrapy.utils.markup import remove_entities
+from scrapy.utils.misc import arg_to_iter
+from scrape.scrapy.processors import Fused, Lazy, RemoveEntities, Strip
+
+
+class LegacyStrip(object):
+
+    def __call__(self, values):
+        return [v.strip() for v in arg_to_iter(values)]
+
+
+class LegacyRemoveEntities(object):
+
+    def __call__(self, values):
+        return [remove_entities(v) for v in arg_to_iter(values)]
+
+
+def make_values(count, entity_every=10):
+    values = []
+    for ii in xrange(count):
+        if ii%entity_every == 0:
+            values.append(u'  Value &amp; number %d  '%ii)
+        else:
+            values.append(u'  Value number %d  '%ii)
+    return values
+
+
+if __name__ == '__main__':
+    legacy = MapCompose(LegacyRemoveEntities(), LegacyStrip())
+    fused = Fused(RemoveEntities(), Strip())
+    print '%8s %14s %14s %9s'%('values', 'legacy', 'fused', 'speedup')
+    for count in (10, 100, 1000, 10000):
+        values = make_values(count)
+        assert legacy(values) == fused(values)
+        number = max(1, 100000/count)
+        before = time_per_call(lambda: legacy(values), number=number)
+        after = time_per_call(lambda: fused(values), number=number)
+        print '%8d %12.1fus %12.1fus %8.2fx'%(count, before, after, before/after)
+
+    take_first = TakeFirst()
+    lazy = Lazy(Fused(RemoveEntities(), Strip()), limit=1)
+    print
+    print '%8s %14s %14s %9s'%('values', 'fused', 'lazy', 'speedup')
+    for count in (10, 100, 1000, 10000):
+        values = make_values(count)
+        assert take_first(fused(values)) == take_first(lazy(values))
+        number = max(1, 100000/count)
+        before = time_per_call(lambda: take_first(fused(values)), number=number)
+        after = time_per_call(lambda: take_first(lazy(values)), number=number)
+        print '%8d %12.1fus %12.1fus %8.2fx'%(count, before, after, before/after)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+## Per-item Python overhead of preparing a DjangoItem for saving.
+# Compares classifying fields on every item, as DjangoItem.save and
+# DjangoItemPipeline.save_item used to, against the save plan compiled by
+# DjangoItemMeta. No database access is involved.
+from datetime import datetime
+from common import setup_django, time_per_call, report
+setup_django()
+
+from django.db import models
+from django.db.models import FileField
+from django.db.models.fields.related import ManyToManyField
+from scrape.scrapy.items import DjangoItem, get_field_value
+
+
+class Genre(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+
+    class Meta:
+        app_label = 'bench'
+
+
+class Venue(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+    capacity = models.IntegerField(blank=True, null=True)
+
+    class Meta:
+        app_label = 'bench'
+
+
+class Event(models.Model):
+    title = models.CharField(max_length=100)
+    start = models.DateTimeField()
+    price = models.FloatField(blank=True, null=True)
+    description = models.TextField(blank=True)
+    venue = models.ForeignKey(Venue)
+    genres = models.ManyToManyField(Genre, blank=True)
+    poster = models.ImageField(upload_to='posters', blank=True)
+
+    class Meta:
+        app_label = 'bench'
+        unique_together = (('title', 'start', 'venue'),)
+
+
+class EventItem(DjangoItem):
+    django_model = Event
+
+
+def make_item():
+    item = EventItem()
+    item['id'] = u'http://example.com/events/1'
+    item['scrape_url'] = u'http://example.com/events/1'
+    item['title'] = u'An Event'
+    item['start'] = datetime(2012, 1, 1, 20)
+    item['price'] = 10.0
+    item['description'] = u'Some words.'
+    item['venue'] = 1
+    item['genres'] = [1, 2, 3]
+    item['poster'] = u'/tmp/images/full/abc.jpg'
+    return item
+
+
+## The original filter construction.
+def legacy_query(item, field, value, use_null=False):
+    if value in ('', None, []):
+        if use_null:
+            if isinstance(field, (models.CharField, models.TextField)):
+                return ('', '')
+            else:
+                return ('__isnull', True)
+        else:
+            return None
+    value = get_field_value(item, field, value, None, None)
+    if isinstance(field, ManyToManyField):
+        return ('__contains', value)
+    elif isinstance(field, FileField):
+        return ('__contains', value)
+    return ('', value)
+
+
+def legacy_filter(item):
+    fltr = {}
+    for field in item._model_fields:
+        value = item.get(field.name)
+        if value not in ['', None, []]:
+            item[field.name] = get_field_value(item, field, value, None, None)
+    for field in item._model_fields:
+        if field.unique or isinstance(field, FileField):
+            query = legacy_query(item, field, item.get(field.name, None))
+            if query:
+                fltr[field.name + query[0]] = query[1]
+    for unique_set in item.django_model._meta.unique_together:
+        for field_name in unique_set:
+            field = item.django_model._meta.get_field_by_name(field_name)[0]
+            query = legacy_query(item, field, item.get(field.name, None), use_null=True)
+            fltr[field.name + query[0]] = query[1]
+    return fltr
+
+
+## The original field classification in DjangoItemPipeline.save_item.
+def legacy_classify(item):
+    kinds = []
+    for field in item._model_fields:
+        if field in item._model_rel_fields:
+            kinds.append(field in item._model_m2m_fields)
+        elif field in item._model_file_fields or field in item._model_img_fields:
+            kinds.append(True)
+        kinds.append(field.blank == False)
+    return kinds
+
+
+def plan_filter(item):
+    item.convert_values(None, None)
+    return item.get_filter(None, None)
+
+
+def plan_classify(item):
+    kinds = []
+    for plan in item._save_plan:
+        if plan.is_related:
+            kinds.append(plan.is_m2m)
+        elif plan.is_file:
+            kinds.append(True)
+        kinds.append(plan.required)
+    return kinds
+
+
+if __name__ == '__main__':
+    item = make_item()
+    print '%-30s %12s %12s %9s'%('', 'before', 'after', 'speedup')
+    report('filter', time_per_call(lambda: legacy_filter(item)), time_per_call(lambda: plan_filter(item)))
+    report('classify', time_per_call(lambda: legacy_classify(item)), time_per_call(lambda: plan_classify(item)))
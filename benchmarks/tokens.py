@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+## Scaling of the token processors on long value lists.
+# The original Split concatenated lists with "sum" and GenreMash popped from
+# the front of a list, both quadratic in the number of values. The legacy
+# versions are only timed up to 20000 values to keep the run short.
+from common import time_per_call
+
+from scrapy.utils.misc import arg_to_iter
+from scrape.scrapy.processors import Split, GenreMash
+
+
+class LegacySplit(object):
+
+    def __init__(self, token=u' '):
+        self.token = token
+
+    def __call__(self, values):
+        return sum([v.split(self.token) for v in arg_to_iter(values)], [])
+
+
+class LegacyGenreMash(object):
+
+    def __call__(self, values):
+        out_values = []
+        values = list(arg_to_iter(values))
+        while values:
+            val = values.pop(0)
+            if values and val == 'R' and values[0] == 'B':
+                values.pop(0)
+                out_values.append('R&B')
+            elif val:
+                out_values.append(val)
+        return out_values
+
+
+def make_values(count):
+    genres = [u'R&B', u'Soul', u'Jazz', u'', u'Rock & Roll']
+    return [genres[ii%len(genres)] for ii in xrange(count)]
+
+
+def compare(name, legacy, current, values, limit=20000):
+    number = max(1, 10000/len(values))
+    after = time_per_call(lambda: current(values), number=number, repeat=3)
+    if len(values) <= limit:
+        assert legacy(values) == current(values)
+        before = time_per_call(lambda: legacy(values), number=number, repeat=3)
+        print '%-6s %8d %12.1fus %12.1fus %8.2fx'%(name, len(values), before, after, before/after)
+    else:
+        print '%-6s %8d %14s %12.1fus %9s'%(name, len(values), '-', after, '-')
+
+
+if __name__ == '__main__':
+    print '%-6s %8s %14s %14s %9s'%('', 'values', 'legacy', 'current', 'speedup')
+    for count in (100, 1000, 10000, 20000, 100000):
+        values = make_values(count)
+        compare('split', LegacySplit(u'&'), Split(u'&'), values)
+        split = Split(u'&')(values)
+        compare('mash', LegacyGenreMash(), GenreMash(), split)
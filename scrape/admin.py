@@ -1,10 +1,64 @@
+from django import forms
 from django.contrib import admin
+from django.contrib.admin import widgets
+from django.utils.datastructures import SortedDict
+from django.contrib.admin.views.main import ChangeList
 from django.forms.models import _get_foreign_key
+from models import VALID_STATES, ScrapeCoverage, get_valid_state, filter_valid_state, set_valid
 
 import logging
 logger = logging.getLogger(__name__)
 
 
+## Names of the editable scrape metadata fields, other than the '_valid' guys.
+# Packed sources and timestamps are edited through form fields, see
+# "make_packed_form".
+def get_scrape_meta_fields(model):
+    packed = getattr(model, '_scrape_metadata', 'columns') == 'packed'
+    names = []
+    for name in model._scrape_fields:
+        if name[-6:] == '_valid':
+            continue
+        if (packed and name in model._scrape_columns) or model._meta.get_field(name).editable:
+            names.append(name)
+    return names
+
+
+## Make a model form editing packed scrape metadata as if it were columns.
+# Packed metadata lives in properties, which model forms know nothing about, so
+# each gets a form field reading and writing its property. The admin then shows
+# the same '_valid' checkboxes, sources and timestamps for both kinds of model.
+def make_packed_form(model, form=forms.ModelForm):
+    attrs = SortedDict()
+    for valid_name in model._scrape_valid_fields:
+        name = valid_name[:-6]
+        attrs[valid_name] = forms.BooleanField(required=False)
+        attrs[name + '_source'] = forms.URLField(required=False)
+        attrs[name + '_timestamp'] = forms.SplitDateTimeField(required=False, widget=widgets.AdminSplitDateTime)
+    names = attrs.keys()
+
+    def __init__(self, *args, **kwargs):
+        form.__init__(self, *args, **kwargs)
+        for name in names:
+            self.initial.setdefault(name, getattr(self.instance, name))
+
+    def save(self, commit=True):
+        for name in names:
+            setattr(self.instance, name, self.cleaned_data.get(name))
+        return form.save(self, commit)
+
+    attrs['__init__'] = __init__
+    attrs['save'] = save
+    return type(form)('Packed%sForm'%model.__name__, (form,), attrs)
+
+
+## Keyword arguments giving a packed model's admin its form.
+def get_form_kwargs(model, form, kwargs):
+    if getattr(model, '_scrape_metadata', 'columns') == 'packed' and 'form' not in kwargs:
+        kwargs['form'] = make_packed_form(model, form)
+    return kwargs
+
+
 ## Create fieldsets for a scraped model's admin.
 # It's a little tricky to get the ordering correct and place the
 # meta information in its own fieldset. This function helps out.
@@ -12,8 +66,7 @@ def make_scrape_fieldsets(fieldsets, obj):
     if obj:
 
         # Remove references to scrape fields, except for the '_valid' guys.
-        scrape_fields = [n for n in obj._scrape_fields if n[-6:] != '_valid']
-        scrape_fields_set = set(scrape_fields)
+        scrape_fields = get_scrape_meta_fields(obj)
         scrape_valid_fields_set = set(obj._scrape_valid_fields)
         target_fields_set = set(obj._scrape_target_fields)
         for name, options in fieldsets:
@@ -42,24 +95,145 @@ def make_scrape_fieldsets(fieldsets, obj):
     return fieldsets
 
 
+## Names of the columns holding sources and timestamps.
+def get_scrape_deferred_fields(model):
+    if getattr(model, '_scrape_metadata', 'columns') == 'packed':
+        return [c for c in set(model._scrape_columns.values()) if c != 'scrape_valid']
+    return [n for n in model._scrape_fields if n.endswith('_source') or n.endswith('_timestamp')]
+
+
+## Filter objects by how many of their fields are validated.
+# One filter in place of one per field. If the model keeps coverage counts
+# (see ScrapeCoverage) they're shown against each choice.
+class ValidationCoverageFilter(admin.SimpleListFilter):
+    title = 'validation'
+    parameter_name = 'scrape_valid_state'
+
+    def lookups(self, request, model_admin):
+        counts = None
+        if getattr(model_admin.model, '_scrape_coverage', False):
+            counts = ScrapeCoverage.get_counts(model_admin.model)
+        if counts is None:
+            return VALID_STATES
+        return [(state, '%s (%d)'%(label, counts[state])) for state, label in VALID_STATES]
+
+    def queryset(self, request, queryset):
+        if self.value() in dict(VALID_STATES):
+            return filter_valid_state(queryset, self.value())
+        return queryset
+
+
+## Changelist that doesn't load source and timestamp columns.
+class ScrapeChangeList(ChangeList):
+
+    def get_query_set(self, request):
+        qs = super(ScrapeChangeList, self).get_query_set(request)
+        return qs.defer(*get_scrape_deferred_fields(self.model))
+
+
+## Make an admin action setting or clearing the validity of fields.
+def make_validate_action(field_names, valid):
+    def action(modeladmin, request, queryset):
+        updated = set_valid(queryset, field_names, valid)
+        modeladmin.message_user(request, '%d %s %s.'%(
+            updated, modeladmin.model._meta.verbose_name_plural, 'validated' if valid else 'invalidated'))
+    return action
+
+
+## Wrap the admin's "delete_selected" action to keep coverage counts up to date.
+# The action deletes the whole queryset at once, bypassing "delete_model". It
+# only deletes once confirmed, returning nothing; otherwise it returns the
+# confirmation page and nothing changes.
+def make_counted_delete(delete):
+    def action(modeladmin, request, queryset):
+        if not request.POST.get('post'):
+            return delete(modeladmin, request, queryset)
+        counts = dict([(state, filter_valid_state(queryset, state).count()) for state in ('all', 'none')])
+        total = queryset.count()
+        response = delete(modeladmin, request, queryset)
+        if response is None:
+            ScrapeCoverage.add(modeladmin.model, total=-total, fully_valid=-counts['all'],
+                               not_valid=-counts['none'])
+        return response
+    return action
+
+
 ## Base model for displaying a ScrapeModel in an admin.
 # Intended to be inherited by model admin classes used to display
 # models that inherit from ScrapeModel.
+#
+# On large tables set "scrape_compact_changelist", which stops the changelist
+# loading sources and timestamps, and replaces the per field validity filters
+# with a single ValidationCoverageFilter. Models with packed metadata always
+# get the single filter.
 class ScrapeModelAdmin(admin.ModelAdmin):
+    scrape_compact_changelist = False
 
     def __init__(self, *args, **kwargs):
         super(ScrapeModelAdmin, self).__init__(*args, **kwargs)
         list_filter = list(self.list_filter)
-        list_filter.extend(self.model._scrape_valid_fields)
+        if self.scrape_compact_changelist or getattr(self.model, '_scrape_metadata', 'columns') == 'packed':
+            list_filter.append(ValidationCoverageFilter)
+        else:
+            list_filter.extend(self.model._scrape_valid_fields)
         self.list_filter = tuple(list_filter)
 
+    def get_changelist(self, request, **kwargs):
+        if self.scrape_compact_changelist:
+            return ScrapeChangeList
+        return super(ScrapeModelAdmin, self).get_changelist(request, **kwargs)
+
+    def get_form(self, request, obj=None, **kwargs):
+        kwargs = get_form_kwargs(self.model, self.form, kwargs)
+        return super(ScrapeModelAdmin, self).get_form(request, obj, **kwargs)
+
     def get_fieldsets(self, request, obj=None):
         fieldsets = super(ScrapeModelAdmin, self).get_fieldsets(request, obj)
         return make_scrape_fieldsets(fieldsets, obj)
 
+    ## Add actions to validate or invalidate fields of the selected objects.
+    # One pair for all fields together and one for each field. Each is a single
+    # UPDATE however many objects are selected.
+    def get_actions(self, request):
+        actions = super(ScrapeModelAdmin, self).get_actions(request)
+        if actions and 'delete_selected' in actions and getattr(self.model, '_scrape_coverage', False):
+            delete, name, description = actions['delete_selected']
+            actions['delete_selected'] = (make_counted_delete(delete), name, description)
+        if actions is None or not self.has_change_permission(request):
+            return actions
+        scrape_actions = SortedDict()
+        field_names = [n[:-6] for n in self.model._scrape_valid_fields]
+        for label, names in [('all fields', None)] + [(n, [n]) for n in field_names]:
+            for valid in (True, False):
+                name = 'scrape_%s_%s'%('validate' if valid else 'invalidate', 'all' if names is None else names[0])
+                description = '%s %s'%('Validate' if valid else 'Invalidate', label)
+                scrape_actions[name] = (make_validate_action(names, valid), name, description)
+        actions.update(scrape_actions)
+        return actions
+
+    ## Keep coverage counts up to date with edits.
+    def save_model(self, request, obj, form, change):
+        if not getattr(self.model, '_scrape_coverage', False):
+            return super(ScrapeModelAdmin, self).save_model(request, obj, form, change)
+        old_state = None
+        if change:
+            old_state = get_valid_state(self.model._default_manager.get(pk=obj.pk))
+        super(ScrapeModelAdmin, self).save_model(request, obj, form, change)
+        ScrapeCoverage.change_state(self.model, old_state, get_valid_state(obj))
+
+    def delete_model(self, request, obj):
+        state = get_valid_state(obj)
+        super(ScrapeModelAdmin, self).delete_model(request, obj)
+        if getattr(self.model, '_scrape_coverage', False):
+            ScrapeCoverage.change_state(self.model, state, None)
+
 
 class ScrapeStackedInline(admin.StackedInline):
 
+    def get_formset(self, request, obj=None, **kwargs):
+        kwargs = get_form_kwargs(self.model, self.form, kwargs)
+        return super(ScrapeStackedInline, self).get_formset(request, obj, **kwargs)
+
     def get_fieldsets(self, request, obj=None):
         fieldsets = super(ScrapeStackedInline, self).get_fieldsets(request, obj)
         return make_scrape_fieldsets(fieldsets, self.model)
@@ -67,6 +241,10 @@ class ScrapeStackedInline(admin.StackedInline):
 
 class ScrapeTabularInline(admin.TabularInline):
 
+    def get_formset(self, request, obj=None, **kwargs):
+        kwargs = get_form_kwargs(self.model, self.form, kwargs)
+        return super(ScrapeTabularInline, self).get_formset(request, obj, **kwargs)
+
     def get_fieldsets(self, request, obj=None):
         fieldsets = super(ScrapeTabularInline, self).get_fieldsets(request, obj)
         return make_scrape_fieldsets(fieldsets, self.model)
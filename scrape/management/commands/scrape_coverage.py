@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import get_app, get_apps, get_models
+from scrape.models import ScrapeCoverage
+
+
+## Recount the validation coverage of ScrapeModels.
+# Counts are normally kept up to date incrementally, but changes made outside of
+# DjangoItem.save and the admin aren't seen.
+class Command(BaseCommand):
+    args = '[appname ...]'
+    help = 'Recounts validation coverage for ScrapeModels with scrape_coverage set.'
+
+    def handle(self, *app_labels, **options):
+        if app_labels:
+            try:
+                apps = [get_app(label) for label in app_labels]
+            except Exception, e:
+                raise CommandError(str(e))
+        else:
+            apps = get_apps()
+
+        for app in apps:
+            for model in get_models(app):
+                if not getattr(model, '_scrape_coverage', False):
+                    continue
+                coverage = ScrapeCoverage.rebuild(model)
+                self.stdout.write('%s: %d objects, %d fully validated, %d not validated\n'%(
+                    coverage.model, coverage.total, coverage.fully_valid, coverage.not_valid))
+        transaction.commit_unless_managed()
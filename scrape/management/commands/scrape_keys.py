@@ -0,0 +1,67 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.db.models import get_app, get_apps, get_models
+
+
+# Per object columns added by ScrapeModel Meta options after a table may exist.
+OBJECT_COLUMNS = ('scrape_key', 'scrape_url', 'scrape_time')
+
+
+## Add natural key and scheduling columns and indexes to existing tables.
+# Models created after "scrape_key" or "scrape_schedule" was added to their Meta
+# get the columns from syncdb. Tables that already existed need them added, which
+# is what this does for every ScrapeModel missing any. Existing rows are left
+# empty; they're filled in as the rows are scraped again.
+class Command(BaseCommand):
+    args = '[appname ...]'
+    help = 'Adds missing scrape_key, scrape_url and scrape_time columns, and their indexes, ' \
+        'to existing ScrapeModel tables.'
+    option_list = BaseCommand.option_list + (
+        make_option('--database', action='store', dest='database', default=DEFAULT_DB_ALIAS,
+                    help='Database to alter, defaults to "default".'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Print the SQL without running it.'),
+    )
+
+    def handle(self, *app_labels, **options):
+        connection = connections[options['database']]
+        if app_labels:
+            try:
+                apps = [get_app(label) for label in app_labels]
+            except Exception, e:
+                raise CommandError(str(e))
+        else:
+            apps = get_apps()
+
+        cursor = connection.cursor()
+        tables = set(connection.introspection.table_names(cursor))
+        qn = connection.ops.quote_name
+        statements = []
+        for app in apps:
+            for model in get_models(app):
+                names = [n for n in OBJECT_COLUMNS if n in getattr(model, '_scrape_fields', ())]
+                table = model._meta.db_table
+                if not names or table not in tables:
+                    continue
+                columns = [c[0] for c in connection.introspection.get_table_description(cursor, table)]
+                for name in names:
+                    field = model._meta.get_field(name)
+                    if field.column in columns:
+                        continue
+                    statements.append('ALTER TABLE %s ADD COLUMN %s %s NULL;'%(
+                        qn(table), qn(field.column), field.db_type(connection=connection)))
+                    if field.unique or field.db_index:
+                        statements.append('CREATE %sINDEX %s ON %s (%s);'%(
+                            'UNIQUE ' if field.unique else '', qn('%s_%s'%(table, field.column)),
+                            qn(table), qn(field.column)))
+
+        if not statements:
+            self.stdout.write('Nothing to do.\n')
+            return
+        for sql in statements:
+            self.stdout.write(sql + '\n')
+            if not options['dry_run']:
+                cursor.execute(sql)
+        if not options['dry_run']:
+            transaction.commit_unless_managed(using=options['database'])
@@ -0,0 +1,49 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import get_model
+from scrape.models import set_valid
+
+
+## Validate or invalidate fields of many scraped objects at once.
+# Selects objects of a ScrapeModel with any number of "--filter" lookups, then
+# sets (or with "--clear", clears) the validity of "--fields", or of all fields,
+# with a single UPDATE:
+#
+#   manage.py scrape_validate events.Event --fields=title,start --filter venue__city__name=Sydney
+class Command(BaseCommand):
+    args = '<app_label.ModelName>'
+    help = 'Sets or clears the validity of scraped fields across a filtered set of objects.'
+    option_list = BaseCommand.option_list + (
+        make_option('--fields', action='store', dest='fields', default=None,
+                    help='Comma separated fields to update, defaults to all of them.'),
+        make_option('--filter', action='append', dest='filters', default=[],
+                    help='A lookup=value pair limiting the objects updated, may be repeated.'),
+        make_option('--clear', action='store_true', dest='clear', default=False,
+                    help='Clear validity instead of setting it.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or '.' not in args[0]:
+            raise CommandError('Give a single model as app_label.ModelName.')
+        model = get_model(*args[0].split('.', 1))
+        if model is None or not hasattr(model, '_scrape_valid_fields'):
+            raise CommandError('%s is not a ScrapeModel.'%args[0])
+
+        lookups = {}
+        for fltr in options['filters']:
+            if '=' not in fltr:
+                raise CommandError('Filters look like lookup=value: %s'%fltr)
+            key, value = fltr.split('=', 1)
+            lookups[str(key)] = value
+        field_names = None
+        if options['fields']:
+            field_names = [n.strip() for n in options['fields'].split(',') if n.strip()]
+
+        try:
+            updated = set_valid(model._default_manager.filter(**lookups), field_names, not options['clear'])
+        except ValueError, e:
+            raise CommandError(str(e))
+        transaction.commit_unless_managed()
+        self.stdout.write('%d %s %s.\n'%(updated, model._meta.verbose_name_plural,
+                                         'invalidated' if options['clear'] else 'validated'))
@@ -1,6 +1,83 @@
+import time, threading
+from datetime import datetime
 from django.db import models
-from django.db.models import fields
+from django.db.models import fields, F, Q
 from django.db.models.base import ModelBase
+from scrape.scrapy.cache import LRUCache
+
+
+## Source URLs of packed scrape metadata.
+# Each URL is stored once and referred to by ID. Lookups both ways are cached in
+# process, see "intern" and "get_url".
+class ScrapeSource(models.Model):
+    url = models.URLField(verify_exists=False, unique=True)
+
+    _ids = LRUCache(10000)
+    _urls = LRUCache(10000)
+    _lock = threading.Lock()
+
+    def __unicode__(self):
+        return self.url
+
+    ## Get the ID for a URL, adding it if needed.
+    @classmethod
+    def intern(cls, url):
+        with cls._lock:
+            id = cls._ids.get(url)
+        if id is None:
+            id = cls.objects.get_or_create(url=url)[0].pk
+            with cls._lock:
+                cls._ids.set(url, id)
+                cls._urls.set(id, url)
+        return id
+
+    @classmethod
+    def get_url(cls, id):
+        with cls._lock:
+            url = cls._urls.get(id)
+        if url is None:
+            url = cls.objects.get(pk=id).url
+            with cls._lock:
+                cls._ids.set(url, id)
+                cls._urls.set(id, url)
+        return url
+
+    ## Forget cached IDs, which may have gone with a rolled back transaction.
+    @classmethod
+    def clear_cache(cls):
+        with cls._lock:
+            cls._ids.clear()
+            cls._urls.clear()
+
+
+## Properties giving packed metadata the same attributes as separate columns.
+def packed_valid(column, bit):
+    def get(self):
+        return bool((getattr(self, column) or 0) & bit)
+    def set(self, value):
+        mask = getattr(self, column) or 0
+        setattr(self, column, (mask | bit) if value else (mask & ~bit))
+    return property(get, set)
+
+
+def packed_source(attname):
+    def get(self):
+        id = getattr(self, attname)
+        return ScrapeSource.get_url(id) if id is not None else None
+    def set(self, url):
+        setattr(self, attname, ScrapeSource.intern(url) if url else None)
+    return property(get, set)
+
+
+def packed_timestamp(column):
+    def get(self):
+        value = getattr(self, column)
+        return datetime.fromtimestamp(value) if value is not None else None
+    def set(self, value):
+        if isinstance(value, datetime):
+            value = int(time.mktime(value.timetuple()))
+        setattr(self, column, value)
+    return property(get, set)
 
 
 ## Metaclass for setting up a model for scraping.
@@ -21,12 +98,29 @@ class ScrapeModelMetaclass(ModelBase):
         # Extract any meta information.
         include_fields = getattr(meta, 'scrape_include_fields', [])
         exclude_fields = getattr(meta, 'scrape_exclude_fields', [])
+        hash_fields = getattr(meta, 'scrape_hash_fields', [])
+        use_key = getattr(meta, 'scrape_key', False)
+        metadata = getattr(meta, 'scrape_metadata', 'columns')
+        coverage = getattr(meta, 'scrape_coverage', False)
+        schedule = getattr(meta, 'scrape_schedule', False)
+        if metadata not in ('columns', 'packed'):
+            raise TypeError('Unknown scrape_metadata: %s'%metadata)
 
         # Delete our meta values as Django complains if it finds unknown values.
         if hasattr(meta, 'scrape_include_fields'):
             del meta.scrape_include_fields
         if hasattr(meta, 'scrape_exclude_fields'):
             del meta.scrape_exclude_fields
+        if hasattr(meta, 'scrape_hash_fields'):
+            del meta.scrape_hash_fields
+        if hasattr(meta, 'scrape_key'):
+            del meta.scrape_key
+        if hasattr(meta, 'scrape_metadata'):
+            del meta.scrape_metadata
+        if hasattr(meta, 'scrape_coverage'):
+            del meta.scrape_coverage
+        if hasattr(meta, 'scrape_schedule'):
+            del meta.scrape_schedule
 
         # Pull the fields from our model.
         target_fields = []
@@ -39,15 +133,42 @@ class ScrapeModelMetaclass(ModelBase):
         if not target_fields:
             return super(ScrapeModelMetaclass, cls).__new__(cls, name, bases, attrs)
 
+        # Keep the fields in declaration order, which decides their bits when packed.
+        target_fields.sort(key=lambda f: f[1].creation_counter)
+
         # Add the appropriate fields to our attribute dictionary.
         scrape_fields = []
         scrape_valid_fields = []
+        scrape_columns = {}
         for field_name, field in target_fields:
             if field_name in ['id', 'pk']: # Skip the primary key.
                 continue
             if not _is_target_field(field_name, include_fields, exclude_fields):
                 continue
 
+            # Packed metadata is a bit in a shared mask for validity, an interned
+            # source and a timestamp in seconds. Properties stand in for the usual
+            # fields, and "_scrape_columns" maps them to the real ones.
+            if metadata == 'packed':
+                bit = len(scrape_valid_fields)
+                if bit >= 63:
+                    raise TypeError('Too many fields to pack scrape metadata for %s.'%name)
+                valid_name = field_name + '_valid'
+                source_name = field_name + '_source'
+                timestamp_name = field_name + '_timestamp'
+                scrape_fields.extend([valid_name, source_name, timestamp_name])
+                scrape_valid_fields.append(valid_name)
+                attrs[field_name + '_src'] = models.ForeignKey(ScrapeSource, blank=True, null=True,
+                                                               related_name='+', editable=False)
+                attrs[field_name + '_ts'] = models.IntegerField(blank=True, null=True, editable=False)
+                attrs[valid_name] = packed_valid('scrape_valid', 1 << bit)
+                attrs[source_name] = packed_source(field_name + '_src_id')
+                attrs[timestamp_name] = packed_timestamp(field_name + '_ts')
+                scrape_columns[valid_name] = 'scrape_valid'
+                scrape_columns[source_name] = field_name + '_src'
+                scrape_columns[timestamp_name] = field_name + '_ts'
+                continue
+
             # Add the "valid" field.
             attname = field_name + '_valid'
             scrape_fields.append(attname)
@@ -67,6 +188,41 @@ class ScrapeModelMetaclass(ModelBase):
             if attname not in attrs:
                 attrs[attname] = models.DateTimeField(blank=True, null=True)
 
+        # Packed validity bits all live in the one column. Forms edit the bits through
+        # their properties instead, see "admin.py".
+        if metadata == 'packed':
+            attrs['scrape_valid'] = models.BigIntegerField(default=0, editable=False)
+
+        # Add an indexed content hash for each requested file field, used to find
+        # existing objects by file without searching on names.
+        for field_name in hash_fields:
+            if not isinstance(attrs.get(field_name), models.FileField):
+                raise TypeError('"%s" in scrape_hash_fields is not a file field.'%field_name)
+            attname = field_name + '_hash'
+            scrape_fields.append(attname)
+            if attname not in attrs:
+                attrs[attname] = models.CharField(max_length=40, db_index=True, blank=True, null=True)
+
+        # Add a natural key, a hash of the ID of the item the object was scraped from,
+        # so existing objects are found with a single indexed lookup.
+        if use_key:
+            scrape_fields.append('scrape_key')
+            if 'scrape_key' not in attrs:
+                attrs['scrape_key'] = models.CharField(max_length=40, unique=True, blank=True, null=True,
+                                                       editable=False)
+
+        # Record the page each object was last scraped from and when, bumped on every
+        # scrape whether or not anything changed. Used to re-crawl the stalest objects,
+        # see "scheduler.py".
+        if schedule:
+            scrape_fields.extend(['scrape_url', 'scrape_time'])
+            if 'scrape_url' not in attrs:
+                attrs['scrape_url'] = models.URLField(verify_exists=False, max_length=500, blank=True,
+                                                      null=True, editable=False)
+            if 'scrape_time' not in attrs:
+                attrs['scrape_time'] = models.DateTimeField(blank=True, null=True, db_index=True,
+                                                            editable=False)
+
         # Call our parent's __new__.
         inst = super(ScrapeModelMetaclass, cls).__new__(cls, name, bases, attrs)
 
@@ -78,6 +234,13 @@ class ScrapeModelMetaclass(ModelBase):
             inst._scrape_fields = scrape_fields
         if not hasattr(inst, '_scrape_valid_fields'):
             inst._scrape_valid_fields = scrape_valid_fields
+        if not hasattr(inst, '_scrape_metadata'):
+            inst._scrape_metadata = metadata
+            inst._scrape_columns = scrape_columns
+        if not hasattr(inst, '_scrape_coverage'):
+            inst._scrape_coverage = coverage
+        if not hasattr(inst, '_scrape_schedule'):
+            inst._scrape_schedule = schedule
 
         # Return the instance.
         return inst
@@ -91,3 +254,161 @@ class ScrapeModel(models.Model):
 
     class Meta:
         abstract = True
+
+
+## Validation states an object can be in.
+VALID_STATES = (
+    ('all', 'Fully validated'),
+    ('some', 'Partly validated'),
+    ('none', 'Not validated'),
+)
+
+
+## How many of an object's fields are validated: "all", "some" or "none".
+def get_valid_state(obj):
+    valid = [getattr(obj, n) for n in obj._scrape_valid_fields]
+    if all(valid):
+        return 'all'
+    elif any(valid):
+        return 'some'
+    return 'none'
+
+
+## Limit a queryset of scraped objects to those in a validation state.
+def filter_valid_state(qs, state):
+    model = qs.model
+    if model._scrape_metadata == 'packed':
+        all_q = Q(scrape_valid=(1 << len(model._scrape_valid_fields)) - 1)
+        none_q = Q(scrape_valid=0)
+    else:
+        all_q = Q(**dict([(n, True) for n in model._scrape_valid_fields]))
+        none_q = Q(**dict([(n, False) for n in model._scrape_valid_fields]))
+    if state == 'all':
+        return qs.filter(all_q)
+    elif state == 'none':
+        return qs.filter(none_q)
+    return qs.exclude(all_q).exclude(none_q)
+
+
+## Set or clear the validity of fields of every object in a queryset.
+# Runs a single UPDATE, without loading any objects or touching their sources and
+# timestamps. "field_names" are target field names, defaulting to all of them.
+# Returns the number of objects updated. Coverage counts are adjusted by counting
+# the states of just the selected objects beforehand.
+def set_valid(qs, field_names=None, valid=True):
+    model = qs.model
+    if field_names is None:
+        field_names = [n[:-6] for n in model._scrape_valid_fields]
+    valid_names = []
+    for name in field_names:
+        valid_name = name + '_valid'
+        if valid_name not in model._scrape_valid_fields:
+            raise ValueError('%s has no scraped field named %s'%(model._meta.object_name, name))
+        valid_names.append(valid_name)
+    if not valid_names:
+        return 0
+    other_names = [n for n in model._scrape_valid_fields if n not in valid_names]
+
+    # Setting fields leaves an object fully validated if all the others already
+    # are, clearing them leaves it not validated if none of the others are.
+    if model._scrape_metadata == 'packed':
+        mask = others = 0
+        for ii, valid_name in enumerate(model._scrape_valid_fields):
+            if valid_name in valid_names:
+                mask |= 1 << ii
+            else:
+                others |= 1 << ii
+        if valid:
+            update = F('scrape_valid') | mask
+            others_q = Q(scrape_valid=F('scrape_valid') | others)
+        else:
+            update = F('scrape_valid') & ~mask
+            others_q = Q(scrape_valid=F('scrape_valid') & ~others)
+        values = {'scrape_valid': update}
+    else:
+        others_q = Q(**dict([(n, valid) for n in other_names]))
+        values = dict([(n, valid) for n in valid_names])
+
+    if model._scrape_coverage:
+        was_all = filter_valid_state(qs, 'all').count()
+        was_none = filter_valid_state(qs, 'none').count()
+        now = qs.filter(others_q).count()
+    updated = qs.update(**values)
+    if model._scrape_coverage and updated:
+        if valid:
+            ScrapeCoverage.add(model, fully_valid=now - was_all, not_valid=-was_none)
+        else:
+            ScrapeCoverage.add(model, fully_valid=-was_all, not_valid=now - was_none)
+    return updated
+
+
+## Counts of objects by validation state, for models with "scrape_coverage" set.
+# Kept up to date as objects are created by DjangoItem.save and edited or deleted
+# in the admin, so the admin never has to count large tables. Changes made any
+# other way leave the counts out until "rebuild" is called, for example by the
+# scrape_coverage management command.
+class ScrapeCoverage(models.Model):
+    model = models.CharField(max_length=100, unique=True)
+    total = models.IntegerField(default=0)
+    fully_valid = models.IntegerField(default=0)
+    not_valid = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return self.model
+
+    @staticmethod
+    def get_label(model):
+        return u'%s.%s'%(model._meta.app_label, model._meta.object_name)
+
+    ## Count a model's objects from scratch.
+    @classmethod
+    def rebuild(cls, model):
+        qs = model._default_manager.all()
+        coverage = cls.objects.get_or_create(model=cls.get_label(model))[0]
+        coverage.total = qs.count()
+        coverage.fully_valid = filter_valid_state(qs, 'all').count()
+        coverage.not_valid = filter_valid_state(qs, 'none').count()
+        coverage.save()
+        return coverage
+
+    ## Adjust the counts for a model.
+    # If the model hasn't been counted yet it's counted from scratch instead, which
+    # includes whatever changes are being recorded.
+    @classmethod
+    def add(cls, model, total=0, fully_valid=0, not_valid=0):
+        updated = cls.objects.filter(model=cls.get_label(model)).update(
+            total=F('total') + total,
+            fully_valid=F('fully_valid') + fully_valid,
+            not_valid=F('not_valid') + not_valid,
+        )
+        if not updated:
+            cls.rebuild(model)
+
+    ## Record an object moving between validation states.
+    # Either state may be None, for objects being created or deleted.
+    @classmethod
+    def change_state(cls, model, old_state, new_state):
+        if old_state == new_state:
+            return
+        deltas = {'total': 0, 'fully_valid': 0, 'not_valid': 0}
+        for state, sign in ((old_state, -1), (new_state, 1)):
+            if state is not None:
+                deltas['total'] += sign
+            if state == 'all':
+                deltas['fully_valid'] += sign
+            elif state == 'none':
+                deltas['not_valid'] += sign
+        cls.add(model, **deltas)
+
+    ## Counts for each validation state, or None if the model hasn't been counted.
+    @classmethod
+    def get_counts(cls, model):
+        try:
+            coverage = cls.objects.get(model=cls.get_label(model))
+        except cls.DoesNotExist:
+            return None
+        return {
+            'all': coverage.fully_valid,
+            'none': coverage.not_valid,
+            'some': coverage.total - coverage.fully_valid - coverage.not_valid,
+        }
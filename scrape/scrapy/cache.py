@@ -0,0 +1,119 @@
+import threading
+from collections import OrderedDict
+from django.db.models import FileField
+from django.db.models.base import ModelState
+
+
+## A size bounded cache that evicts the least recently used entries.
+# Keeps count of hits and misses so callers can report on its effectiveness.
+class LRUCache(object):
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data[key] = value
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        if len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+    def discard(self, key):
+        self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+
+
+## A model instance's column values, without its state or cached relations.
+# Deferred columns are left to be loaded again.
+def snapshot(obj):
+    values = {}
+    for field in obj._meta.fields:
+        if field.attname not in obj.__dict__:
+            continue
+        value = obj.__dict__[field.attname]
+        if isinstance(field, FileField) and value is not None:
+            value = getattr(value, 'name', value)
+        values[field.attname] = value
+    return (type(obj), obj._state.db, values)
+
+
+## Build a new instance from a snapshot.
+# Skips __init__, like loading from the database, so no signals are sent and
+# images aren't opened to find their size.
+def restore(snap):
+    model, db, values = snap
+    obj = model.__new__(model)
+    obj.__dict__.update(values)
+    obj._state = ModelState()
+    obj._state.db = db
+    obj._state.adding = False
+    return obj
+
+
+## Remembers the object found for each unique lookup.
+# Wraps another cache, such as an LRUCache, making it safe to share between
+# threads. Only objects' column values are kept, and a new instance is built
+# from them on the way out, so callers are free to modify what they get back
+# without touching anyone else's related objects. Unhashable keys are simply
+# never cached.
+class IdentityCache(object):
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.lock = threading.Lock()
+
+    @property
+    def hits(self):
+        return self.cache.hits
+
+    @property
+    def misses(self):
+        return self.cache.misses
+
+    def get(self, key):
+        try:
+            with self.lock:
+                snap = self.cache.get(key)
+        except TypeError:
+            return None
+        if snap is None:
+            return None
+        return restore(snap)
+
+    def set(self, key, obj):
+        try:
+            with self.lock:
+                self.cache.set(key, snapshot(obj))
+        except TypeError:
+            pass
+
+    def discard(self, key):
+        try:
+            with self.lock:
+                self.cache.discard(key)
+        except TypeError:
+            pass
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
@@ -0,0 +1,94 @@
+import os, errno, hashlib, threading
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from cache import LRUCache
+
+
+## Ways a downloaded file can be put into a file field.
+#   copy       Copy the file into the field's storage.
+#   link       Hard link it into the storage's directory.
+#   move       Rename it into the storage's directory. The download is gone
+#              afterwards, so the images pipeline will fetch it again next crawl.
+#              Items sharing a download get the name it was moved to, as long as
+#              it was moved by this process recently enough to be remembered.
+#   reference  Point the field at the file where it is. Only possible if it's
+#              already inside the storage's directory, e.g. IMAGES_STORE is
+#              under MEDIA_ROOT.
+# Anything other than "copy" needs a FileSystemStorage, and falls back to the
+# next best mode when it isn't possible, ending with a copy.
+FILE_MODES = ('copy', 'link', 'move', 'reference')
+
+# Where moved downloads went, by their absolute path.
+moved_files = LRUCache(10000)
+moved_lock = threading.Lock()
+
+
+## Store a downloaded file in a field file without saving its instance.
+def store_file(field_file, path, mode='copy'):
+    storage = field_file.storage
+    if mode != 'copy' and isinstance(storage, FileSystemStorage):
+        if mode == 'reference':
+            name = os.path.relpath(os.path.abspath(path), os.path.abspath(storage.location))
+            if not name.startswith(os.pardir):
+                set_name(field_file, name)
+                return
+            mode = 'link'
+        if mode == 'move':
+
+            # The download may already have been moved for another item.
+            key = os.path.abspath(path)
+            with moved_lock:
+                moved = moved_files.get(key)
+                if moved is not None and moved[0] == storage.location and not os.path.exists(path):
+                    set_name(field_file, moved[1])
+                    return
+                name = place_file(field_file, path, os.rename)
+                if name is not None:
+                    moved_files.set(key, (storage.location, name))
+                    return
+        elif place_file(field_file, path, os.link) is not None:
+            return
+
+    # Storages stream the file across in chunks.
+    with open(path, 'rb') as f:
+        field_file.save(os.path.basename(path), File(f), save=False)
+
+
+## Put a file into a field's storage directory by linking or renaming it.
+# Returns the stored name, or None if it isn't possible and the file needs copying
+# instead.
+def place_file(field_file, path, place):
+    storage = field_file.storage
+    name = field_file.field.generate_filename(field_file.instance, os.path.basename(path))
+    name = storage.get_available_name(name)
+    dest = storage.path(name)
+    try:
+        directory = os.path.dirname(dest)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        place(path, dest)
+    except OSError, e:
+
+        # Different filesystems, no hard links, or someone beat us to the name.
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EEXIST, errno.ENOTSUP):
+            raise
+        return None
+    set_name(field_file, name)
+    return name
+
+
+## MD5 of a file's contents, in hex.
+# The same as the checksums reported by the images pipeline.
+def file_hash(path, chunk_size=65536):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+## Point a field file at a file already in its storage.
+def set_name(field_file, name):
+    field_file.name = name
+    setattr(field_file.instance, field_file.field.name, name)
+    field_file._committed = True
@@ -0,0 +1,145 @@
+import threading
+from django.db.models import Model
+from cache import LRUCache
+from stores import SqliteStore
+
+
+## Geocode an address using the field itself.
+# This is what AddressField does when given a string, and needs network access.
+# Anything with the same signature can be used in its place by setting
+# DJANGO_ITEM_GEOCODER, e.g. a stub returning fixed addresses for tests.
+def geocode(field, value):
+    return field.to_python(value)
+
+
+## Resolves address strings to saved Address objects.
+# Results are kept by normalised address in an in-process LRU cache, and, if a
+# path is given, in an SQLite table that persists between crawls. The country,
+# state and locality of each new address are found or created through their own
+# caches, so a repeated address costs no geocoding and no writes.
+#
+# Set "wait_for_commit" when addresses are saved inside transactions. New entries
+# are then held back from the persistent cache until "commit" is called after the
+# transaction commits, and forgotten by "clear" if it rolls back, as a rolled
+# back row's primary key may be reused for another address.
+class AddressCache(object):
+
+    def __init__(self, geocode=geocode, size=10000, path=None, level_size=1000):
+        self.geocode = geocode
+        self.cache = LRUCache(size)
+        self.path = path
+        self.store = None
+        self.level_size = level_size
+        self.levels = {}
+        self.wait_for_commit = False
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.open()
+
+    @classmethod
+    def from_settings(cls, settings):
+        from scrapy.utils.misc import load_object
+        return cls(
+            geocode=load_object(settings.get('DJANGO_ITEM_GEOCODER', 'scrape.scrapy.geocoding.geocode')),
+            size=settings.getint('DJANGO_ITEM_GEOCODE_CACHE_SIZE', 10000),
+            path=settings.get('DJANGO_ITEM_GEOCODE_CACHE'),
+        )
+
+    @staticmethod
+    def normalize(value):
+        return u' '.join(unicode(value).lower().split())
+
+    ## Get a saved Address for a value.
+    # Values that are already model instances are returned as is.
+    def resolve(self, field, value):
+        if isinstance(value, Model):
+            return value
+        key = self.normalize(value)
+
+        # Check the in-process cache then the persistent one.
+        with self.lock:
+            address = self.cache.get(key)
+            if address is None and self.store is not None:
+                pk = self.store.get(key)
+                if pk is not None:
+                    # The row may have been lost to a rolled back transaction.
+                    try:
+                        address = field.rel.to._default_manager.get(pk=pk)
+                        self.cache.set(key, address)
+                    except field.rel.to.DoesNotExist:
+                        pass
+        if address is not None:
+            return address
+
+        # Geocode and store the address, including each level of its locality.
+        address = self.geocode(field, value)
+        locality = address.locality
+        state = locality.state
+        self.get_or_create(state.country)
+        state.country_id = state.country.pk
+        self.get_or_create(state)
+        locality.state_id = state.pk
+        self.get_or_create(locality)
+        address.locality_id = locality.pk
+        self.get_or_create(address)
+
+        with self.lock:
+            self.cache.set(key, address)
+            if self.store is None:
+                pass
+            elif self.wait_for_commit:
+                self.pending[key] = address.pk
+            else:
+                self.store.set(key, address.pk)
+        return address
+
+    ## Find or create the row matching an unsaved object.
+    # Rows are matched on all their fields. Objects that already have a primary
+    # key are left alone.
+    def get_or_create(self, obj):
+        if obj.pk is not None:
+            return
+        model = type(obj)
+        lookup = tuple([(f.attname, getattr(obj, f.attname)) for f in model._meta.fields
+                        if not f.primary_key])
+        with self.lock:
+            cache = self.levels.get(model)
+            if cache is None:
+                cache = self.levels[model] = LRUCache(self.level_size)
+            pk = cache.get(lookup)
+        if pk is None:
+            pk = model._default_manager.get_or_create(**dict(lookup))[0].pk
+            with self.lock:
+                cache.set(lookup, pk)
+        obj.pk = pk
+
+    ## Forget everything held in memory.
+    # Needed when a transaction is rolled back, as the rows we remember may have
+    # gone with it.
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.levels.clear()
+            self.pending.clear()
+
+    ## Write new entries to the persistent cache, once their rows are committed.
+    def commit(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            if self.store is not None:
+                for key, pk in pending.iteritems():
+                    self.store.set(key, pk)
+                self.store.commit()
+
+    ## Open the persistent cache, if there is one and it isn't open already.
+    def open(self):
+        if self.path and self.store is None:
+            self.store = SqliteStore(self.path)
+
+    ## Close the persistent cache. Entries still waiting on a commit are dropped.
+    def close(self):
+        with self.lock:
+            self.pending.clear()
+        if self.store is not None:
+            self.store.close()
+            self.store = None
@@ -1,23 +1,111 @@
-import os, urllib2
+import os, time, urllib2, operator, hashlib
 from datetime import datetime
+from twisted.python.failure import Failure
+from scrapy import log
 from scrapy.exceptions import DropItem
 from scrapy.item import Field, Item, ItemMeta
 from scrapy.contrib.loader import ItemLoader, XPathItemLoader
 import django.db.models as django_models
-from django.core.files import File
+from django.db import transaction
+from django.db.models import Q
 from django.db.models import OneToOneField, ForeignKey, FileField, ImageField
 from django.db.models.fields.related import RelatedField, ManyToManyField
 from django.db.models.fields.subclassing import SubfieldBase
 from django.core.exceptions import ObjectDoesNotExist
 from processors import *
+from geocoding import AddressCache
+from metrics import record_time
+from files import store_file, set_name
 from address.models import AddressField
+from scrape.models import ScrapeCoverage
 from pythonutils.conv import to_datetime
 
 # Don't assume googlemaps is available.
 try:
     from googlemaps import GoogleMapsError
 except:
-    pass
+    class GoogleMapsError(Exception):
+        pass
+
+# Used when there's no pipeline to provide an address cache.
+default_address_cache = AddressCache()
+
+
+## How a model field is handled when saving.
+# DjangoItemMeta builds one of these for each model field when the item class is
+# created, so the save path never needs to classify fields again.
+class FieldPlan(object):
+    __slots__ = ('field', 'name', 'attname', 'unique', 'required', 'is_fk', 'is_m2m', 'is_related',
+                 'is_file', 'is_image', 'is_address', 'is_text', 'valid_name', 'source_name',
+                 'timestamp_name', 'hash_name')
+
+    def __init__(self, field, scrape_model=False):
+        self.field = field
+        self.name = field.name
+        self.attname = field.attname
+        self.unique = field.unique
+        self.required = field.blank == False
+        self.is_m2m = isinstance(field, ManyToManyField)
+        self.is_fk = isinstance(field, (ForeignKey, OneToOneField)) and \
+            not issubclass(field.__metaclass__, SubfieldBase)
+        self.is_related = self.is_fk or self.is_m2m
+        self.is_file = isinstance(field, FileField)
+        self.is_image = isinstance(field, ImageField)
+        self.is_address = isinstance(field, AddressField)
+        self.is_text = isinstance(field, (django_models.CharField, django_models.TextField))
+        # Only scraped fields have metadata; the metadata fields themselves, and any
+        # excluded fields, don't.
+        scrape_fields = getattr(field.model, '_scrape_fields', ()) if scrape_model else ()
+        if field.name + '_valid' in scrape_fields:
+            self.valid_name = field.name + '_valid'
+            self.source_name = field.name + '_source'
+            self.timestamp_name = field.name + '_timestamp'
+        else:
+            self.valid_name = self.source_name = self.timestamp_name = None
+        if self.is_file and field.name + '_hash' in scrape_fields:
+            self.hash_name = field.name + '_hash'
+        else:
+            self.hash_name = None
+
+    ## Name used to refer to this field when holding the given value.
+    # Related objects are passed around by primary key, which means we need to use
+    # the field's attribute name (e.g. "artist_id") instead of the field name.
+    def attr_name(self, value):
+        if self.is_fk and value not in ('', None, []) and not isinstance(value, django_models.Model):
+            return self.attname
+        return self.name
+
+    ## Does an object currently hold something other than the given value?
+    # Related objects are compared by primary key so they never need to be loaded.
+    def differs(self, obj, value):
+        if isinstance(value, django_models.Model):
+            return getattr(obj, self.attname) != value.pk
+        if self.is_fk:
+            return getattr(obj, self.attname) != value
+        try:
+            value = self.field.to_python(value)
+        except Exception:
+            return True
+        return getattr(obj, self.name) != value
+
+    ## Build a lookup for an already converted value.
+    # See "get_field_query".
+    def query(self, value, use_null=False):
+        if value in ('', None, []):
+            if use_null:
+                if self.is_text:
+                    return ('', '')
+                else:
+                    return ('__isnull', True)
+            else:
+                return None
+        if self.is_address:
+            return ('', value)
+        elif self.is_m2m:
+            return ('__contains', value)
+        elif self.is_file:
+            return ('__contains', os.path.basename(value))
+        return ('', value)
 
 
 class DjangoItemMeta(ItemMeta):
@@ -33,11 +121,11 @@ class DjangoItemMeta(ItemMeta):
             elif isinstance(field, django_models.BooleanField):
                 return Bool()
             elif isinstance(field, django_models.DateTimeField):
-                return DateTime()
+                return DateTime(cls.date_formats)
             elif isinstance(field, django_models.DateField):
-                return Date()
+                return Date(cls.date_formats)
             else:
-                return MapCompose(RemoveEntities(), Strip())
+                return Fused(RemoveEntities(), Strip())
 
         # Instantiate our class from the parent and copy their fields.
         cls = super(DjangoItemMeta, mcs).__new__(mcs, class_name, bases, attrs)
@@ -56,6 +144,8 @@ class DjangoItemMeta(ItemMeta):
                 cls._scrape_model = True
         except:
             pass
+        cls._scrape_coverage = getattr(django_model, '_scrape_coverage', False)
+        cls._scrape_schedule = getattr(django_model, '_scrape_schedule', False)
 
         # Make room for our fields.
         cls._model_meta = django_model._meta
@@ -66,11 +156,14 @@ class DjangoItemMeta(ItemMeta):
         cls._model_file_fields = []
         cls._model_img_fields = []
 
+        # Packed scrape metadata is reached through properties, not its columns.
+        packed_columns = set(getattr(django_model, '_scrape_columns', {}).values())
+
         # Do a pass over all the fields.
         for field in cls._model_fields:
 
             # Don't bother looking at the ID field.
-            if field.name == 'id':
+            if field.name == 'id' or field.name in packed_columns:
                 continue
 
             # Different action for each different kind of field.
@@ -100,11 +193,47 @@ class DjangoItemMeta(ItemMeta):
             if field.name not in cls.fields:
                 cls.fields[field.name] = Field(input_processor=ip, output_processor=op)
 
+        # In lazy mode input processors stream their values, and fields that only
+        # keep their first value stop processing once they have one.
+        if cls.lazy_processors:
+            for name, meta in cls.fields.items():
+                ip = meta.get('input_processor')
+                if ip is None or isinstance(ip, Lazy):
+                    continue
+                limit = 1 if isinstance(meta.get('output_processor'), TakeFirst) else None
+                cls.fields[name] = Field(meta, input_processor=Lazy(ip, limit=limit))
+
         # Create a group of related fields.
         cls._model_rel_fields = cls._model_fk_fields + cls._model_m2m_fields
+
         cls._model_fields = cls._model_reg_fields + cls._model_rel_fields + cls._model_file_fields + \
             cls._model_img_fields
 
+        # Compile the save plan.
+        cls._save_plan = [FieldPlan(f, cls._scrape_model) for f in cls._model_fields]
+        plans = dict([(p.name, p) for p in cls._save_plan])
+        cls._convert_plans = [p for p in cls._save_plan if p.is_address]
+        cls._key_plan = None
+        if 'scrape_key' in getattr(django_model, '_scrape_fields', ()):
+            cls._key_plan = plans['scrape_key']
+        cls._unique_plans = [p for p in cls._save_plan
+                             if (p.unique or p.is_file) and p is not cls._key_plan]
+        cls._unique_together_plans = []
+        for unique_set in django_model._meta.unique_together:
+            cur_plans = []
+            for field_name in unique_set:
+                if field_name not in plans:
+                    field = django_model._meta.get_field_by_name(field_name)[0]
+                    plans[field_name] = FieldPlan(field, cls._scrape_model)
+                cur_plans.append(plans[field_name])
+            cls._unique_together_plans.append(cur_plans)
+        cls._required_plans = [p for p in cls._save_plan if p.required]
+
+        # Split the fields into those stored in the model's own row and those that
+        # need the object to exist first.
+        cls._column_plans = [p for p in cls._save_plan if not (p.is_m2m or p.is_file)]
+        cls._post_plans = [p for p in cls._save_plan if p.is_m2m or p.is_file]
+
         return cls
 
 
@@ -112,96 +241,498 @@ def get_field_value(item, field, value, pipeline, spider):
     if value in ('', None, []):
         return None
     if isinstance(field, AddressField):
+        cache = getattr(pipeline, 'address_cache', None) or default_address_cache
         try:
-            address = field.to_python(value)
-        except GoogleMapsError, urllib2.HTTPError:
-            pipeline.drop_item(spider, item.get('id'), 'Failed to geolocate address.')
-        address.locality.state.country.save()
-        address.locality.state.country_id = address.locality.state.country.pk
-        address.locality.state.save()
-        address.locality.state_id = address.locality.state.pk
-        address.locality.save()
-        address.locality_id = address.locality.pk
-        address.save()
-        return address
+            return cache.resolve(field, value)
+        except (GoogleMapsError, urllib2.HTTPError):
+            pipeline.drop_item(spider, item.get('id'), 'Failed to geolocate address.',
+                               reason='geocode', model_name=item.django_model.__name__)
     else:
         return value
 
 
+## Lookup a model field by either its name or attribute name.
+def get_model_field(model, name):
+    try:
+        return model._meta.get_field(name)
+    except django_models.FieldDoesNotExist:
+        for field in model._meta.fields:
+            if field.attname == name:
+                return field
+        raise
+
+
 def get_field_query(item, field, value, pipeline, spider, use_null=False):
-    if value in ('', None, []):
-        if use_null:
-            if isinstance(field, (django_models.CharField, django_models.TextField)):
-                return ('', '')
-            else:
-                return ('__isnull', True)
-        else:
-            return None
     value = get_field_value(item, field, value, pipeline, spider)
-    if isinstance(field, AddressField):
-        return ('', value)
-    elif isinstance(field, ManyToManyField):
-        return ('__contains', value)
-    elif isinstance(field, FileField):
-        return ('__contains', os.path.basename(value))
-    return ('', value)
+    return FieldPlan(field).query(value, use_null)
+
+
+## The pipeline's identity cache for a model, if it has one.
+def get_identity_cache(pipeline, model):
+    get_cache = getattr(pipeline, 'get_identity_cache', None)
+    return get_cache(model) if get_cache else None
+
+
+## The pipeline's metrics, if it's keeping any.
+def get_metrics(pipeline):
+    return getattr(pipeline, 'metrics', None)
+
+
+## Should changed fields be written with an UPDATE instead of a save?
+def get_partial(pipeline):
+    return getattr(pipeline, 'partial_updates', False)
+
+
+## Roll back to a savepoint.
+# Lets the pipeline know, so it can throw away anything it has cached that may
+# have been rolled back too. Savepoints only exist in managed transactions.
+def rollback_savepoint(pipeline, sid):
+    transaction.savepoint_rollback(sid)
+    rolled_back = getattr(pipeline, 'rolled_back', None)
+    if rolled_back is not None and transaction.is_managed():
+        rolled_back()
+
+
+## Count new objects towards their model's coverage.
+# New objects start out not validated. A pipeline collects the counts and writes
+# them once per batch or transaction, so writers don't queue on the one counter
+# row. Without one they're written straight away.
+def count_created(pipeline, model, num):
+    add_coverage = getattr(pipeline, 'add_coverage', None)
+    if add_coverage is not None:
+        add_coverage(model, num)
+    else:
+        ScrapeCoverage.add(model, total=num, not_valid=num)
+
+
+## Write the changed fields of an object.
+# Saves the whole object, unless "partial" is set, in which case a single UPDATE
+# is limited to the named fields, plus any "auto_now" fields and the dimension
+# fields of changed images. Values then go through each field's "pre_save", as
+# they would when saving, but the model's "save" isn't called and no save signals
+# are sent. Packed scrape metadata is written to the columns behind it. The time
+# taken is added to "metrics", if given.
+def update_object(obj, names, metrics=None, partial=False):
+    started = time.time()
+    model = type(obj)
+    if not partial:
+        obj.save()
+        record_time(metrics, model.__name__, 'save', started)
+        return
+    columns = getattr(obj, '_scrape_columns', None)
+    if columns:
+        names = set([columns.get(n, n) for n in names])
+    else:
+        names = set(names)
+    for field in model._meta.fields:
+        if getattr(field, 'auto_now', False):
+            names.add(field.name)
+        elif isinstance(field, ImageField) and field.name in names:
+            names.update([n for n in (field.width_field, field.height_field) if n])
+    values = {}
+    for name in names:
+        values[name] = model._meta.get_field(name).pre_save(obj, False)
+    model._default_manager.filter(pk=obj.pk).update(**values)
+    record_time(metrics, model.__name__, 'save', started)
+
+
+## Can a filter be matched against an object in Python?
+# Only plain equality and '__isnull' lookups on concrete columns qualify.
+def is_simple_filter(model, fltr):
+    for lookup in fltr.iterkeys():
+        name, sep, op = lookup.partition('__')
+        if op not in ('', 'isnull'):
+            return False
+        try:
+            field = get_model_field(model, name)
+        except django_models.FieldDoesNotExist:
+            return False
+        if isinstance(field, (ManyToManyField, FileField)):
+            return False
+    return True
+
+
+## Hashable key describing a simple filter.
+def filter_key(fltr):
+    key = []
+    for lookup, value in fltr.iteritems():
+        if isinstance(value, django_models.Model):
+            value = value.pk
+        key.append((lookup, value))
+    return tuple(sorted(key))
+
+
+## The key an object would have under a filter with the given lookups.
+def object_key(obj, lookups):
+    key = []
+    for lookup in lookups:
+        name, sep, op = lookup.partition('__')
+        value = getattr(obj, get_model_field(type(obj), name).attname)
+        if op == 'isnull':
+            value = value is None
+        key.append((lookup, value))
+    return tuple(key)
+
+
+## Build a query matching any of a set of simple filters.
+# Filters on a single column are combined into one "__in" lookup.
+def filters_query(fltrs):
+    groups = {}
+    for fltr in fltrs:
+        groups.setdefault(tuple(sorted(fltr.iterkeys())), []).append(fltr)
+    queries = []
+    for lookups, group in groups.iteritems():
+        if len(lookups) == 1 and '__' not in lookups[0]:
+            queries.append(Q(**{lookups[0] + '__in': [f[lookups[0]] for f in group]}))
+        else:
+            queries.extend([Q(**f) for f in group])
+    return reduce(operator.or_, queries)
+
+
+## Find objects matching any of a set of simple filters.
+# Uses one query for every "chunk_size" filters, keeping under the limits some
+# databases have on query parameters. Returns a dictionary mapping filter keys
+# to objects.
+def find_objects(model, fltrs, chunk_size=500):
+    lookup_sets = set([tuple(sorted(f.iterkeys())) for f in fltrs])
+    objs = {}
+    for ii in xrange(0, len(fltrs), chunk_size):
+        for obj in model.objects.filter(filters_query(fltrs[ii:ii + chunk_size])):
+            for lookups in lookup_sets:
+                objs.setdefault(object_key(obj, lookups), obj)
+    return objs
 
 
 class DjangoItem(Item):
     __metaclass__ = DjangoItemMeta
     django_model = None
 
+    # Formats tried, in order, when parsing date and time fields. Strings that
+    # match none of them are parsed fuzzily.
+    date_formats = ()
+
+    # Set to stream values through input processors instead of building a list
+    # at every step. See "Lazy".
+    lazy_processors = False
+
     # We use the "id" field to form links between models for related fields.
-    id = Field(input_processor=MapCompose(RemoveEntities(), Strip()), output_processor=TakeFirst())
+    id = Field(input_processor=Fused(RemoveEntities(), Strip()), output_processor=TakeFirst())
     scrape_url = Field(output_processor=TakeFirst())
 
+    # Set by the pipeline when fingerprinting items.
+    _fingerprint = None
+
+    # How files are put into file fields, set by the pipeline. See "files.py".
+    _file_mode = 'copy'
+
     def save(self, pipeline, spider):
-        # Convert all our values as needed. Mostly for addresses, dammit.
-        for field in self._model_fields:
-            value = self.get(field.name)
-            if value not in ['', None, []]:
-                self[field.name] = get_field_value(self, field, value, pipeline, spider)
+        metrics = get_metrics(pipeline)
+        partial = get_partial(pipeline)
+        model_name = self.django_model.__name__
+        self.convert_values(pipeline, spider)
+        fltr = self.get_filter(pipeline, spider)
+        started = time.time()
+        cache = get_identity_cache(pipeline, self.django_model)
+        obj = cache.get(filter_key(fltr)) if (cache and fltr) else None
+        created = False
+        if obj is None:
+            obj, created = self.get_object(fltr)
+        record_time(metrics, model_name, 'lookup', started)
 
-        # Create a search filter, beginning by adding all my unique fields.
+        # We perform a fill operation even on new objects because of the possibility
+        # that the filter we uesed to find an existing object contained '__' notations,
+        # e.g. any many-to-many field.
+        dirty = self.fill(obj, metrics=metrics)
+
+        # Write whatever changed, if anything.
+        if dirty:
+            update_object(obj, dirty, metrics, partial)
+        if cache and fltr:
+            cache.set(filter_key(fltr), obj)
+        if created and self._scrape_coverage:
+            count_created(pipeline, self.django_model, 1)
+
+        return obj
+
+    ## Save a list of items of the same model in bulk.
+    # Existing objects are found with a single query over all the items' filters and
+    # new objects are created with a single bulk insert. Items whose filters can't be
+    # matched back to rows in Python (i.e. those containing '__contains' lookups) are
+    # saved one at a time. Returns a list of objects or failures, one per item.
+    #
+    # Inside a managed transaction each item's writes get their own savepoint, so a
+    # failure only rolls back that item.
+    @classmethod
+    def save_batch(cls, items, pipeline, spider):
+        model = cls.django_model
+        metrics = get_metrics(pipeline)
+        partial = get_partial(pipeline)
+        results = [None]*len(items)
+        fltrs = [None]*len(items)
+
+        # Convert values and build filters, failures only affect their own item. Items
+        # with cached objects are finished off straight away.
+        cache = get_identity_cache(pipeline, model)
+        single, grouped = [], {}
+        for ii, item in enumerate(items):
+            sid = transaction.savepoint()
+            try:
+                item.convert_values(pipeline, spider)
+                fltrs[ii] = item.get_filter(pipeline, spider)
+                obj = cache.get(filter_key(fltrs[ii])) if (cache and fltrs[ii]) else None
+                if obj is not None:
+                    dirty = item.fill(obj, metrics=metrics)
+                    if dirty:
+                        update_object(obj, dirty, metrics, partial)
+                    cache.set(filter_key(fltrs[ii]), obj)
+                    results[ii] = obj
+            except Exception:
+                results[ii] = Failure()
+                rollback_savepoint(pipeline, sid)
+                continue
+            transaction.savepoint_commit(sid)
+            if results[ii] is not None:
+                continue
+            if fltrs[ii] and is_simple_filter(model, fltrs[ii]):
+                grouped.setdefault(filter_key(fltrs[ii]), []).append(ii)
+            else:
+                single.append(ii)
+
+        # Locate existing objects with one query and create the rest in bulk.
+        objs, created = {}, set()
+        if grouped:
+            keys = grouped.keys()
+            started = time.time()
+            objs = find_objects(model, [fltrs[grouped[k][0]] for k in keys])
+            missing = [k for k in keys if k not in objs]
+
+            # Objects saved before their model had a natural key are found by their
+            # unique fields, as in "get_object". Those that can't be matched in
+            # Python are left to be saved one at a time.
+            if missing and cls._key_plan is not None:
+                legacy = {}
+                for key in missing:
+                    unique_fltr = items[grouped[key][0]].get_unique_filter()
+                    if not unique_fltr:
+                        continue
+                    if is_simple_filter(model, unique_fltr):
+                        legacy[key] = unique_fltr
+                    else:
+                        single.extend(grouped.pop(key))
+                if legacy:
+                    found = find_objects(model, legacy.values())
+                    for key, unique_fltr in legacy.iteritems():
+                        obj = found.get(filter_key(unique_fltr))
+                        if obj is not None:
+                            objs[key] = obj
+                missing = [k for k in keys if k in grouped and k not in objs]
+            record_time(metrics, model.__name__, 'lookup', started)
+            if missing:
+                new_objs = []
+                for key in missing:
+                    item = items[grouped[key][0]]
+                    try:
+                        obj = model(**item.get_create_values(fltrs[grouped[key][0]]))
+                        item.fill(obj, item._column_plans)
+                    except Exception:
+                        failure = Failure()
+                        for ii in grouped.pop(key):
+                            results[ii] = failure
+                        continue
+                    new_objs.append(obj)
+                missing = [k for k in missing if k in grouped]
+                if missing:
+                    sid = transaction.savepoint()
+                    try:
+                        started = time.time()
+                        model.objects.bulk_create(new_objs)
+                        record_time(metrics, model.__name__, 'save', started)
+                        found = find_objects(model, [fltrs[grouped[k][0]] for k in missing])
+                        objs.update(found)
+                        created.update([k for k in missing if k in found])
+                        transaction.savepoint_commit(sid)
+                        if created and cls._scrape_coverage:
+                            count_created(pipeline, model, len(created))
+                    except Exception:
+                        rollback_savepoint(pipeline, sid)
+                        transaction.rollback_unless_managed()
+                        spider.log('Bulk insert into %s failed, saving individually.'%model.__name__,
+                                   level=log.WARNING)
+
+            # Anything we still couldn't find gets saved the slow way.
+            for key in grouped.keys():
+                if key not in objs:
+                    single.extend(grouped.pop(key))
+
+        # Fill and save the objects we found or created in bulk. Objects we just inserted
+        # already have their columns filled, they only need their related fields.
+        for key, indices in grouped.iteritems():
+            obj = objs[key]
+            for ii in indices:
+                item = items[ii]
+                sid = transaction.savepoint()
+                try:
+                    if key in created and ii == indices[0]:
+                        dirty = item.fill(obj, item._post_plans, metrics)
+                    else:
+                        dirty = item.fill(obj, metrics=metrics)
+                    if dirty:
+                        update_object(obj, dirty, metrics, partial)
+                    if cache:
+                        cache.set(key, obj)
+                    results[ii] = obj
+                    transaction.savepoint_commit(sid)
+                except Exception:
+                    results[ii] = Failure()
+                    rollback_savepoint(pipeline, sid)
+
+        # Save the remainder individually.
+        for ii in single:
+            sid = transaction.savepoint()
+            try:
+                started = time.time()
+                obj, is_new = items[ii].get_object(fltrs[ii])
+                record_time(metrics, model.__name__, 'lookup', started)
+                dirty = items[ii].fill(obj, metrics=metrics)
+                if dirty:
+                    update_object(obj, dirty, metrics, partial)
+                if cache and fltrs[ii]:
+                    cache.set(filter_key(fltrs[ii]), obj)
+                results[ii] = obj
+                transaction.savepoint_commit(sid)
+                if is_new and cls._scrape_coverage:
+                    count_created(pipeline, model, 1)
+            except Exception:
+                results[ii] = Failure()
+                rollback_savepoint(pipeline, sid)
+
+        return results
+
+    ## Key identifying this item between crawls.
+    # Based on the item's ID. Items without one aren't fingerprinted, as several
+    # of them often come from the same page.
+    def get_fingerprint_key(self):
+        id = self.get('id')
+        if not id:
+            return None
+        return u'%s.%s:%s'%(self._model_meta.app_label, self._model_meta.object_name, id)
+
+    ## A stable hash of the item's model field values.
+    # Must be taken before values are converted. Related objects are included by
+    # primary key, so items are only considered unchanged if their relations are too.
+    def get_fingerprint(self):
+        digest = hashlib.sha1()
+        for plan in self._save_plan:
+            digest.update('%s\0%r\0'%(plan.name, self.get(plan.name)))
+        return digest.hexdigest()
+
+    ## Convert all our values as needed. Mostly for addresses, dammit.
+    def convert_values(self, pipeline, spider):
+        for plan in self._convert_plans:
+            value = self.get(plan.name)
+            if value not in ['', None, []]:
+                self[plan.name] = get_field_value(self, plan.field, value, pipeline, spider)
+
+    ## The natural key of the object this item saves to.
+    # A hash of the item's ID. Items without one have no key, as several of them
+    # often come from the same page; they're found by their unique fields instead.
+    def get_scrape_key(self):
+        id = self.get('id')
+        if not id:
+            return None
+        if isinstance(id, unicode):
+            id = id.encode('utf-8')
+        return hashlib.sha1(id).hexdigest()
+
+    ## Create a search filter used to find an existing object.
+    # Models with a natural key are found by it, see "get_object". Everything
+    # else is found by its unique fields. Expects values to have been converted
+    # already.
+    def get_filter(self, pipeline, spider):
+        if self._key_plan is not None:
+            key = self.get_scrape_key()
+            if key is not None:
+                self[self._key_plan.name] = key
+                return {self._key_plan.name: key}
+        return self.get_unique_filter()
+
+    ## Create a search filter from our unique fields.
+    def get_unique_filter(self):
+
+        # Begin by adding all my unique fields.
         fltr = {}
-        for field in self._model_fields:
-            if field.unique or isinstance(field, FileField):
-                query = get_field_query(self, field, self.get(field.name, None), pipeline, spider)
-                if query:
-                    fltr.update({field.name + query[0]: query[1]})
+        for plan in self._unique_plans:
+
+            # Files with a content hash are found by it.
+            if plan.hash_name is not None and self.get(plan.hash_name):
+                fltr[plan.hash_name] = self[plan.hash_name]
+                continue
+
+            value = self.get(plan.name, None)
+            query = plan.query(value)
+            if query:
+                fltr[plan.attr_name(value) + query[0]] = query[1]
 
         # Now add all the fields that must be unique combined.
-        for unique_set in self.django_model._meta.unique_together:
-            cur_fltr = {}
-            for field_name in unique_set:
-                field = self.django_model._meta.get_field_by_name(field_name)[0]
-                query = get_field_query(self, field, self.get(field.name, None), pipeline, spider, use_null=True)
-                cur_fltr.update({field.name + query[0]: query[1]})
-            if cur_fltr:
-                fltr.update(cur_fltr)
-
-        # Either get an existing object or create a new one.
-        if fltr:
-            obj, created = self.django_model.objects.get_or_create(**fltr)
+        for unique_plans in self._unique_together_plans:
+            for plan in unique_plans:
+                value = self.get(plan.name, None)
+                query = plan.query(value, use_null=True)
+                fltr[plan.attr_name(value) + query[0]] = query[1]
+
+        return fltr
+
+    ## Values used when inserting a new object.
+    # Made up of the plain lookups from the filter, and the required fields if
+    # there's nothing else or "required" is set.
+    def get_create_values(self, fltr, required=False):
+        values = dict([(k, v) for k, v in fltr.iteritems() if '__' not in k])
+        if not fltr or required:
+            for plan in self._required_plans:
+                value = self.get(plan.name)
+                if value is None:
+                    print self
+                assert value is not None
+                values[plan.attr_name(value)] = value
+        return values
+
+    ## Either get an existing object or create a new one.
+    # Objects saved before their model had a natural key don't have one yet, so
+    # if nothing has our key we look again by our unique fields.
+    def get_object(self, fltr):
+        if fltr and self._key_plan is not None and fltr.keys() == [self._key_plan.name]:
+            manager = self.django_model.objects
+            try:
+                return manager.get(**fltr), False
+            except ObjectDoesNotExist:
+                pass
+            unique_fltr = self.get_unique_filter()
+            if unique_fltr:
+                return manager.get_or_create(**unique_fltr)
+            return manager.create(**self.get_create_values(fltr, required=True)), True
+        elif fltr:
+            return self.django_model.objects.get_or_create(**fltr)
         else:
 
             # If we're making a new object, be sure to fill required fields.
-            required = {}
-            for field in self._model_fields:
-                if field.blank == False:
-                    value = self.get(field.name)
-                    if value is None:
-                        print self
-                    assert value is not None
-                    required[field.name] = value
-            obj, created = self.django_model.objects.create(**required), True
-
-        # We perform a fill operation even on new objects because of the possibility
-        # that the filter we uesed to find an existing object contained '__' notations,
-        # e.g. any many-to-many field.
-        for field in self._model_fields:
-            name = field.name
-            cur_value = getattr(obj, name)
+            return self.django_model.objects.create(**self.get_create_values(fltr)), True
+
+    ## Fill an object with our values.
+    # Only the given field plans are considered, defaulting to all of them. Values
+    # that match what the object already holds are left alone. Returns the set of
+    # names of the object's own fields that were changed and need writing. Time
+    # spent on many-to-many fields and files is added to "metrics", if given.
+    #
+    # A field's source and timestamp are only set when its value changes, or if
+    # they're empty, so they record when and where the value last changed rather
+    # than when it was last scraped. That way re-scraping an unchanged object
+    # writes nothing, unless its model has "scrape_schedule" set, in which case
+    # the object's "scrape_time" is bumped along with the first plans filled.
+    def fill(self, obj, plans=None, metrics=None):
+        model_name = self.django_model.__name__
+        dirty = set()
+        for plan in (plans if plans is not None else self._save_plan):
+            name = plan.name
 
             # If the value to set is empty, skip it.
             if self.get(name) in [None, '']:
@@ -209,30 +740,42 @@ class DjangoItem(Item):
 
             # If we're using a ScrapeModel, first check if the field has already been
             # validated.
-            if self._scrape_model:
-                if getattr(obj, name + '_valid') == True:
+            if plan.valid_name is not None:
+                if getattr(obj, plan.valid_name) == True:
                     continue # alrady validated, skip
 
             # If the field is an m2m, perform a merge.
             modified = False
-            if isinstance(field, ManyToManyField):
-                to_insert = arg_to_iter(self.get(name))
-                existing = cur_value.all()
-                to_insert = [t for t in to_insert if t not in existing]
-                for itm in to_insert:
-                    cur_value.add(itm)
+            # We fetch the existing keys once, then add everything new in one go.
+            if plan.is_m2m:
+                started = time.time()
+                cur_value = getattr(obj, name)
+                existing = set(cur_value.values_list('pk', flat=True))
+                to_insert = []
+                for itm in arg_to_iter(self.get(name)):
+                    if isinstance(itm, django_models.Model):
+                        itm = itm.pk
+                    if itm not in existing:
+                        existing.add(itm)
+                        to_insert.append(itm)
+                if to_insert:
+                    cur_value.add(*to_insert)
                     modified = True
+                record_time(metrics, model_name, 'm2m', started)
 
             # If we have a file field we need special consideration.
-            elif isinstance(field, FileField):
+            elif plan.is_file:
 
                 # Only change it if it does not already have a value. If we don't
                 # observe this, we end up with duplicate files.
+                cur_value = getattr(obj, name)
                 if cur_value in ['', None]:
-                    path = self.get(name)
-                    filename = os.path.basename(path)
-                    cur_value.save(filename, File(open(path, 'rb')))
+                    started = time.time()
+                    if not (plan.hash_name and self.use_stored_file(obj, plan)):
+                        store_file(cur_value, self.get(name), self._file_mode)
                     modified = True
+                    dirty.add(name)
+                    record_time(metrics, model_name, 'files', started)
 
             # # Otherwise just check if a value already exists.
             # elif cur_value in ['', None]:
@@ -242,29 +785,50 @@ class DjangoItem(Item):
             # Otherwise, stomp on existing value, bearing in mind that we've already
             # checked if the value we're writing is empty.
             else:
-                setattr(obj, name, self.get(name))
-                modified = True
+                value = self.get(name)
+                if plan.differs(obj, value):
+                    setattr(obj, plan.attr_name(value), value)
+                    modified = True
+                    dirty.add(name)
 
             # If we're using a scrape model and we changed the field, update the scrape data. Or,
             # if there is no existing value for either the source or timestamp, fill them in.
-            if self._scrape_model:
+            if plan.valid_name is not None:
 
                 # Timestamp.
-                cur_name = name + '_timestamp'
+                cur_name = plan.timestamp_name
                 cur_val = getattr(obj, cur_name)
                 if not cur_val or modified:
                     setattr(obj, cur_name, datetime.now())#to_datetime(self[cur_name]))
+                    dirty.add(cur_name)
 
                 # Source
-                cur_name = name + '_source'
+                cur_name = plan.source_name
                 cur_val = getattr(obj, cur_name)
                 if not cur_val or modified:
                     setattr(obj, cur_name, self['scrape_url'])#self[cur_name])
-
-        # Save both the object and the scrape object.
-        obj.save()
-
-        return obj
+                    dirty.add(cur_name)
+
+        # Record the scrape. New objects saved in bulk are filled in two goes, only
+        # the first of which is written with the insert.
+        if self._scrape_schedule and plans is not self._post_plans:
+            obj.scrape_time = datetime.now()
+            dirty.add('scrape_time')
+
+        return dirty
+
+    ## Point a file field at an identical file another object already stored.
+    # Files are matched by content hash. Returns False if there isn't one.
+    def use_stored_file(self, obj, plan):
+        file_hash = self.get(plan.hash_name)
+        if not file_hash:
+            return False
+        names = self.django_model._default_manager.filter(**{plan.hash_name: file_hash}) \
+            .exclude(**{plan.name: ''}).values_list(plan.name, flat=True)[:1]
+        if not names:
+            return False
+        set_name(getattr(obj, plan.name), names[0])
+        return True
 
 
 class DjangoItemLoader(ItemLoader):
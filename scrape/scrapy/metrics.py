@@ -0,0 +1,108 @@
+import time, threading
+from django.conf import settings as django_settings
+from django.db import connection
+
+
+## Stages of saving an item that are timed.
+STAGES = ('wait', 'map', 'lookup', 'm2m', 'files', 'save')
+
+
+## Add the time since "started" to a stage, if we have metrics.
+def record_time(metrics, model_name, stage, started):
+    if metrics is not None:
+        metrics.add_time(model_name, stage, time.time() - started)
+
+
+## Accumulates per model timings, query counts and drops for DjangoItemPipeline.
+# Stages are timed with "time.time" and summed, which costs next to nothing. Query
+# counting needs a debug cursor, which keeps the SQL of every query, so it's only
+# done if "count_queries" is set; the SQL is thrown away again once counted unless
+# DEBUG is on. Everything may be called from DB worker threads.
+class PipelineMetrics(object):
+
+    def __init__(self, count_queries=False):
+        self.count_queries = count_queries
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.items = {}
+        self.queries = {}
+        self.drops = {}
+
+    def add_time(self, model_name, stage, seconds):
+        key = (model_name, stage)
+        with self.lock:
+            timing = self.timings.get(key)
+            if timing is None:
+                timing = self.timings[key] = [0, 0.0]
+            timing[0] += 1
+            timing[1] += seconds
+
+    def add_drop(self, model_name, reason):
+        key = (model_name, reason)
+        with self.lock:
+            self.drops[key] = self.drops.get(key, 0) + 1
+
+    ## Call a function that saves a number of items of a model.
+    # Counts the items, and the queries run if we're counting them. Must be
+    # called in the thread that runs the queries.
+    def measure(self, model_name, num_items, f, *args, **kwargs):
+        if not self.count_queries:
+            try:
+                return f(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.items[model_name] = self.items.get(model_name, 0) + num_items
+        old_debug = connection.use_debug_cursor
+        keep = old_debug or django_settings.DEBUG
+        connection.use_debug_cursor = True
+        start = len(connection.queries)
+        try:
+            return f(*args, **kwargs)
+        finally:
+            num_queries = len(connection.queries) - start
+            if not keep:
+                del connection.queries[start:]
+            connection.use_debug_cursor = old_debug
+            with self.lock:
+                self.items[model_name] = self.items.get(model_name, 0) + num_items
+                self.queries[model_name] = self.queries.get(model_name, 0) + num_queries
+
+    ## Write everything out as Scrapy stats.
+    # Totals are set rather than incremented, so this can be called repeatedly.
+    def publish(self, stats, spider):
+        with self.lock:
+            for (model_name, stage), (count, seconds) in self.timings.iteritems():
+                stats.set_value('django_item/time/%s/%s'%(model_name, stage), round(seconds, 3), spider=spider)
+                stats.set_value('django_item/time/%s/%s_count'%(model_name, stage), count, spider=spider)
+            for model_name, count in self.items.iteritems():
+                stats.set_value('django_item/items/%s'%model_name, count, spider=spider)
+                if self.count_queries and count:
+                    queries = self.queries.get(model_name, 0)
+                    stats.set_value('django_item/queries/%s'%model_name, queries, spider=spider)
+                    stats.set_value('django_item/queries_per_item/%s'%model_name,
+                                    round(float(queries)/count, 2), spider=spider)
+            for (model_name, reason), count in self.drops.iteritems():
+                stats.set_value('django_item/dropped/%s/%s'%(model_name, reason), count, spider=spider)
+
+    ## One line per model summarising everything so far.
+    def summary(self):
+        with self.lock:
+            names = set(self.items.keys())
+            names.update([k[0] for k in self.timings.iterkeys()])
+            names.update([k[0] for k in self.drops.iterkeys()])
+            lines = []
+            for model_name in sorted(names):
+                count = self.items.get(model_name, 0)
+                parts = ['%s: %d items'%(model_name, count)]
+                if self.count_queries and count:
+                    parts.append('%.1f queries/item'%(float(self.queries.get(model_name, 0))/count))
+                for stage in STAGES:
+                    timing = self.timings.get((model_name, stage))
+                    if timing is not None:
+                        parts.append('%s %.1fms'%(stage, timing[1]*1000.0/timing[0]))
+                drops = sorted([(r, c) for (m, r), c in self.drops.iteritems() if m == model_name])
+                if drops:
+                    parts.append('dropped %d (%s)'%(sum([c for r, c in drops]),
+                                                    ', '.join(['%s: %d'%d for d in drops])))
+                lines.append(', '.join(parts))
+        return lines
@@ -1,31 +1,432 @@
-import os
-from twisted.internet.defer import Deferred, DeferredList
-from scrapy.utils.misc import arg_to_iter
+import os, time, hashlib, threading
+from datetime import datetime
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, DeferredList, DeferredSemaphore, maybeDeferred, succeed
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.failure import Failure
+from twisted.python.threadable import isInIOThread
+from twisted.python.threadpool import ThreadPool
+from scrapy.utils.misc import arg_to_iter, load_object
 from scrapy import log
-from scrapy.exceptions import DropItem
+from scrapy.exceptions import DropItem, NotConfigured
 from scrapy.conf import settings
+from scrapy.stats import stats
 from scrapy.contrib.pipeline.images import ImagesPipeline
 from django.db.models import OneToOneField, ForeignKey, FileField, ImageField
 from django.db.models import Model as DjangoModel
 from django.db.models.fields.related import RelatedField, ManyToManyField
 from django.core.files import File
+from django.db import DatabaseError, close_connection, transaction
 
 import items
+from scrape.models import ScrapeSource, ScrapeCoverage
+from stores import SqliteStore
+from geocoding import AddressCache
+from cache import IdentityCache
+from files import FILE_MODES, file_hash
+from metrics import PipelineMetrics, record_time
 
 
+_unresolved = object()
+
+
+## Run a function inside a DB worker thread.
+# Django keeps one connection per thread, so each worker has its own. If the
+# connection breaks we close it, and Django will reconnect on the next query.
+def run_in_connection(f, *args, **kwargs):
+    try:
+        return f(*args, **kwargs)
+    except DatabaseError:
+        close_connection()
+        raise
+
+
+## Does a row still exist?
+# Rows of models with "scrape_schedule" set have their scrape time bumped in the
+# same query, as they've just been scraped.
+def touch_row(model, pk):
+    qs = model._default_manager.filter(pk=pk)
+    if getattr(model, '_scrape_schedule', False):
+        return qs.update(scrape_time=datetime.now()) > 0
+    return qs.exists()
+
+
+## Thread pool for database writes.
+# Django opens a connection for each thread that uses it, so each worker closes
+# its own on the way out, when the pool is stopped.
+class DBThreadPool(ThreadPool):
+
+    def _worker(self):
+        try:
+            ThreadPool._worker(self)
+        finally:
+            close_connection()
+
+
+## An item ID that other items are waiting on.
+# Keeps count of the waiting items for each model, so we can report on what was
+# lost if the ID never turns up.
+class PendingDependency(object):
+
+    def __init__(self, id):
+        self.id = id
+        self.deferred = Deferred()
+        self.waiting = {}
+        self.timer = None
+        self.timed_out = False
+
+    def add_waiting(self, model_name):
+        self.waiting[model_name] = self.waiting.get(model_name, 0) + 1
+
+    def cancel(self):
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+
+
+## Saves DjangoItems to the database.
+# Items are saved one at a time by default. Setting DJANGO_ITEM_BATCH_SIZE buffers
+# items per model and saves them in bulk once the buffer fills, or every
+# DJANGO_ITEM_BATCH_TIMEOUT seconds, whichever comes first.
+#
+# Database writes happen on the reactor thread unless DJANGO_ITEM_DB_THREADS is
+# set, in which case they're handed to a pool of that many threads with at most
+# DJANGO_ITEM_DB_MAX_IN_FLIGHT writes queued or running at once. Either way,
+# the object map and its deferreds are only ever touched from the reactor thread.
+#
+# Saved items are remembered by mapping their IDs to primary keys in a store, see
+# "stores.py". DJANGO_ITEM_ID_STORE picks the store class, which defaults to
+# keeping everything in memory. To shard a crawl over several processes give them
+# all a SharedSqliteStore and the same DJANGO_ITEM_CRAWL_ID; items then resolve
+# IDs saved by any of them, waking up as the store is polled.
+#
+# Items referring to IDs that haven't been saved wait for them. Setting
+# DJANGO_ITEM_DEPENDENCY_TIMEOUT limits how many seconds they wait, after which
+# DJANGO_ITEM_DEPENDENCY_TIMEOUT_ACTION decides their fate: "drop" them (the
+# default) or "null" to save them without the missing relations. Unresolved IDs
+# are reported when the spider closes.
+#
+# Setting DJANGO_ITEM_FINGERPRINTS to a file path keeps a fingerprint of every
+# saved item with an ID there. Re-scraped items with an unchanged fingerprint
+# aren't saved again, their existing primary key is used instead, once a lookup
+# has confirmed the row is still there. Remove the file to force everything to be
+# saved.
+#
+# Items that change nothing aren't written. Those that do save their object, unless
+# DJANGO_ITEM_PARTIAL_UPDATES is set, in which case only the changed columns are
+# written with an UPDATE. That skips the model's "save" and its pre_save and
+# post_save signals, so leave it off if anything, such as a search index, relies
+# on them.
+#
+# Setting DJANGO_ITEM_IDENTITY_CACHE_SIZE keeps up to that many objects per
+# model, keyed by the unique filter used to find them, so popular parent rows
+# are found without a query. DJANGO_ITEM_IDENTITY_CACHE picks the cache class.
+# Cached objects don't see changes made outside the crawl, such as fields being
+# validated in the admin, so leave this off if that happens mid-crawl.
+#
+# Time spent in each stage of saving, items saved and items dropped, and why, are
+# recorded per model and published as "django_item/..." stats, see "metrics.py".
+# A summary is logged every DJANGO_ITEM_METRICS_INTERVAL seconds (default 60, 0 to
+# only log when the spider closes). Setting DJANGO_ITEM_COUNT_QUERIES also counts
+# queries per item, at a small cost. DJANGO_ITEM_METRICS = False turns it all off.
+#
+# Setting DJANGO_ITEM_TRANSACTION_SIZE groups saves into transactions, committed
+# once that many items have been saved or every DJANGO_ITEM_TRANSACTION_TIMEOUT
+# seconds (default 1.0). Each save runs in a savepoint, so a failing item only
+# rolls back itself; on databases without savepoints, such as SQLite, whatever
+# it wrote before failing is kept. Items are only recorded as saved, waking those
+# waiting on them, once their transaction commits. All saves have to share one
+# connection, so this can't be used with more than one DB thread.
+#
+# With no DB threads that connection is the reactor thread's, and it stays inside
+# the open transaction between commits. Any other queries made on the reactor
+# thread, by spiders or StaleRequestsMixin for example, run in that transaction
+# too, and anything they write is only committed, or rolled back, along with it.
+# Set DJANGO_ITEM_DB_THREADS to 1 to keep saves on a connection of their own.
+#
+# New objects of models with "scrape_coverage" are counted as they're created, and
+# the counts written once per model when their transaction commits, or after each
+# save without transactions, instead of once per object.
+#
+# DJANGO_ITEM_FILE_MODE decides how downloaded files get into file fields: "copy"
+# (the default), "link", "move" or "reference". See "files.py".
 class DjangoItemPipeline(object):
 
     def __init__(self):
         self.spider_objs = {}
+        self.spider_pending = {}
+        self.spider_batches = {}
+        self.spider_timers = {}
+        self.spider_metric_timers = {}
+        self.spider_uncommitted = {}
+        self.spider_commit_timers = {}
+        self.spider_poll_timers = {}
+        self.batch_size = settings.getint('DJANGO_ITEM_BATCH_SIZE', 0)
+        self.batch_timeout = settings.getfloat('DJANGO_ITEM_BATCH_TIMEOUT', 1.0)
+        self.store_cls = load_object(settings.get('DJANGO_ITEM_ID_STORE',
+                                                  'scrape.scrapy.stores.MemoryStore'))
+        self.poll_interval = settings.getfloat('DJANGO_ITEM_ID_STORE_POLL_INTERVAL', 0.5)
+        self.dependency_timeout = settings.getfloat('DJANGO_ITEM_DEPENDENCY_TIMEOUT', 0)
+        self.dependency_action = settings.get('DJANGO_ITEM_DEPENDENCY_TIMEOUT_ACTION', 'drop')
+        if self.dependency_action not in ('drop', 'null'):
+            raise NotConfigured('Unknown DJANGO_ITEM_DEPENDENCY_TIMEOUT_ACTION: %s'%self.dependency_action)
+
+        self.file_mode = settings.get('DJANGO_ITEM_FILE_MODE', 'copy')
+        if self.file_mode not in FILE_MODES:
+            raise NotConfigured('Unknown DJANGO_ITEM_FILE_MODE: %s'%self.file_mode)
+
+        # Setup the identity caches, which are created per model as needed.
+        self.partial_updates = settings.getbool('DJANGO_ITEM_PARTIAL_UPDATES', False)
+        self.identity_cache_size = settings.getint('DJANGO_ITEM_IDENTITY_CACHE_SIZE', 0)
+        self.identity_cache_cls = load_object(settings.get('DJANGO_ITEM_IDENTITY_CACHE',
+                                                           'scrape.scrapy.cache.LRUCache'))
+        self.identity_caches = {}
+        self.identity_lock = threading.Lock()
+
+        # New objects are counted towards their model's coverage here, and the counts
+        # written once per transaction, or after each save without transactions.
+        self.coverage = {}
+        self.coverage_lock = threading.Lock()
+
+        # Addresses are resolved through a shared cache, see "geocoding.py".
+        self.address_cache = AddressCache.from_settings(settings)
+
+        # Open the fingerprint store, which persists between crawls.
+        self.fingerprints = None
+        path = settings.get('DJANGO_ITEM_FINGERPRINTS')
+        if path:
+            self.fingerprints = SqliteStore(path)
+
+        # Setup instrumentation.
+        self.metrics = None
+        if settings.getbool('DJANGO_ITEM_METRICS', True):
+            self.metrics = PipelineMetrics(settings.getbool('DJANGO_ITEM_COUNT_QUERIES', False))
+        self.metrics_interval = settings.getfloat('DJANGO_ITEM_METRICS_INTERVAL', 60)
+
+        # Setup the DB worker pool.
+        self.db_pool = None
+        db_threads = settings.getint('DJANGO_ITEM_DB_THREADS', 0)
+        if db_threads:
+            self.db_pool = DBThreadPool(db_threads, db_threads, 'DjangoItemPipeline')
+            max_in_flight = settings.getint('DJANGO_ITEM_DB_MAX_IN_FLIGHT', 0) or db_threads
+            self.db_semaphore = DeferredSemaphore(max_in_flight)
+
+        # Setup transactions. The open flag is only touched by the thread doing the
+        # saving.
+        self.transaction_size = settings.getint('DJANGO_ITEM_TRANSACTION_SIZE', 0)
+        self.transaction_timeout = settings.getfloat('DJANGO_ITEM_TRANSACTION_TIMEOUT', 1.0)
+        self.transaction_open = False
+        if self.transaction_size and db_threads > 1:
+            raise NotConfigured('DJANGO_ITEM_TRANSACTION_SIZE needs DJANGO_ITEM_DB_THREADS of at most 1.')
+        self.address_cache.wait_for_commit = bool(self.transaction_size)
 
     def open_spider(self, spider):
-        self.spider_objs[spider] = {}
+        if self.db_pool is not None and not self.db_pool.started:
+            self.db_pool.start()
+        self.address_cache.open()
+        self.spider_objs[spider] = store = self.store_cls.from_settings(settings, spider)
+        self.spider_pending[spider] = {}
+        self.spider_batches[spider] = {}
+        if hasattr(store, 'poll'):
+            timer = LoopingCall(self.poll_store, spider)
+            timer.start(self.poll_interval, now=False)
+            self.spider_poll_timers[spider] = timer
+
+        # The timer also guarantees progress for items waiting on related objects that
+        # are sitting in a partially filled batch.
+        if self.batch_size:
+            timer = LoopingCall(self.flush_batches, spider)
+            timer.start(self.batch_timeout, now=False)
+            self.spider_timers[spider] = timer
+        if self.metrics is not None and self.metrics_interval:
+            timer = LoopingCall(self.log_metrics, spider)
+            timer.start(self.metrics_interval, now=False)
+            self.spider_metric_timers[spider] = timer
+        if self.transaction_size:
+            self.spider_uncommitted[spider] = []
+            timer = LoopingCall(self.commit, spider)
+            timer.start(self.transaction_timeout, now=False)
+            self.spider_commit_timers[spider] = timer
 
     def close_spider(self, spider):
-        del self.spider_objs[spider]
+        for timers in (self.spider_timers, self.spider_metric_timers, self.spider_commit_timers,
+                       self.spider_poll_timers):
+            timer = timers.pop(spider, None)
+            if timer is not None:
+                timer.stop()
+        dfd = self.drain_batches(spider)
+        if self.transaction_size:
+            dfd.addCallback(lambda _: self.commit(spider))
+        return dfd.addBoth(self._spider_closed, spider)
+
+    def _spider_closed(self, result, spider):
+        self.report_unresolved(spider)
+        if self.metrics is not None:
+            self.log_metrics(spider)
+        for model, cache in self.identity_caches.items():
+            stats.set_value('django_item/identity_cache/%s/hits'%model.__name__, cache.hits, spider=spider)
+            stats.set_value('django_item/identity_cache/%s/misses'%model.__name__, cache.misses, spider=spider)
+        del self.spider_batches[spider]
+        del self.spider_pending[spider]
+        self.spider_uncommitted.pop(spider, None)
+        self.spider_objs.pop(spider).close()
+        if self.db_pool is not None and not self.spider_objs:
+            self.db_pool.stop()
+        if self.fingerprints is not None:
+            self.fingerprints.commit()
+        if not self.spider_objs:
+            self.address_cache.close()
+        else:
+            self.address_cache.commit()
+        return result
+
+    ## Get the identity cache for a model.
+    # Returns None if identity caching is turned off. May be called from DB worker
+    # threads.
+    def get_identity_cache(self, model):
+        if not self.identity_cache_size:
+            return None
+        with self.identity_lock:
+            cache = self.identity_caches.get(model)
+            if cache is None:
+                cache = IdentityCache(self.identity_cache_cls(self.identity_cache_size))
+                self.identity_caches[model] = cache
+        return cache
+
+    ## Run a blocking database function.
+    # Returns a deferred firing with the function's result, which will be run in the
+    # DB worker pool if we have one.
+    def defer_db(self, f, *args, **kwargs):
+        if self.db_pool is None:
+            return maybeDeferred(f, *args, **kwargs)
+        return self.db_semaphore.run(deferToThreadPool, reactor, self.db_pool,
+                                     run_in_connection, f, *args, **kwargs)
+
+    ## Throw away cached objects.
+    # Called when a transaction or savepoint is rolled back, as cached objects may
+    # refer to rows that no longer exist. May be called from DB worker threads.
+    def rolled_back(self):
+        with self.identity_lock:
+            caches = self.identity_caches.values()
+        for cache in caches:
+            cache.clear()
+        self.address_cache.clear()
+        ScrapeSource.clear_cache()
+
+    ## Run a blocking function saving items of a model, measuring it.
+    def defer_save(self, model, num_items, f, *args, **kwargs):
+        if self.transaction_size:
+            f, args = self.save_in_transaction, (f,) + args
+        else:
+            f, args = self.save_and_count, (f,) + args
+        if self.metrics is None:
+            return self.defer_db(f, *args, **kwargs)
+        return self.defer_db(self.metrics.measure, model.__name__, num_items, f, *args, **kwargs)
+
+    ## Collect new objects for the coverage counts.
+    # May be called from DB worker threads.
+    def add_coverage(self, model, num):
+        with self.coverage_lock:
+            self.coverage[model] = self.coverage.get(model, 0) + num
+
+    ## Write the collected coverage counts, one UPDATE per model.
+    # Runs wherever the saving happens.
+    def flush_coverage(self):
+        with self.coverage_lock:
+            coverage, self.coverage = self.coverage, {}
+        for model, num in coverage.iteritems():
+            ScrapeCoverage.add(model, total=num, not_valid=num)
+
+    ## Run a save outside of a transaction, then write its coverage counts.
+    def save_and_count(self, f, *args, **kwargs):
+        try:
+            return f(*args, **kwargs)
+        finally:
+            self.flush_coverage()
+
+    ## Run a save in the current transaction, starting one if needed.
+    # Runs wherever the saving happens. The save gets its own savepoint.
+    def save_in_transaction(self, f, *args, **kwargs):
+        if not self.transaction_open:
+            transaction.enter_transaction_management()
+            transaction.managed(True)
+            self.transaction_open = True
+        sid = transaction.savepoint()
+        with self.coverage_lock:
+            coverage = self.coverage.copy()
+        try:
+            result = f(*args, **kwargs)
+        except:
+            transaction.savepoint_rollback(sid)
+            # Objects it created are gone again, so are their counts.
+            with self.coverage_lock:
+                self.coverage = coverage
+            self.rolled_back()
+            raise
+        transaction.savepoint_commit(sid)
+        return result
+
+    ## Commit the current transaction, if there is one.
+    # Runs wherever the saving happens. If the commit fails everything in the
+    # transaction is rolled back.
+    def commit_transaction(self):
+        if not self.transaction_open:
+            return
+        self.transaction_open = False
+        try:
+            self.flush_coverage()
+            transaction.commit()
+        except:
+            transaction.rollback()
+            self.rolled_back()
+            raise
+        finally:
+            transaction.leave_transaction_management()
+        self.address_cache.commit()
+
+    ## Commit the items saved so far.
+    # Items saved while the commit is on its way are left for the next one.
+    def commit(self, spider):
+        uncommitted = self.spider_uncommitted[spider]
+        self.spider_uncommitted[spider] = []
+        dfd = self.defer_db(self.commit_transaction)
+        return dfd.addCallbacks(self._committed, self._commit_failed,
+                                callbackArgs=(uncommitted, spider), errbackArgs=(uncommitted, spider))
+
+    def _committed(self, result, uncommitted, spider):
+        for item, obj, dfd in uncommitted:
+            self.item_stored(spider, item, obj)
+            dfd.callback(item)
+
+    def _commit_failed(self, failure, uncommitted, spider):
+        log.msg('Commit failed, %d item(s) lost: %s'%(len(uncommitted), failure.getErrorMessage()),
+                level=log.ERROR, spider=spider)
+        for item, obj, dfd in uncommitted:
+            if self.metrics is not None:
+                self.metrics.add_drop(item.django_model.__name__, 'commit')
+            self.forget_item(spider, item.get('id'))
+            dfd.errback(failure)
+
+    ## Hold a saved item back until its transaction commits.
+    # Returns a deferred that fires with the item once it has.
+    def add_uncommitted(self, spider, item, obj):
+        dfd = Deferred()
+        uncommitted = self.spider_uncommitted[spider]
+        uncommitted.append((item, obj, dfd))
+        if len(uncommitted) >= self.transaction_size:
+            self.commit(spider)
+        return dfd
+
+    ## Publish metrics as stats and log a summary.
+    def log_metrics(self, spider):
+        self.metrics.publish(stats, spider)
+        for line in self.metrics.summary():
+            log.msg('DjangoItemPipeline: %s'%line, spider=spider)
 
     def process_item(self, item, spider):
         obj_map = self.spider_objs[spider]
+        pending = self.spider_pending[spider]
         rel_fields = item._model_rel_fields
 
         # If there are no related fields to resolve just save and return.
@@ -34,7 +435,7 @@ class DjangoItemPipeline(object):
 
         # Build a list of outstanding requests.
         req_ids = sum([arg_to_iter(item.get(f.name, [])) for f in rel_fields], [])
-        req_ids = [u for u in req_ids if (u not in obj_map or isinstance(obj_map[u], Deferred))]
+        req_ids = [u for u in req_ids if (u in pending or u not in obj_map)]
 
         # If there are no requests to perform, fill, save and return.
         if not req_ids:
@@ -42,102 +443,335 @@ class DjangoItemPipeline(object):
 
         # Defer?
         dlist = []
+        model_name = item.django_model.__name__
         for id in req_ids:
-            if id not in obj_map:
-                obj_map[id] = Deferred()
-            dfd = obj_map[id]
-            assert dfd is not None
-            dlist.append(dfd)
-        return DeferredList(dlist, consumeErrors=1).addCallback(self.save_item, item, spider)
-
-    def drop_item(self, spider, id, msg):
-        if id is not None:
-            dfd = self.spider_objs[spider].get(id)
-            self.spider_objs[spider][id] = None
-            if isinstance(dfd, Deferred):
-                dfd.callback(None)
+            dep = pending.get(id)
+            if dep is None:
+                dep = pending[id] = PendingDependency(id)
+                if self.dependency_timeout:
+                    dep.timer = reactor.callLater(self.dependency_timeout, self.dependency_timed_out,
+                                                  spider, id)
+            dep.add_waiting(model_name)
+            dlist.append(dep.deferred)
+        dfd = DeferredList(dlist, consumeErrors=1)
+        if self.metrics is not None:
+            dfd.addCallback(self._dependencies_resolved, model_name, time.time())
+        return dfd.addCallback(self.save_item, item, spider)
+
+    def _dependencies_resolved(self, result, model_name, started):
+        record_time(self.metrics, model_name, 'wait', started)
+        return result
+
+    ## Drop an item.
+    # Can be called from DB worker threads, in which case the item is forgotten
+    # when its failure arrives back on the reactor thread. The drop is counted
+    # against the model under "reason".
+    def drop_item(self, spider, id, msg, reason='other', model_name=None):
+        if self.metrics is not None:
+            self.metrics.add_drop(model_name or 'unknown', reason)
+        if isInIOThread():
+            self.forget_item(spider, id)
         raise DropItem(msg)
 
+    ## Mark an item ID as never going to be saved.
+    # Anything waiting on it gets woken up to discover that.
+    def forget_item(self, spider, id):
+        self.store_pk(spider, id, None)
+
+    ## Store the resultant django object and call the deferred object.
+    def store_object(self, spider, id, obj):
+        self.store_pk(spider, id, obj.pk)
+
+    ## Record a saved item.
+    def item_stored(self, spider, item, obj):
+        self.store_object(spider, item.get('id'), obj)
+        if item._fingerprint is not None:
+            self.fingerprints.set(item.get_fingerprint_key(), (item._fingerprint, obj.pk))
+
+    def store_pk(self, spider, id, pk):
+        if id is not None:
+            self.spider_objs[spider].set(id, pk)
+            dep = self.spider_pending[spider].pop(id, None)
+            if dep is not None:
+                dep.cancel()
+                dep.deferred.callback(None)
+
+    ## Wake items waiting on IDs another process has stored.
+    def poll_store(self, spider):
+        pending = self.spider_pending[spider]
+        for id in self.spider_objs[spider].poll():
+            dep = pending.pop(id, None)
+            if dep is not None:
+                dep.cancel()
+                dep.deferred.callback(None)
+
+    ## Give up waiting on an ID.
+    # The waiting items are woken up and, finding nothing stored for the ID, will be
+    # either dropped or saved without it.
+    def dependency_timed_out(self, spider, id):
+        dep = self.spider_pending[spider].pop(id, None)
+        if dep is None:
+            return
+        dep.timer = None
+        dep.timed_out = True
+        self.record_unresolved(spider, dep)
+        log.msg('Gave up waiting for "%s" after %ss, %s waiting item(s) will be %s.'%(
+            id, self.dependency_timeout, sum(dep.waiting.values()),
+            'dropped' if self.dependency_action == 'drop' else 'saved without it'
+        ), level=log.WARNING, spider=spider)
+        dep.deferred.callback(None)
+
+    def record_unresolved(self, spider, dep):
+        stats.inc_value('django_item/unresolved_ids', spider=spider)
+        for model_name, count in dep.waiting.iteritems():
+            stats.inc_value('django_item/unresolved_items/%s'%model_name, count, spider=spider)
+
+    ## Report on IDs that were never resolved.
+    # Covers both those that timed out and those still pending now.
+    def report_unresolved(self, spider):
+        pending = self.spider_pending[spider]
+        for dep in pending.itervalues():
+            dep.cancel()
+            self.record_unresolved(spider, dep)
+            log.msg('Never resolved "%s", waiting items: %s'%(dep.id, ', '.join(
+                ['%s: %s'%c for c in sorted(dep.waiting.iteritems())]
+            )), level=log.WARNING, spider=spider)
+        num_ids = stats.get_value('django_item/unresolved_ids', 0, spider=spider)
+        if num_ids:
+            prefix = 'django_item/unresolved_items/'
+            counts = [(k[len(prefix):], v) for k, v in stats.get_stats(spider).iteritems()
+                      if k.startswith(prefix)]
+            log.msg('%s ID(s) were never resolved, waiting items: %s'%(num_ids, ', '.join(
+                ['%s: %s'%c for c in sorted(counts)]
+            )), level=log.WARNING, spider=spider)
+
+    ## Add an item to its model's batch.
+    # Returns a deferred that fires with the item once its batch has been saved.
+    def batch_item(self, item, spider):
+        batch = self.spider_batches[spider].setdefault(item.django_model, [])
+        dfd = Deferred()
+        batch.append((item, dfd))
+        if len(batch) >= self.batch_size:
+            self.flush_batch(spider, item.django_model)
+        return dfd
+
+    def flush_batches(self, spider):
+        batches = self.spider_batches[spider]
+        return DeferredList([self.flush_batch(spider, m) for m in batches.keys()])
+
+    ## Flush every batch for a spider.
+    # Flushing can wake items waiting on related objects, which may in turn
+    # start new batches, so keep going until nothing is left.
+    def drain_batches(self, spider):
+        if not self.spider_batches[spider]:
+            return succeed(None)
+        return self.flush_batches(spider).addCallback(lambda _: self.drain_batches(spider))
+
+    def flush_batch(self, spider, model):
+        batch = self.spider_batches[spider].pop(model, None)
+        if not batch:
+            return succeed(None)
+        items = [i for i, d in batch]
+        dfd = self.defer_save(model, len(items), type(items[0]).save_batch, items, self, spider)
+        return dfd.addCallbacks(self._batch_saved, self._batch_failed,
+                                callbackArgs=(batch, spider), errbackArgs=(batch, spider))
+
+    def _batch_failed(self, failure, batch, spider):
+        self._batch_saved([failure]*len(batch), batch, spider)
+
+    def _batch_saved(self, results, batch, spider):
+        for (item, dfd), result in zip(batch, results):
+            if isinstance(result, Failure):
+                if self.metrics is not None and not result.check(DropItem):
+                    self.metrics.add_drop(item.django_model.__name__, 'error')
+                self.forget_item(spider, item.get('id'))
+                dfd.errback(result)
+            elif self.transaction_size:
+                self.add_uncommitted(spider, item, result).chainDeferred(dfd)
+            else:
+                self.item_stored(spider, item, result)
+                dfd.callback(item)
+
     def save_item(self, result, item, spider):
         obj_map = self.spider_objs[spider]
         # for k,v in obj_map.iteritems():
         #     if isinstance(v, Deferred):
         #         print '***: ' + repr(k)
         item_id = item.get('id')
+        model_name = item.django_model.__name__
+        started = time.time()
 
         # Map the item's values.
-        for field in item._model_fields:
-            name = field.name
+        for plan in item._save_plan:
+            name = plan.name
 
             # Process related fields.
-            if field in item._model_rel_fields:
+            if plan.is_related:
 
-                # Map the related IDs to objects.
+                # Map the related IDs to primary keys. We don't need the objects
+                # themselves, Django will load them if anyone asks.
                 ids = item.get(name, [])
-                objs = []
+                pks = []
                 for id in arg_to_iter(ids):
-                    obj = obj_map[id]
+                    pk = obj_map.get(id, _unresolved)
+
+                    # We gave up waiting on this one.
+                    if pk is _unresolved:
+                        if self.dependency_action == 'null':
+                            continue
+                        self.drop_item(
+                            spider, item_id,
+                            '%s.%s has an unresolved related object "%s" for "%s".'%(
+                                model_name, name, id, item['scrape_url']
+                            ),
+                            reason='unresolved', model_name=model_name
+                        )
 
                     # Check that this is a valid object.
-                    if not isinstance(obj, DjangoModel):
+                    if pk is None:
                         self.drop_item(
                             spider, item_id, 
                             '%s.%s had an invalid related object for "%s".'%(
-                                item.django_model.__name__, name, item['scrape_url']
-                            )
+                                model_name, name, item['scrape_url']
+                            ),
+                            reason='invalid_related', model_name=model_name
                         )
 
                     # Add to the set of objects.
-                    objs.append(obj)
+                    pks.append(pk)
 
                 # Coerce to fit the type of field.
-                if len(objs) == 1 and field not in item._model_m2m_fields:
-                    item[name] = objs[0]
-                elif objs:
-                    item[name] = objs
+                if len(pks) == 1 and not plan.is_m2m:
+                    item[name] = pks[0]
+                elif pks:
+                    item[name] = pks
+                elif ids:
+                    item[name] = None
 
             # Process file fields.
-            elif field in item._model_file_fields or field in item._model_img_fields:
+            elif plan.is_file:
                 file_field = item.get(item.get(name), None)
                 if file_field:
                     file_info = file_field[0]
                     path = os.path.join(settings['IMAGES_STORE'], file_info['path'])
-                    filename = os.path.basename(path)
                     item[name] = path
+                    item._file_mode = self.file_mode
+                    if plan.hash_name is not None:
+                        item[plan.hash_name] = file_info.get('checksum') or file_hash(path)
                 else:
                     item[name] = None
 
             # Check for missing/empty values.
             if item.get(name) in [None, '', []]:
-                if field.blank == False:
+                if plan.required:
                     self.drop_item(
                         spider, item_id,
                         '%s.%s cannot be null for "%s".'%(
-                            item.django_model.__name__, name, item['scrape_url'])
+                            model_name, name, item['scrape_url']),
+                        reason='required', model_name=model_name
                     )
+        record_time(self.metrics, model_name, 'map', started)
 
-        # Store the results.
-        obj = item.save(self, spider)
+        # Skip items we've already saved exactly as they are now, as long as what we
+        # saved them to is still there.
+        if self.fingerprints is not None:
+            key = item.get_fingerprint_key()
+            if key is not None:
+                item._fingerprint = item.get_fingerprint()
+                known = self.fingerprints.get(key)
+                if known is not None and known[0] == item._fingerprint:
+                    dfd = self.defer_db(touch_row, item.django_model, known[1])
+                    return dfd.addCallbacks(self._fingerprint_checked, self._item_failed,
+                                            callbackArgs=(item, known[1], spider),
+                                            errbackArgs=(item, spider))
+        return self.store_item(item, spider)
 
-        # Store the resultant django object and call the deferred object.
-        if item_id is not None:
-            dfd = obj_map.get(item_id)
-            if isinstance(dfd, Deferred):
-                obj_map[item_id] = obj
-                dfd.callback(None)
-            else:
-                obj_map[item_id] = obj
+    def _fingerprint_checked(self, exists, item, pk, spider):
+        if not exists:
+            stats.inc_value('django_item/fingerprint_missing', spider=spider)
+            return self.store_item(item, spider)
+        stats.inc_value('django_item/unchanged', spider=spider)
+        self.store_pk(spider, item.get('id'), pk)
+        return item
+
+    ## Store the results, either now or when the batch is flushed.
+    def store_item(self, item, spider):
+        if self.batch_size:
+            return self.batch_item(item, spider)
+        dfd = self.defer_save(item.django_model, 1, item.save, self, spider)
+        return dfd.addCallbacks(self._item_saved, self._item_failed,
+                                callbackArgs=(item, spider), errbackArgs=(item, spider))
+
+    def _item_saved(self, obj, item, spider):
+        if self.transaction_size:
+            return self.add_uncommitted(spider, item, obj)
+        self.item_stored(spider, item, obj)
 
         # Need to return the item, as this is what gets eventually handed on to the next link
         # in the item pipeline.
         return item
 
+    def _item_failed(self, failure, item, spider):
+        if self.metrics is not None and not failure.check(DropItem):
+            self.metrics.add_drop(item.django_model.__name__, 'error')
+        self.forget_item(spider, item.get('id'))
+        return failure
 
+
+## Images pipeline that also dedupes downloads by content.
+# If DJANGO_ITEM_IMAGE_INDEX is set to a file path, the checksum of every
+# downloaded image is kept there along with the first path it was stored at.
+# Later downloads with the same checksum are replaced by hard links to that
+# first file, and the item is given its path, so each image is only stored once
+# however many URLs it came from. Only the full size images are deduped.
 class FixedImagesPipeline(ImagesPipeline):
 
+    def __init__(self, *args, **kwargs):
+        super(FixedImagesPipeline, self).__init__(*args, **kwargs)
+        self.image_index = None
+        path = settings.get('DJANGO_ITEM_IMAGE_INDEX')
+        if path and hasattr(self.store, 'basedir'):
+            self.image_index = SqliteStore(path)
+
+    def close_spider(self, spider):
+        if self.image_index is not None:
+            self.image_index.commit()
+        parent = super(FixedImagesPipeline, self)
+        if hasattr(parent, 'close_spider'):
+            return parent.close_spider(spider)
+
+    ## Swap a downloaded image for an identical one we already have.
+    def dedupe_image(self, image):
+        checksum = image.get('checksum')
+        if not checksum:
+            return image
+        known = self.image_index.get(checksum)
+        if known is None:
+            self.image_index.set(checksum, image['path'])
+            return image
+        if known == image['path']:
+            return image
+        known_path = os.path.join(self.store.basedir, known)
+        if not os.path.exists(known_path):
+            self.image_index.set(checksum, image['path'])
+            return image
+
+        # Keep the downloaded path around, as a link, so the download isn't
+        # considered missing next crawl.
+        path = os.path.join(self.store.basedir, image['path'])
+        try:
+            if not os.path.samefile(path, known_path):
+                os.link(known_path, path + '.dedupe')
+                os.rename(path + '.dedupe', path)
+        except OSError:
+            pass
+        return dict(image, path=known)
+
     def item_completed(self, results, item, info):
         if 'images' in item.fields and 'image_urls' in item.fields:
             item['images'] = [x for ok, x in results if ok]
+            if self.image_index is not None:
+                item['images'] = [self.dedupe_image(x) for x in item['images']]
         elif results:
             raise DropItem('Confused, item has no "images" field, yet images were found.')
         return item
@@ -1,9 +1,128 @@
 from datetime import datetime
 import dateutil.parser, re
+from collections import deque
 from scrapy.contrib.loader.processor import *
 from scrapy.utils.markup import remove_entities
 from scrapy.utils.misc import arg_to_iter
 from scrapy import log
+from cache import LRUCache
+
+
+## Marks a value that a processor has dropped.
+SKIP = object()
+
+
+## Remove entities from a string.
+# Most values have no entities at all, so we only bother with the regular
+# expression when there's an ampersand.
+def fast_remove_entities(value):
+    if isinstance(value, str):
+        value = value.decode('utf-8')
+    if u'&' not in value:
+        return value
+    return remove_entities(value)
+
+
+## Iterate over the output of any processor.
+# Processors with an "iter_values" method stream their values; anything else is
+# called on a list and its result iterated over.
+def iter_processed(processor, values):
+    if hasattr(processor, 'iter_values'):
+        return processor.iter_values(values)
+    return iter(arg_to_iter(processor(list(values))))
+
+
+## Base for processors that map each value independently.
+# Subclasses implement "process_value", returning the new value or SKIP. Chains
+# of these can be fused into a single pass with "Fused".
+class ValueProcessor(object):
+
+    def process_value(self, value):
+        raise NotImplementedError
+
+    def __call__(self, values):
+        process = self.process_value
+        out_values = []
+        for v in arg_to_iter(values):
+            v = process(v)
+            if v is not SKIP:
+                out_values.append(v)
+        return out_values
+
+    def iter_values(self, values):
+        process = self.process_value
+        for v in arg_to_iter(values):
+            v = process(v)
+            if v is not SKIP:
+                yield v
+
+
+## Fuse a chain of value processors into a single pass.
+# Each value goes through every processor in turn, without building a list
+# between each. Behaves like MapCompose over the same processors, so values
+# that come out as None are dropped too.
+class Fused(object):
+
+    def __init__(self, *processors):
+        for p in processors:
+            if not isinstance(p, ValueProcessor):
+                raise TypeError('Only value processors can be fused, not %r.'%p)
+        self.functions = tuple([p.process_value for p in processors])
+
+    def __call__(self, values):
+        functions = self.functions
+        out_values = []
+        for v in arg_to_iter(values):
+            for func in functions:
+                if v is None or v is SKIP:
+                    break
+                v = func(v)
+            else:
+                if v is not None and v is not SKIP:
+                    out_values.append(v)
+        return out_values
+
+    def iter_values(self, values):
+        functions = self.functions
+        for v in arg_to_iter(values):
+            for func in functions:
+                if v is None or v is SKIP:
+                    break
+                v = func(v)
+            else:
+                if v is not None and v is not SKIP:
+                    yield v
+
+
+## Chain processors as generators.
+# Values stream through every processor and the result is only built once, at
+# the end. If "limit" is given, processing stops once that many values other
+# than None or '' have come out, which is all TakeFirst will ever look at.
+class Lazy(object):
+
+    def __init__(self, *processors, **kwargs):
+        self.processors = processors
+        self.limit = kwargs.get('limit')
+
+    def __call__(self, values):
+        return list(self.iter_values(values))
+
+    def iter_values(self, values):
+        values = iter(arg_to_iter(values))
+        for proc in self.processors:
+            values = iter_processed(proc, values)
+        if self.limit is not None:
+            values = self._limit(values, self.limit)
+        return values
+
+    @staticmethod
+    def _limit(values, limit):
+        for v in values:
+            yield v
+            if v is not None and v != '':
+                limit -= 1
+                if limit <= 0:
+                    break
 
 
 class PassThrough(object):
@@ -11,35 +130,40 @@ class PassThrough(object):
     def __call__(self, values):
         return values
 
+    def iter_values(self, values):
+        return iter(arg_to_iter(values))
+
 
-class Prefix(object):
+class Prefix(ValueProcessor):
 
     def __init__(self, prefix=u''):
         self.prefix = prefix
 
-    def __call__(self, values):
-        return [self.prefix + v for v in arg_to_iter(values)]
+    def process_value(self, value):
+        return self.prefix + value
 
 
-class Strip(object):
+class Strip(ValueProcessor):
 
-    def __call__(self, values):
-        return [v.strip() for v in arg_to_iter(values)]
+    def process_value(self, value):
+        return value.strip()
 
 
-class RemoveEntities(object):
+class RemoveEntities(ValueProcessor):
 
-    def __call__(self, values):
-        return [remove_entities(v) for v in arg_to_iter(values)]
+    def process_value(self, value):
+        return fast_remove_entities(value)
 
 
-class Exclude(object):
+class Exclude(ValueProcessor):
 
     def __init__(self, *args):
         self.excludes = args
 
-    def __call__(self, values):
-        return [v for v in arg_to_iter(values) if v not in self.excludes]
+    def process_value(self, value):
+        if value in self.excludes:
+            return SKIP
+        return value
 
 
 class Split(object):
@@ -48,109 +172,183 @@ class Split(object):
         self.token = token
 
     def __call__(self, values):
-        return sum([v.split(self.token) for v in arg_to_iter(values)], [])
+        token = self.token
+        out_values = []
+        for v in arg_to_iter(values):
+            out_values.extend(v.split(token))
+        return out_values
 
+    def iter_values(self, values):
+        token = self.token
+        for v in arg_to_iter(values):
+            for part in v.split(token):
+                yield part
 
-class Float(object):
 
-    def __call__(self, values):
-        new_values = []
-        for v in arg_to_iter(values):
-            if isinstance(v, (str, unicode)):
-                v = remove_entities(v).strip()
-            new_values.append(float(v))
-        return new_values
+class Float(ValueProcessor):
 
+    def process_value(self, value):
+        if isinstance(value, (str, unicode)):
+            value = fast_remove_entities(value).strip()
+        return float(value)
 
-class Int(object):
 
-    def __call__(self, values):
-        new_values = []
-        for v in arg_to_iter(values):
-            if isinstance(v, (str, unicode)):
-                v = remove_entities(v).strip()
-            new_values.append(int(v))
-        return new_values
+class Int(ValueProcessor):
 
+    def process_value(self, value):
+        if isinstance(value, (str, unicode)):
+            value = fast_remove_entities(value).strip()
+        return int(value)
 
-class Bool(object):
 
-    def __call__(self, values):
-        new_values = []
-        for v in arg_to_iter(values):
-            if isinstance(v, (str, unicode)):
-                v = remove_entities(v).strip()
-                v = (v.lower() == 'true')
-            else:
-                v = bool(v)
-            new_values.append(v)
-        return new_values
+class Bool(ValueProcessor):
+
+    def process_value(self, value):
+        if isinstance(value, (str, unicode)):
+            value = fast_remove_entities(value).strip()
+            return (value.lower() == 'true')
+        else:
+            return bool(value)
 
 
-class Slice(object):
+class Slice(ValueProcessor):
 
     def __init__(self, begin, end=None):
         self.begin = begin
         self.end = end
 
-    def __call__(self, values):
-        return [v[self.begin:self.end] for v in arg_to_iter(values)]
-
+    def process_value(self, value):
+        return value[self.begin:self.end]
 
-class GenreMash(object):
 
-    def __call__(self, values):
-        out_values = []
-        values = arg_to_iter(values)
-        while values:
-            val = values.pop(0)
-            if values and val == 'R' and values[0] == 'B':
-                values.pop(0)
-                out_values.append('R&B')
-            elif val:
-                out_values.append(val)
-        return out_values
-
-
-class DateTime(object):
-
-    def __call__(self, values):
-        out_values = []
-        for v in arg_to_iter(values):
-            if isinstance(v, (str, unicode)):
-                try:
-                    out_values.append(dateutil.parser.parse(str(v), fuzzy=True))
-                except:
-                    log.msg('Failed to convert datetime string: "%s"'%v, level=log.WARNING)
-                    out_values.append(None)
-            elif isinstance(v, datetime):
-                out_values.append(v)
-            else:
-                out_values.append(datetime(v))
-        return out_values
+## Merge runs of adjacent tokens.
+# "merges" maps sequences of tokens to their replacements, for example
+# {('R', 'B'): 'R&B'}. Values are consumed in a single pass, holding back only
+# as many as the longest sequence, and the longest matching sequence wins. If
+# "drop_empty" is set, empty tokens that aren't part of a merge are dropped.
+class TokenMerge(object):
 
-
-class Date(object):
+    def __init__(self, merges, drop_empty=False):
+        self.drop_empty = drop_empty
+        self.longest = 1
+        self.starts = {}
+        for seq, replacement in merges.iteritems():
+            seq = tuple(seq)
+            self.longest = max(self.longest, len(seq))
+            self.starts.setdefault(seq[0], []).append((seq, replacement))
+        for candidates in self.starts.itervalues():
+            candidates.sort(key=lambda c: -len(c[0]))
 
     def __call__(self, values):
-        return [v.date() for v in DateTime()(values)]
-
+        return list(self.iter_values(values))
 
-class EverythingAfter(object):
+    def iter_values(self, values):
+        buf = deque()
+        for v in arg_to_iter(values):
+            buf.append(v)
+            if len(buf) >= self.longest:
+                value = self._next(buf)
+                if value is not SKIP:
+                    yield value
+        while buf:
+            value = self._next(buf)
+            if value is not SKIP:
+                yield value
+
+    ## Take the next output value from the front of the buffer.
+    def _next(self, buf):
+        for seq, replacement in self.starts.get(buf[0], ()):
+            if len(seq) <= len(buf) and all([buf[ii] == seq[ii] for ii in xrange(1, len(seq))]):
+                for ii in xrange(len(seq)):
+                    buf.popleft()
+                return replacement
+        value = buf.popleft()
+        if self.drop_empty and not value:
+            return SKIP
+        return value
+
+
+## Fix up genres that were split on "&".
+class GenreMash(TokenMerge):
+
+    def __init__(self, merges=None):
+        if merges is None:
+            merges = {('R', 'B'): 'R&B'}
+        super(GenreMash, self).__init__(merges, drop_empty=True)
+
+
+## Convert strings to datetimes.
+# Any explicit "strptime" formats are tried first, falling back to fuzzy parsing
+# with dateutil, which is slow. Sites tend to repeat the same strings, so results
+# are kept in an LRU cache of "cache_size" entries; "hits" and "misses" count how
+# well that's working.
+class DateTime(ValueProcessor):
+
+    def __init__(self, formats=(), cache_size=1024):
+        self.formats = tuple(formats)
+        self.cache = LRUCache(cache_size) if cache_size else None
+
+    @property
+    def hits(self):
+        return self.cache.hits if self.cache is not None else 0
+
+    @property
+    def misses(self):
+        return self.cache.misses if self.cache is not None else 0
+
+    def parse(self, text):
+        for fmt in self.formats:
+            try:
+                return datetime.strptime(text, fmt)
+            except ValueError:
+                pass
+        return dateutil.parser.parse(text, fuzzy=True)
+
+    def process_value(self, value):
+        if isinstance(value, (str, unicode)):
+            cache = self.cache
+            if cache is not None:
+                result = cache.get(value, SKIP)
+                if result is not SKIP:
+                    return result
+            try:
+                result = self.parse(str(value))
+            except:
+                log.msg('Failed to convert datetime string: "%s"'%value, level=log.WARNING)
+                result = None
+            if cache is not None:
+                cache.set(value, result)
+            return result
+        elif isinstance(value, datetime):
+            return value
+        else:
+            return datetime(value)
+
+
+class Date(ValueProcessor):
+
+    def __init__(self, formats=(), cache_size=1024):
+        self.datetime = DateTime(formats, cache_size)
+
+    def process_value(self, value):
+        value = self.datetime.process_value(value)
+        if value is not None:
+            value = value.date()
+        return value
+
+
+class EverythingAfter(ValueProcessor):
 
     def __init__(self, delim, max_length=None):
         self.delim = delim
         self.max_length = max_length
 
-    def __call__(self, values):
-        values = arg_to_iter(values)
-        out_values = []
-        for value in values:
-            idx = value.find(self.delim)
-            if idx != -1:
-                value = value[idx + len(self.delim):]
-                if value:
-                    if self.max_length and len(value) > self.max_length:
-                        value = value[:self.max_length]
-                    out_values.append(value)
-        return out_values
+    def process_value(self, value):
+        idx = value.find(self.delim)
+        if idx != -1:
+            value = value[idx + len(self.delim):]
+            if value:
+                if self.max_length and len(value) > self.max_length:
+                    value = value[:self.max_length]
+                return value
+        return SKIP
@@ -0,0 +1,124 @@
+import heapq, math, operator
+from datetime import datetime
+from django.db.models import Q
+from cache import LRUCache
+
+
+## Objects of a model with at least one field that isn't validated.
+def stale_queryset(model):
+    qs = model._default_manager.all()
+    if model._scrape_metadata == 'packed':
+        full = (1 << len(model._scrape_valid_fields)) - 1
+        return qs.exclude(scrape_valid=full)
+    return qs.filter(reduce(operator.or_, [Q(**{n: False}) for n in model._scrape_valid_fields]))
+
+
+## One model's objects that aren't fully validated, stalest first.
+# Objects are ordered by when they were last scraped, which needs "scrape_schedule"
+# set on the model. Those never scraped come first; they have no "scrape_url"
+# either, so the source of any of their fields is used instead. Rows are read in
+# chunks of "chunk_size" using keyset pagination, so each chunk is a single indexed
+# range scan. Yields (time, url) pairs, with datetime.min standing in for missing
+# times and None for missing URLs.
+def stale_objects(model, chunk_size=1000):
+    qs = stale_queryset(model)
+
+    # Those never scraped, by primary key.
+    if model._scrape_metadata == 'packed':
+        source_names = [n[:-6] + '_src__url' for n in model._scrape_valid_fields]
+    else:
+        source_names = [n[:-6] + '_source' for n in model._scrape_valid_fields]
+    never = qs.filter(scrape_time__isnull=True).order_by('pk')
+    last_pk = None
+    while True:
+        page = never if last_pk is None else never.filter(pk__gt=last_pk)
+        rows = list(page.values_list('pk', 'scrape_url', *source_names)[:chunk_size])
+        for row in rows:
+            urls = [u for u in row[1:] if u]
+            yield (datetime.min, urls[0] if urls else None)
+        if len(rows) < chunk_size:
+            break
+        last_pk = rows[-1][0]
+
+    # The rest, oldest first.
+    scraped = qs.filter(scrape_time__isnull=False).order_by('scrape_time', 'pk')
+    last = None
+    while True:
+        page = scraped
+        if last is not None:
+            page = page.filter(Q(scrape_time__gt=last[1]) | Q(scrape_time=last[1], pk__gt=last[0]))
+        rows = list(page.values_list('pk', 'scrape_time', 'scrape_url')[:chunk_size])
+        for pk, scrape_time, url in rows:
+            yield (scrape_time, url)
+        if len(rows) < chunk_size:
+            break
+        last = rows[-1]
+
+
+## Source URLs of scraped objects, stalest first.
+# Merges the objects of every model, skipping those that are fully validated and
+# so won't be updated. Models need "scrape_schedule" set. Stops after "limit"
+# objects, or after "fraction" of the number of objects that aren't fully
+# validated; both count objects, including those whose URL has already been
+# produced for another object, which isn't produced again. Only the last
+# "dedupe_size" URLs are remembered for that, Scrapy's duplicate filter catches
+# the rest.
+class StaleSources(object):
+
+    def __init__(self, models, limit=None, fraction=None, chunk_size=1000, dedupe_size=10000):
+        for model in models:
+            if not getattr(model, '_scrape_schedule', False):
+                raise TypeError('%s needs "scrape_schedule" in its Meta to be scheduled.'%
+                                model._meta.object_name)
+        self.models = models
+        self.limit = limit
+        self.fraction = fraction
+        self.chunk_size = chunk_size
+        self.dedupe_size = dedupe_size
+
+    ## Number of objects with at least one field that isn't validated.
+    def count_stale(self):
+        return sum([stale_queryset(m).count() for m in self.models])
+
+    def get_limit(self):
+        limits = []
+        if self.limit is not None:
+            limits.append(self.limit)
+        if self.fraction is not None:
+            limits.append(int(math.ceil(self.count_stale()*self.fraction)))
+        return min(limits) if limits else None
+
+    def __iter__(self):
+        limit = self.get_limit()
+        if limit == 0:
+            return
+        streams = [stale_objects(m, self.chunk_size) for m in self.models]
+        seen = LRUCache(self.dedupe_size)
+        count = 0
+        for scrape_time, url in heapq.merge(*streams):
+            if not url:
+                continue
+            count += 1
+            if url not in seen:
+                seen.set(url, True)
+                yield url
+            if limit is not None and count >= limit:
+                return
+
+
+## Spider mixin starting from the stalest scraped objects.
+# Set "stale_models" to the ScrapeModels to refresh, each with "scrape_schedule"
+# in its Meta, and, optionally, "stale_limit" and/or "stale_fraction" to only
+# refresh the oldest few, e.g. 0.1 for the oldest 10%. URLs are read from the
+# database in chunks as Scrapy asks for more requests.
+class StaleRequestsMixin(object):
+    stale_models = ()
+    stale_limit = None
+    stale_fraction = None
+    stale_chunk_size = 1000
+
+    def start_requests(self):
+        sources = StaleSources(self.stale_models, limit=self.stale_limit, fraction=self.stale_fraction,
+                               chunk_size=self.stale_chunk_size)
+        for url in sources:
+            yield self.make_requests_from_url(url)
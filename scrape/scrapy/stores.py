@@ -0,0 +1,239 @@
+import os, glob, sqlite3, anydbm, tempfile
+import cPickle as pickle
+from scrapy.exceptions import NotConfigured
+from cache import LRUCache
+
+
+_missing = object()
+
+
+## Stores used by DjangoItemPipeline to map item IDs to primary keys.
+# A store behaves like a very small dictionary: "get", "set" and "in". A value
+# of None means the item was dropped. Stores are created per spider using
+# "from_settings" and closed when the spider finishes.
+
+
+## Keep everything in memory.
+# Fastest, but grows for as long as the crawl runs.
+class MemoryStore(object):
+
+    def __init__(self):
+        self.data = {}
+
+    @classmethod
+    def from_settings(cls, settings, spider):
+        return cls()
+
+    def __contains__(self, id):
+        return id in self.data
+
+    def get(self, id, default=None):
+        return self.data.get(id, default)
+
+    def set(self, id, pk):
+        self.data[id] = pk
+
+    def close(self):
+        self.data.clear()
+
+
+## Base for stores that spill to disk.
+# Files are created in DJANGO_ITEM_ID_STORE_DIR (the system temporary directory by
+# default) and removed when the store is closed. If DJANGO_ITEM_ID_STORE_CACHE is
+# set the store is wrapped in an LRU cache holding that many entries.
+class DiskStore(object):
+    suffix = ''
+
+    def __init__(self, path=None, directory=None, prefix='tmp'):
+        self.temporary = path is None
+        if path is None:
+            fd, path = tempfile.mkstemp(suffix=self.suffix, prefix=prefix, dir=directory)
+            os.close(fd)
+            os.unlink(path)
+        self.path = path
+
+    @classmethod
+    def from_settings(cls, settings, spider):
+        store = cls(directory=settings.get('DJANGO_ITEM_ID_STORE_DIR'), prefix='%s-'%spider.name)
+        size = settings.getint('DJANGO_ITEM_ID_STORE_CACHE', 0)
+        if size:
+            store = LRUStore(store, size)
+        return store
+
+    ## Remove temporary files, including any extensions added by the backend.
+    def close(self):
+        if self.temporary:
+            for path in glob.glob(self.path + '*'):
+                os.unlink(path)
+
+
+## Store IDs in an SQLite database.
+# Writes are committed every "commit_every" sets rather than individually; reads
+# on the same connection see uncommitted writes. The connection may be used from
+# any thread, but callers must make sure only one uses it at a time.
+class SqliteStore(DiskStore):
+    suffix = '.sqlite'
+
+    def __init__(self, path=None, commit_every=1000, **kwargs):
+        super(SqliteStore, self).__init__(path, **kwargs)
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute('PRAGMA synchronous=OFF')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS ids (id TEXT PRIMARY KEY, pk BLOB)')
+
+    def __contains__(self, id):
+        return self.conn.execute('SELECT 1 FROM ids WHERE id=?', (id,)).fetchone() is not None
+
+    def get(self, id, default=None):
+        row = self.conn.execute('SELECT pk FROM ids WHERE id=?', (id,)).fetchone()
+        if row is None:
+            return default
+        return pickle.loads(str(row[0]))
+
+    def set(self, id, pk):
+        self.conn.execute('INSERT OR REPLACE INTO ids (id, pk) VALUES (?, ?)',
+                          (id, sqlite3.Binary(pickle.dumps(pk, 2))))
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+        super(SqliteStore, self).close()
+
+
+## Store IDs in an SQLite database shared by many crawler processes.
+# Lets crawls be sharded over worker processes, with items in one resolving IDs
+# saved by another. Every process points DJANGO_ITEM_ID_STORE_PATH at the same
+# file, which may include "%(spider)s" for the spider's name, and sets the same
+# DJANGO_ITEM_CRAWL_ID, unique to the crawl. The file holds one crawl at a time:
+# the first process of a new crawl clears out what the last one stored, so
+# primary keys are never trusted across crawls. Writes are committed straight
+# away so the others see them.
+#
+# Stores with a "poll" method tell DjangoItemPipeline which IDs have been set
+# since it last asked, including by other processes, so it can wake items
+# waiting on them. It polls every DJANGO_ITEM_ID_STORE_POLL_INTERVAL seconds.
+#
+# Dropped items are only remembered by the process that dropped them. Items
+# elsewhere waiting on them keep waiting, as another process may yet save them.
+class SharedSqliteStore(DiskStore):
+
+    def __init__(self, path, crawl, timeout=30.0):
+        super(SharedSqliteStore, self).__init__(path)
+        self.crawl = crawl
+        self.dropped = set()
+        self.conn = sqlite3.connect(self.path, timeout=timeout, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS crawl_ids (seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                          'crawl TEXT, id TEXT, pk BLOB, UNIQUE (crawl, id))')
+        self.conn.execute('DELETE FROM crawl_ids WHERE crawl<>?', (crawl,))
+        self.conn.commit()
+        self.last_seq = self.conn.execute('SELECT COALESCE(MAX(seq), 0) FROM crawl_ids').fetchone()[0]
+
+    @classmethod
+    def from_settings(cls, settings, spider):
+        path = settings.get('DJANGO_ITEM_ID_STORE_PATH')
+        crawl = settings.get('DJANGO_ITEM_CRAWL_ID')
+        if not path or not crawl:
+            raise NotConfigured('SharedSqliteStore needs DJANGO_ITEM_ID_STORE_PATH and DJANGO_ITEM_CRAWL_ID.')
+        return cls(path%{'spider': spider.name}, crawl)
+
+    def __contains__(self, id):
+        return id in self.dropped or self.conn.execute(
+            'SELECT 1 FROM crawl_ids WHERE crawl=? AND id=?', (self.crawl, id)).fetchone() is not None
+
+    def get(self, id, default=None):
+        row = self.conn.execute('SELECT pk FROM crawl_ids WHERE crawl=? AND id=?', (self.crawl, id)).fetchone()
+        if row is None:
+            return None if id in self.dropped else default
+        return pickle.loads(str(row[0]))
+
+    ## Replacing a row gives it a new sequence number, so pollers see the change.
+    def set(self, id, pk):
+        if pk is None:
+            self.dropped.add(id)
+            return
+        self.conn.execute('INSERT OR REPLACE INTO crawl_ids (crawl, id, pk) VALUES (?, ?, ?)',
+                          (self.crawl, id, sqlite3.Binary(pickle.dumps(pk, 2))))
+        self.conn.commit()
+
+    ## IDs set since the last poll.
+    def poll(self):
+        rows = self.conn.execute('SELECT seq, id FROM crawl_ids WHERE crawl=? AND seq>? ORDER BY seq',
+                                 (self.crawl, self.last_seq)).fetchall()
+        if rows:
+            self.last_seq = rows[-1][0]
+        return [r[1] for r in rows]
+
+    def commit(self):
+        pass
+
+    def close(self):
+        self.dropped.clear()
+        self.conn.close()
+
+
+## Store IDs in a dbm file.
+class DbmStore(DiskStore):
+
+    def __init__(self, path=None, **kwargs):
+        super(DbmStore, self).__init__(path, **kwargs)
+        self.db = anydbm.open(self.path, 'c')
+
+    def _key(self, id):
+        if isinstance(id, unicode):
+            return id.encode('utf-8')
+        return str(id)
+
+    def __contains__(self, id):
+        return self.db.has_key(self._key(id))
+
+    def get(self, id, default=None):
+        try:
+            return pickle.loads(self.db[self._key(id)])
+        except KeyError:
+            return default
+
+    def set(self, id, pk):
+        self.db[self._key(id)] = pickle.dumps(pk, 2)
+
+    def close(self):
+        self.db.close()
+        super(DbmStore, self).close()
+
+
+## Keep the most recently used IDs in memory in front of another store.
+# Writes go straight through to the backend so nothing is lost on eviction.
+class LRUStore(object):
+
+    def __init__(self, backend, size=10000):
+        self.backend = backend
+        self.cache = LRUCache(size)
+
+    def __contains__(self, id):
+        return id in self.cache or id in self.backend
+
+    def get(self, id, default=None):
+        pk = self.cache.get(id, _missing)
+        if pk is _missing:
+            pk = self.backend.get(id, _missing)
+            if pk is _missing:
+                return default
+            self.cache.set(id, pk)
+        return pk
+
+    def set(self, id, pk):
+        self.cache.set(id, pk)
+        self.backend.set(id, pk)
+
+    def close(self):
+        self.cache.clear()
+        self.backend.close()
@@ -1,9 +1,121 @@
-from django.test import TestCase
-from django.db import IntegrityError
+import os, glob, time, tempfile
+from django.test import TestCase, TransactionTestCase
+from django.utils import unittest
+from django.db import IntegrityError, connection
 from django.db import models
 import models as scrape_models
 
 
+## Models the saving tests write to. Defined here so the test database gets
+# their tables.
+class BatchThing(models.Model):
+    name = models.CharField(max_length=20, unique=True)
+    code = models.CharField(max_length=20, unique=True, null=True, blank=True)
+    value = models.IntegerField(null=True, blank=True)
+
+
+class KeyThing(scrape_models.ScrapeModel):
+    name = models.CharField(max_length=20)
+    code = models.CharField(max_length=20, unique=True, null=True, blank=True)
+
+    class Meta:
+        scrape_key = True
+
+
+class SchedThing(scrape_models.ScrapeModel):
+    name = models.CharField(max_length=20, unique=True)
+    value = models.IntegerField(null=True, blank=True)
+
+    class Meta:
+        scrape_schedule = True
+
+
+class CovThing(scrape_models.ScrapeModel):
+    name = models.CharField(max_length=20, unique=True)
+
+    class Meta:
+        scrape_coverage = True
+
+
+class PackedThing(scrape_models.ScrapeModel):
+    name = models.CharField(max_length=20)
+    value = models.IntegerField(null=True, blank=True)
+
+    class Meta:
+        scrape_metadata = 'packed'
+        scrape_coverage = True
+
+
+class HashDoc(scrape_models.ScrapeModel):
+    name = models.CharField(max_length=20, unique=True)
+    doc = models.FileField(upload_to='docs', blank=True)
+
+    class Meta:
+        scrape_hash_fields = ('doc',)
+
+
+class TxChild(models.Model):
+    name = models.CharField(max_length=20)
+    parent = models.ForeignKey(BatchThing)
+
+
+class NullChild(models.Model):
+    name = models.CharField(max_length=20)
+    parent = models.ForeignKey(BatchThing, null=True, blank=True)
+
+
+class TagThing(models.Model):
+    name = models.CharField(max_length=20)
+
+
+class TaggedThing(models.Model):
+    name = models.CharField(max_length=20, unique=True)
+    tags = models.ManyToManyField(TagThing, blank=True)
+
+
+class ChangeThing(models.Model):
+    name = models.CharField(max_length=20, unique=True)
+    value = models.IntegerField(null=True, blank=True)
+    note = models.CharField(max_length=20, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+
+class GeoCountry(models.Model):
+    name = models.CharField(max_length=40)
+
+
+class GeoState(models.Model):
+    name = models.CharField(max_length=40)
+    country = models.ForeignKey(GeoCountry)
+
+
+class GeoLocality(models.Model):
+    name = models.CharField(max_length=40)
+    state = models.ForeignKey(GeoState)
+
+
+class GeoAddress(models.Model):
+    street = models.CharField(max_length=100)
+    locality = models.ForeignKey(GeoLocality)
+
+
+class GeoHolder(models.Model):
+    address = models.ForeignKey(GeoAddress)
+
+
+## SQL run by a function.
+def capture_sql(f):
+    from django.db import connection
+    old_debug = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    start = len(connection.queries)
+    try:
+        f()
+    finally:
+        connection.use_debug_cursor = old_debug
+    return [q['sql'] for q in connection.queries[start:]]
+
+
 class ScrapeModelBaseTestCase(TestCase):
 
     def setUp(self):
@@ -72,3 +184,1017 @@ class ScrapeModelBaseTestCase(TestCase):
         self.assertIsInstance(fields[4], models.DateTimeField)
         self.assertEquals(fields[5].name, 'target')
         self.assertIsInstance(fields[5], models.OneToOneField)
+
+    def test_hash_fields(self):
+        class TestHashModel(scrape_models.ScrapeModel):
+            image = models.ImageField(upload_to='images')
+
+            class Meta:
+                scrape_hash_fields = ('image',)
+
+        field = TestHashModel._meta.get_field('image_hash')
+        self.assertIsInstance(field, models.CharField)
+        self.assertTrue(field.db_index)
+        self.assertTrue('image_hash' in TestHashModel._scrape_fields)
+
+        def do_test():
+            class TestBadHashModel(scrape_models.ScrapeModel):
+                name = models.CharField(max_length=10)
+
+                class Meta:
+                    scrape_hash_fields = ('name',)
+        self.assertRaises(TypeError, do_test)
+
+    def test_key(self):
+        class TestKeyModel(scrape_models.ScrapeModel):
+            name = models.CharField(max_length=10)
+
+            class Meta:
+                scrape_key = True
+
+        field = TestKeyModel._meta.get_field('scrape_key')
+        self.assertIsInstance(field, models.CharField)
+        self.assertTrue(field.unique)
+        self.assertTrue('scrape_key' in TestKeyModel._scrape_fields)
+
+    def test_packed(self):
+        from datetime import datetime
+        class TestPackedModel(scrape_models.ScrapeModel):
+            f1 = models.CharField(max_length=10)
+            f2 = models.FloatField()
+
+            class Meta:
+                scrape_metadata = 'packed'
+
+        names = [f.name for f in TestPackedModel._meta.fields]
+        self.assertEquals(names, ['id', 'f1', 'f2', 'f1_src', 'f1_ts', 'f2_src', 'f2_ts', 'scrape_valid'])
+        self.assertEquals(TestPackedModel._scrape_valid_fields, ['f1_valid', 'f2_valid'])
+        self.assertEquals(TestPackedModel._scrape_columns['f2_valid'], 'scrape_valid')
+
+        obj = TestPackedModel(f2_valid=True)
+        self.assertEquals((obj.f1_valid, obj.f2_valid, obj.scrape_valid), (False, True, 2))
+        obj.f1_valid = True
+        obj.f2_valid = False
+        self.assertEquals(obj.scrape_valid, 1)
+        obj.f1_timestamp = datetime(2012, 1, 1, 20, 30)
+        self.assertEquals(obj.f1_timestamp, datetime(2012, 1, 1, 20, 30))
+        self.assertEquals(obj.f2_timestamp, None)
+        obj.f1_source = u'http://example.com/a'
+        self.assertEquals(obj.f1_src_id, scrape_models.ScrapeSource.intern(u'http://example.com/a'))
+        self.assertEquals(obj.f1_source, u'http://example.com/a')
+
+    def test_coverage(self):
+        class TestCoverageModel(scrape_models.ScrapeModel):
+            f1 = models.CharField(max_length=10)
+            f2 = models.FloatField()
+
+            class Meta:
+                scrape_coverage = True
+
+        self.assertTrue(TestCoverageModel._scrape_coverage)
+        obj = TestCoverageModel()
+        self.assertEquals(scrape_models.get_valid_state(obj), 'none')
+        obj.f1_valid = True
+        self.assertEquals(scrape_models.get_valid_state(obj), 'some')
+        obj.f2_valid = True
+        self.assertEquals(scrape_models.get_valid_state(obj), 'all')
+
+    def test_set_valid(self):
+        class TestSetValidModel(scrape_models.ScrapeModel):
+            f1 = models.CharField(max_length=10)
+
+        qs = TestSetValidModel.objects.none()
+        self.assertRaises(ValueError, lambda: scrape_models.set_valid(qs, ['missing']))
+        self.assertEquals(scrape_models.set_valid(qs, []), 0)
+
+    def test_set_valid_packed(self):
+        a = PackedThing.objects.create(name=u'a', value_valid=True)
+        b = PackedThing.objects.create(name=u'b')
+        c = PackedThing.objects.create(name=u'c', name_valid=True, value_valid=True)
+        scrape_models.ScrapeCoverage.rebuild(PackedThing)
+        counts = lambda: scrape_models.ScrapeCoverage.get_counts(PackedThing)
+        state = lambda obj: scrape_models.get_valid_state(PackedThing.objects.get(pk=obj.pk))
+
+        qs = PackedThing.objects.filter(pk__in=[a.pk, b.pk])
+        self.assertEquals(scrape_models.set_valid(qs, ['name']), 2)
+        self.assertEquals((state(a), state(b), state(c)), ('all', 'some', 'all'))
+        self.assertEquals(counts(), {'all': 2, 'some': 1, 'none': 0})
+
+        qs = PackedThing.objects.filter(pk__in=[b.pk, c.pk])
+        self.assertEquals(scrape_models.set_valid(qs, ['name'], False), 2)
+        self.assertEquals((state(a), state(b), state(c)), ('all', 'none', 'some'))
+        self.assertEquals(counts(), {'all': 1, 'some': 1, 'none': 1})
+
+        # Setting fields that are already set changes nothing.
+        self.assertEquals(scrape_models.set_valid(PackedThing.objects.filter(pk=a.pk)), 1)
+        self.assertEquals(PackedThing.objects.get(pk=a.pk).scrape_valid, 3)
+        self.assertEquals(counts(), {'all': 1, 'some': 1, 'none': 1})
+
+
+class PackedAdminTestCase(TestCase):
+
+    def test_save_model(self):
+        from datetime import datetime
+        from django.contrib import admin
+        from django.test.client import RequestFactory
+        from scrape.admin import ScrapeModelAdmin
+        obj = PackedThing.objects.create(name=u'a', value=1, value_valid=True)
+        scrape_models.ScrapeCoverage.rebuild(PackedThing)
+        model_admin = ScrapeModelAdmin(PackedThing, admin.site)
+        request = RequestFactory().post('/')
+
+        # The properties are edited like columns.
+        fieldsets = model_admin.get_fieldsets(request, obj)
+        self.assertEquals(fieldsets[0][1]['fields'], ('name', 'name_valid', 'value', 'value_valid'))
+        self.assertEquals(list(fieldsets[-1][1]['fields']),
+                          ['name_source', 'name_timestamp', 'value_source', 'value_timestamp'])
+        Form = model_admin.get_form(request, obj)
+        self.assertEquals(Form(instance=obj).initial['value_valid'], True)
+
+        form = Form({
+            'name': u'b', 'value': u'2', 'name_valid': u'on',
+            'name_source': u'http://x/b',
+            'name_timestamp_0': u'2012-01-02', 'name_timestamp_1': u'10:30:00',
+        }, instance=obj)
+        self.assertTrue(form.is_valid(), form.errors)
+        model_admin.save_model(request, form.save(commit=False), form, True)
+
+        obj = PackedThing.objects.get(pk=obj.pk)
+        self.assertEquals((obj.name, obj.value), (u'b', 2))
+        self.assertEquals((obj.name_valid, obj.value_valid), (True, False))
+        self.assertEquals(obj.name_source, u'http://x/b')
+        self.assertEquals(obj.name_timestamp, datetime(2012, 1, 2, 10, 30))
+        self.assertEquals(obj.value_source, None)
+        self.assertEquals(scrape_models.ScrapeCoverage.get_counts(PackedThing), {'all': 0, 'some': 1, 'none': 0})
+
+
+class IdStoreTestCase(TestCase):
+
+    def check_store(self, store):
+        self.assertFalse(u'http://a' in store)
+        self.assertEquals(store.get(u'http://a'), None)
+        self.assertEquals(store.get(u'http://a', -1), -1)
+        store.set(u'http://a', 1)
+        store.set(u'http://b', None)
+        self.assertTrue(u'http://a' in store)
+        self.assertTrue(u'http://b' in store)
+        self.assertEquals(store.get(u'http://a'), 1)
+        self.assertEquals(store.get(u'http://b', -1), None)
+        store.set(u'http://a', 2)
+        self.assertEquals(store.get(u'http://a'), 2)
+
+    def test_memory(self):
+        from scrape.scrapy.stores import MemoryStore
+        self.check_store(MemoryStore())
+
+    def test_sqlite(self):
+        from scrape.scrapy.stores import SqliteStore
+        store = SqliteStore()
+        self.check_store(store)
+        store.close()
+        self.assertFalse(os.path.exists(store.path))
+
+    def test_dbm(self):
+        from scrape.scrapy.stores import DbmStore
+        store = DbmStore()
+        self.check_store(store)
+        store.close()
+        self.assertFalse(glob.glob(store.path + '*'))
+
+    def test_lru(self):
+        from scrape.scrapy.stores import LRUStore, SqliteStore
+        store = LRUStore(SqliteStore(), 1)
+        self.check_store(store)
+        self.assertEquals(len(store.cache), 1)
+        self.assertEquals(store.get(u'http://b', -1), None)
+        self.assertEquals(store.get(u'http://a'), 2)
+        store.close()
+
+    def test_shared(self):
+        from scrape.scrapy.stores import SharedSqliteStore
+        path = tempfile.mktemp(suffix='.sqlite')
+        store = SharedSqliteStore(path, u'1')
+        other = SharedSqliteStore(path, u'1')
+        try:
+            self.check_store(store)
+            self.assertEquals(other.get(u'http://a'), 2)
+            self.assertEquals(other.poll(), [u'http://a'])
+            self.assertEquals(other.poll(), [])
+            other.set(u'http://a', None)
+            self.assertEquals(store.get(u'http://a'), 2)
+
+            # Drops stay with the process that dropped them.
+            self.assertFalse(u'http://b' in other)
+            self.assertEquals(other.get(u'http://b', -1), -1)
+        finally:
+            store.close()
+            other.close()
+
+        # The next crawl starts empty.
+        store = SharedSqliteStore(path, u'2')
+        try:
+            self.assertFalse(u'http://a' in store)
+            self.assertEquals(store.get(u'http://a'), None)
+        finally:
+            store.close()
+            for p in glob.glob(path + '*'):
+                os.unlink(p)
+
+
+class CacheTestCase(TestCase):
+
+    def test_lru_eviction(self):
+        from scrape.scrapy.cache import LRUCache
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEquals(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals((cache.hits, cache.misses), (1, 1))
+
+    def test_identity_copies(self):
+        from scrape.scrapy.cache import LRUCache, IdentityCache
+        cache = IdentityCache(LRUCache(2))
+        country = GeoCountry.objects.create(name=u'Australia')
+        obj = GeoState.objects.create(name=u'NSW', country=country)
+        self.assertEquals(obj.country, country)
+        cache.set((('name', u'a'),), obj)
+        obj.name = u'VIC'
+        found = cache.get((('name', u'a'),))
+        self.assertEquals(found.name, u'NSW')
+        self.assertEquals(found.pk, obj.pk)
+        self.assertFalse(found._state is obj._state)
+        self.assertFalse(found._state.adding)
+        self.assertFalse(hasattr(found, '_country_cache'))
+        self.assertEquals(found.country_id, country.pk)
+        found.name = u'QLD'
+        self.assertEquals(cache.get((('name', u'a'),)).name, u'NSW')
+        self.assertEquals(cache.get((('name', [u'a']),)), None)
+        cache.set((('name', [u'a']),), obj)
+        self.assertEquals(cache.hits, 2)
+
+
+class MetricsTestCase(TestCase):
+
+    def test_metrics(self):
+        from scrape.scrapy.metrics import PipelineMetrics
+        class Stats(dict):
+            def set_value(self, key, value, spider=None):
+                self[key] = value
+        metrics = PipelineMetrics(count_queries=True)
+        metrics.add_time('Event', 'lookup', 0.002)
+        metrics.add_time('Event', 'lookup', 0.004)
+        metrics.add_drop('Event', 'required')
+        def run_queries():
+            from django.db import connection
+            cursor = connection.cursor()
+            cursor.execute('SELECT 1')
+            cursor.execute('SELECT 2')
+        metrics.measure('Event', 2, run_queries)
+        stats = Stats()
+        metrics.publish(stats, None)
+        self.assertEquals(stats['django_item/time/Event/lookup_count'], 2)
+        self.assertEquals(stats['django_item/items/Event'], 2)
+        self.assertEquals(stats['django_item/queries_per_item/Event'], 1.0)
+        self.assertEquals(stats['django_item/dropped/Event/required'], 1)
+        self.assertTrue(metrics.summary()[0].startswith('Event: 2 items'))
+
+
+class FilesTestCase(TestCase):
+
+    def test_store_file(self):
+        import tempfile, shutil
+        from django.core.files.storage import FileSystemStorage
+        from scrape.scrapy.files import store_file
+        root = tempfile.mkdtemp()
+        try:
+            class FileDoc(models.Model):
+                doc = models.FileField(upload_to='docs', storage=FileSystemStorage(location=root))
+            path = os.path.join(root, 'download.txt')
+            with open(path, 'w') as f:
+                f.write('content')
+            for mode, name in [('reference', 'download.txt'), ('link', 'docs/download.txt'),
+                               ('copy', 'docs/download_1.txt')]:
+                obj = FileDoc()
+                store_file(obj.doc, path, mode)
+                self.assertEquals(obj.doc.name, name)
+                self.assertEquals(open(os.path.join(root, name)).read(), 'content')
+            obj = FileDoc()
+            store_file(obj.doc, path, 'move')
+            self.assertEquals(obj.doc.name, 'docs/download_2.txt')
+            self.assertFalse(os.path.exists(path))
+
+            # Items sharing a download all get the file it was moved to.
+            other = FileDoc()
+            store_file(other.doc, path, 'move')
+            self.assertEquals(other.doc.name, 'docs/download_2.txt')
+            self.assertEquals(open(os.path.join(root, other.doc.name)).read(), 'content')
+        finally:
+            shutil.rmtree(root)
+
+
+class FileHashTestCase(PipelineTestMixin, TestCase):
+
+    def setUp(self):
+        import shutil
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    ## Write a download under the temporary directory.
+    def write(self, name, content='content'):
+        path = os.path.join(self.root, name)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    ## Temporarily override settings read while items are processed.
+    def override(self, **overrides):
+        from scrapy.conf import settings
+        old = settings.overrides.copy()
+        settings.overrides.update(overrides)
+        def restore():
+            settings.overrides.clear()
+            settings.overrides.update(old)
+        self.addCleanup(restore)
+
+    def test_stored_file(self):
+        from scrapy.item import Field
+        from scrape.scrapy.items import DjangoItem
+        from scrape.scrapy.files import file_hash
+        class DocItem(DjangoItem):
+            django_model = HashDoc
+            images = Field()
+        checksum = file_hash(self.write('full/a.txt'))
+        HashDoc.objects.create(name=u'a', doc='docs/a.txt', doc_hash=checksum)
+        self.override(IMAGES_STORE=self.root)
+        pipeline, spider = self.open_pipeline()
+        process = lambda id, image: self.result_of(pipeline.process_item(DocItem(
+            id=id, scrape_url=u'http://x/%s'%id, name=id, doc='images', images=[image]), spider))
+
+        # The hash is worked out from the download, or taken from its checksum,
+        # and either way finds the file already stored.
+        process(u'b', {'path': 'full/a.txt', 'checksum': None})
+        process(u'c', {'path': 'full/missing.txt', 'checksum': checksum})
+        for name in (u'b', u'c'):
+            obj = HashDoc.objects.get(name=name)
+            self.assertEquals((obj.doc.name, obj.doc_hash), ('docs/a.txt', checksum))
+
+        # Without a match there's nothing to use.
+        plan = [p for p in DocItem._save_plan if p.name == 'doc'][0]
+        self.assertFalse(DocItem(doc_hash='0'*32).use_stored_file(HashDoc(), plan))
+        self.assertFalse(DocItem().use_stored_file(HashDoc(), plan))
+        self.close_pipeline(pipeline, spider)
+
+    def test_dedupe_image(self):
+        from scrape.scrapy.pipelines import FixedImagesPipeline
+        self.override(DJANGO_ITEM_IMAGE_INDEX=os.path.join(self.root, 'index.sqlite'))
+        pipeline = FixedImagesPipeline(self.root)
+        first = self.write('full/a.jpg', 'image')
+        second = self.write('full/b.jpg', 'image')
+        self.assertEquals(pipeline.dedupe_image({'path': 'full/a.jpg', 'checksum': 'c1'})['path'], 'full/a.jpg')
+
+        # A duplicate download becomes a link to the first, and the item points there.
+        image = pipeline.dedupe_image({'path': 'full/b.jpg', 'checksum': 'c1'})
+        self.assertEquals(image['path'], 'full/a.jpg')
+        self.assertTrue(os.path.samefile(first, second))
+
+        # Different content is left alone.
+        self.write('full/c.jpg', 'other')
+        self.assertEquals(pipeline.dedupe_image({'path': 'full/c.jpg', 'checksum': 'c2'})['path'], 'full/c.jpg')
+        pipeline.image_index.close()
+
+
+class GeocodingTestCase(TestCase):
+
+    ## A geocoder that records its calls and needs no network.
+    def make_stub(self, calls):
+        def stub(field, value):
+            calls.append(value)
+            street, locality = [v.strip() for v in value.split(',')]
+            state = GeoState(name=u'NSW', country=GeoCountry(name=u'Australia'))
+            return GeoAddress(street=street, locality=GeoLocality(name=locality, state=state))
+        return stub
+
+    def test_address_cache(self):
+        from scrape.scrapy.geocoding import AddressCache
+        calls = []
+        stub = self.make_stub(calls)
+        field = GeoHolder._meta.get_field('address')
+        path = tempfile.mktemp(suffix='.sqlite')
+        self.addCleanup(lambda: os.path.exists(path) and os.unlink(path))
+
+        cache = AddressCache(geocode=stub, path=path)
+        first = cache.resolve(field, u'1 Main St, Sydney')
+        self.assertEquals(cache.resolve(field, u' 1  main st,  SYDNEY').pk, first.pk)
+        self.assertEquals(len(calls), 1)
+        cache.resolve(field, u'2 Main St, Sydney')
+        self.assertEquals(len(calls), 2)
+        self.assertEquals(GeoLocality.objects.count(), 1)
+        self.assertEquals(GeoCountry.objects.count(), 1)
+        cache.close()
+        self.assertEquals(cache.store, None)
+
+        # A new cache finds addresses through the persistent store.
+        cache = AddressCache(geocode=stub, path=path)
+        self.assertEquals(cache.resolve(field, u'1 Main St, Sydney').pk, first.pk)
+        self.assertEquals(len(calls), 2)
+        cache.close()
+
+    def test_wait_for_commit(self):
+        from scrape.scrapy.geocoding import AddressCache
+        field = GeoHolder._meta.get_field('address')
+        path = tempfile.mktemp(suffix='.sqlite')
+        self.addCleanup(lambda: os.path.exists(path) and os.unlink(path))
+        cache = AddressCache(geocode=self.make_stub([]), path=path)
+        cache.wait_for_commit = True
+        key = cache.normalize(u'1 Main St, Sydney')
+
+        # Nothing is persisted for a rolled back transaction.
+        cache.resolve(field, u'1 Main St, Sydney')
+        self.assertEquals(cache.store.get(key), None)
+        cache.clear()
+        cache.commit()
+        self.assertEquals(cache.store.get(key), None)
+
+        # Only once it's committed.
+        address = cache.resolve(field, u'1 Main St, Sydney')
+        self.assertEquals(cache.store.get(key), None)
+        cache.commit()
+        self.assertEquals(cache.store.get(key), address.pk)
+        cache.close()
+
+
+class ProcessorTestCase(TestCase):
+
+    def test_fused(self):
+        from scrape.scrapy.processors import Fused, RemoveEntities, Strip, Exclude
+        proc = Fused(RemoveEntities(), Strip(), Exclude(u'b'))
+        self.assertEquals(proc([' a &amp; b ', 'b', None, u' c']), [u'a & b', u'c'])
+        self.assertEquals(proc(' x '), [u'x'])
+        self.assertRaises(TypeError, Fused, lambda v: v)
+
+    def test_datetime_cache(self):
+        from datetime import datetime
+        from scrape.scrapy.processors import DateTime, Date
+        proc = DateTime(formats=('%d/%m/%Y %H:%M',))
+        values = ['01/02/2012 20:30', '01/02/2012 20:30']
+        self.assertEquals(proc(values), [datetime(2012, 2, 1, 20, 30)]*2)
+        self.assertEquals((proc.hits, proc.misses), (1, 1))
+        self.assertEquals(proc('1 Feb 2012 8:30pm'), [datetime(2012, 2, 1, 20, 30)])
+        self.assertEquals(Date()(['1 Feb 2012']), [datetime(2012, 2, 1).date()])
+
+    def test_token_merge(self):
+        from scrape.scrapy.processors import TokenMerge, GenreMash, Split
+        values = ['R', 'B', 'Soul', '', 'R', '', 'B', 'R']
+        self.assertEquals(GenreMash()(values), ['R&B', 'Soul', 'R', 'B', 'R'])
+        self.assertEquals(len(values), 8)
+        proc = TokenMerge({('a', 'b', 'c'): 'ABC', ('a', 'b'): 'AB'})
+        self.assertEquals(proc(['a', 'b', 'c', 'a', 'b', 'd', 'a']), ['ABC', 'AB', 'd', 'a'])
+        self.assertEquals(Split(u'&')([u'R&B', u'Soul']), [u'R', u'B', u'Soul'])
+
+    def test_lazy(self):
+        from scrape.scrapy.processors import Lazy, Fused, Strip, Int, Split
+        seen = []
+        def values():
+            for v in [u' ', u' 1 2', u'3', u'4']:
+                seen.append(v)
+                yield v
+        proc = Lazy(Split(), Fused(Strip()), lambda vs: [v for v in vs if v], Int())
+        self.assertEquals(proc([u'1 2', u'3']), [1, 2, 3])
+        proc = Lazy(Fused(Strip()), Split(), limit=1)
+        self.assertEquals(proc(values()), [u'', u'1'])
+        self.assertEquals(seen, [u' ', u' 1 2'])
+
+
+class SaveBatchTestCase(TestCase):
+
+    def setUp(self):
+        from scrapy.spider import BaseSpider
+        from scrape.scrapy.items import DjangoItem
+        class BatchItem(DjangoItem):
+            django_model = BatchThing
+        self.BatchItem = BatchItem
+        self.spider = BaseSpider('test')
+
+    def save(self, *rows):
+        items = [self.BatchItem(**r) for r in rows]
+        return self.BatchItem.save_batch(items, None, self.spider)
+
+    def test_mixed(self):
+        from twisted.python.failure import Failure
+        existing = BatchThing.objects.create(name=u'a', value=1)
+        results = self.save({'name': u'a', 'value': 2}, {'name': u'b', 'value': 3},
+                            {'name': u'b', 'value': 4}, {'name': u'c'})
+        self.assertFalse([r for r in results if isinstance(r, Failure)])
+        self.assertEquals(results[0].pk, existing.pk)
+        self.assertEquals(results[1].pk, results[2].pk)
+        self.assertEquals(dict(BatchThing.objects.values_list('name', 'value')),
+                          {u'a': 2, u'b': 4, u'c': None})
+
+    def test_integrity_fallback(self):
+        from twisted.python.failure import Failure
+        results = self.save({'name': u'x', 'code': u'1'}, {'name': u'y', 'code': u'1'}, {'name': u'z'})
+        self.assertIsInstance(results[1], Failure)
+        self.assertTrue(results[1].check(IntegrityError))
+        self.assertEquals(results[0].code, u'1')
+        self.assertEquals(sorted(BatchThing.objects.values_list('name', flat=True)), [u'x', u'z'])
+
+    def test_item_failure(self):
+        from twisted.python.failure import Failure
+        BatchThing.objects.create(name=u'a', value=1)
+        results = self.save({'name': u'a', 'value': u'abc'}, {'name': u'b', 'value': 2})
+        self.assertIsInstance(results[0], Failure)
+        self.assertEquals(results[1].value, 2)
+        self.assertEquals(BatchThing.objects.get(name=u'b').value, 2)
+
+
+class ChangeDetectionTestCase(TestCase):
+
+    def setUp(self):
+        from scrape.scrapy.items import DjangoItem
+        class ChangeItem(DjangoItem):
+            django_model = ChangeThing
+        self.ChangeItem = ChangeItem
+
+    def test_unchanged(self):
+        self.ChangeItem(name=u'a', value=1, note=u'x').save(None, None)
+        sql = capture_sql(lambda: self.ChangeItem(name=u'a', value=1, note=u'x').save(None, None))
+        self.assertFalse([q for q in sql if q.startswith('UPDATE')])
+
+    def test_saved(self):
+        from django.db.models.signals import post_save
+        saved = []
+        def receiver(sender, instance, **kwargs):
+            saved.append(instance.value)
+        post_save.connect(receiver, sender=ChangeThing)
+        self.addCleanup(lambda: post_save.disconnect(receiver, sender=ChangeThing))
+        self.ChangeItem(name=u'a', value=1, note=u'x').save(None, None)
+        self.assertEquals(saved[-1], 1)
+        self.ChangeItem(name=u'a', value=2, note=u'x').save(None, None)
+        self.assertEquals(saved[-1], 2)
+        count = len(saved)
+        self.ChangeItem(name=u'a', value=2, note=u'x').save(None, None)
+        self.assertEquals(len(saved), count)
+
+    def test_partial(self):
+        class Pipeline(object):
+            partial_updates = True
+        self.ChangeItem(name=u'a', value=1, note=u'x').save(Pipeline(), None)
+        sql = capture_sql(lambda: self.ChangeItem(name=u'a', value=2, note=u'x').save(Pipeline(), None))
+        updates = [q.split(' WHERE ')[0] for q in sql if q.startswith('UPDATE')]
+        self.assertEquals(len(updates), 1)
+        self.assertTrue('"value"' in updates[0])
+        self.assertTrue('"updated"' in updates[0])
+        self.assertFalse('"note"' in updates[0])
+        self.assertFalse('"name"' in updates[0])
+        self.assertEquals(ChangeThing.objects.get(name=u'a').value, 2)
+
+
+class ManyToManyTestCase(TestCase):
+
+    def test_merge(self):
+        from scrape.scrapy.items import DjangoItem
+        class TaggedItem(DjangoItem):
+            django_model = TaggedThing
+        t1, t2, t3 = [TagThing.objects.create(name=n) for n in (u'1', u'2', u'3')]
+        table = TaggedThing.tags.through._meta.db_table
+        inserts = lambda sql: [q for q in sql if q.startswith('INSERT') and table in q]
+        TaggedItem(name=u'a', tags=[t1.pk, t2.pk]).save(None, None)
+
+        # Existing links are kept and only new ones inserted.
+        sql = capture_sql(lambda: TaggedItem(name=u'a', tags=[t2.pk, t3.pk, t3.pk]).save(None, None))
+        self.assertEquals(len(inserts(sql)), 1)
+        obj = TaggedThing.objects.get(name=u'a')
+        self.assertEquals(sorted(obj.tags.values_list('name', flat=True)), [u'1', u'2', u'3'])
+        self.assertEquals(TaggedThing.tags.through.objects.count(), 3)
+
+        # Nothing new, nothing inserted.
+        sql = capture_sql(lambda: TaggedItem(name=u'a', tags=[t1.pk, t3.pk]).save(None, None))
+        self.assertEquals(inserts(sql), [])
+        self.assertEquals(TaggedThing.tags.through.objects.count(), 3)
+
+
+## Runs items through a DjangoItemPipeline without a reactor.
+# With no DB threads everything happens synchronously, apart from what waits on
+# timers, which tests trigger themselves.
+class PipelineTestMixin(object):
+
+    def open_pipeline(self, **overrides):
+        from scrapy.conf import settings
+        from scrapy.spider import BaseSpider
+        from scrapy.stats import stats
+        from scrape.scrapy.pipelines import DjangoItemPipeline
+        overrides.setdefault('DJANGO_ITEM_METRICS', False)
+        old = settings.overrides.copy()
+        settings.overrides.update(overrides)
+        try:
+            pipeline = DjangoItemPipeline()
+        finally:
+            settings.overrides.clear()
+            settings.overrides.update(old)
+        spider = BaseSpider('test')
+        stats.open_spider(spider)
+        pipeline.open_spider(spider)
+        return pipeline, spider
+
+    def close_pipeline(self, pipeline, spider):
+        from scrapy.stats import stats
+        self.result_of(pipeline.close_spider(spider))
+        stats.close_spider(spider, 'finished')
+
+    ## Everything a deferred has fired with so far.
+    def fired(self, dfd):
+        results = []
+        dfd.addBoth(lambda r: results.append(r))
+        return results
+
+    ## Run reactor calls made from DB threads until "results" has something in it.
+    def wait_for(self, results, timeout=10.0):
+        from twisted.internet import reactor
+        deadline = time.time() + timeout
+        while not results and time.time() < deadline:
+            reactor.runUntilCurrent()
+            time.sleep(0.01)
+        self.assertTrue(results, 'Timed out waiting on DB threads.')
+
+    ## The result of a fired deferred, re-raising failures.
+    def result_of(self, dfd):
+        from twisted.internet.defer import Deferred
+        if not isinstance(dfd, Deferred):
+            return dfd
+        results = []
+        dfd.addBoth(results.append)
+        self.assertTrue(results, 'Deferred has not fired.')
+        if hasattr(results[0], 'raiseException'):
+            results[0].raiseException()
+        return results[0]
+
+
+class FingerprintTestCase(PipelineTestMixin, TestCase):
+
+    def test_skip(self):
+        from scrape.scrapy.items import DjangoItem
+        class ChangeItem(DjangoItem):
+            django_model = ChangeThing
+        path = tempfile.mktemp(suffix='.sqlite')
+        self.addCleanup(lambda: os.path.exists(path) and os.unlink(path))
+        make = lambda: ChangeItem(id=u'http://x/a', scrape_url=u'http://x/a', name=u'a', value=1)
+        self.assertEquals(ChangeItem(scrape_url=u'http://x/a', name=u'b').get_fingerprint_key(), None)
+
+        pipeline, spider = self.open_pipeline(DJANGO_ITEM_FINGERPRINTS=path)
+        self.result_of(pipeline.process_item(make(), spider))
+        pk = ChangeThing.objects.get(name=u'a').pk
+
+        # Unchanged items aren't saved, so they don't undo edits.
+        ChangeThing.objects.filter(pk=pk).update(value=5)
+        self.result_of(pipeline.process_item(make(), spider))
+        self.assertEquals(ChangeThing.objects.get(pk=pk).value, 5)
+        self.assertEquals(pipeline.spider_objs[spider].get(u'http://x/a'), pk)
+
+        # Unless the row they were saved to has gone.
+        ChangeThing.objects.filter(pk=pk).delete()
+        self.result_of(pipeline.process_item(make(), spider))
+        obj = ChangeThing.objects.get(name=u'a')
+        self.assertEquals(obj.value, 1)
+        self.assertEquals(pipeline.spider_objs[spider].get(u'http://x/a'), obj.pk)
+        self.close_pipeline(pipeline, spider)
+
+
+class TransactionGroupTestCase(PipelineTestMixin, TransactionTestCase):
+
+    def setUp(self):
+        from scrape.scrapy.items import DjangoItem
+        class BatchItem(DjangoItem):
+            django_model = BatchThing
+        class ChildItem(DjangoItem):
+            django_model = TxChild
+        self.BatchItem = BatchItem
+        self.ChildItem = ChildItem
+        self.pipeline, self.spider = self.open_pipeline(DJANGO_ITEM_TRANSACTION_SIZE=10)
+
+    def process(self, item_cls, id, **values):
+        item = item_cls(id=id, scrape_url=u'http://example.com/%s'%id, **values)
+        return self.fired(self.pipeline.process_item(item, self.spider))
+
+    def test_item_failure(self):
+        from twisted.python.failure import Failure
+        x = self.process(self.BatchItem, u'x', name=u'x', code=u'1')
+        y = self.process(self.BatchItem, u'y', name=u'y', code=u'1')
+        z = self.process(self.BatchItem, u'z', name=u'z')
+        self.assertEquals(len(y), 1)
+        self.assertTrue(y[0].check(IntegrityError))
+        self.assertEquals((x, z), ([], []))
+        self.pipeline.commit(self.spider)
+        self.assertFalse(isinstance(x[0], Failure) or isinstance(z[0], Failure))
+        self.close_pipeline(self.pipeline, self.spider)
+        self.assertEquals(sorted(BatchThing.objects.values_list('name', flat=True)), [u'x', u'z'])
+
+    def test_dependencies_wait_for_commit(self):
+        child = self.process(self.ChildItem, u'c', name=u'c', parent=u'p')
+        parent = self.process(self.BatchItem, u'p', name=u'p')
+        self.assertEquals((parent, child), ([], []))
+        self.assertTrue(u'p' in self.pipeline.spider_pending[self.spider])
+        self.assertFalse(u'p' in self.pipeline.spider_objs[self.spider])
+
+        # The parent's commit wakes the child, which then waits on its own.
+        self.pipeline.commit(self.spider)
+        self.assertEquals(len(parent), 1)
+        self.assertEquals(child, [])
+        self.pipeline.commit(self.spider)
+        self.assertEquals(len(child), 1)
+        self.close_pipeline(self.pipeline, self.spider)
+        self.assertEquals(TxChild.objects.get(name=u'c').parent.name, u'p')
+
+    def test_commit_failure(self):
+        from django.db import transaction, DatabaseError
+        from scrapy.exceptions import DropItem
+        p1 = self.process(self.BatchItem, u'p1', name=u'p1')
+        p2 = self.process(self.BatchItem, u'p2', name=u'p2')
+        child = self.process(self.ChildItem, u'c', name=u'c', parent=u'p1')
+        def fail():
+            raise DatabaseError('commit failed')
+        commit = transaction.commit
+        transaction.commit = fail
+        try:
+            self.pipeline.commit(self.spider)
+        finally:
+            transaction.commit = commit
+        for result in (p1, p2):
+            self.assertTrue(result[0].check(DatabaseError))
+        self.assertTrue(child[0].check(DropItem))
+        store = self.pipeline.spider_objs[self.spider]
+        self.assertEquals(store.get(u'p1', -1), None)
+        self.assertEquals(store.get(u'p2', -1), None)
+        self.close_pipeline(self.pipeline, self.spider)
+        self.assertEquals(BatchThing.objects.count(), 0)
+
+
+class DependencyTestCase(PipelineTestMixin, TestCase):
+
+    def setUp(self):
+        from scrape.scrapy.items import DjangoItem
+        class ChildItem(DjangoItem):
+            django_model = NullChild
+        self.ChildItem = ChildItem
+
+    def process(self, pipeline, spider, id, parent):
+        item = self.ChildItem(id=id, scrape_url=u'http://example.com/%s'%id, name=id, parent=parent)
+        return self.fired(pipeline.process_item(item, spider))
+
+    ## Give up on an ID as its timer would, without waiting for it.
+    def time_out(self, pipeline, spider, id):
+        pipeline.spider_pending[spider][id].cancel()
+        pipeline.dependency_timed_out(spider, id)
+
+    def test_timeout_drop(self):
+        from scrapy.exceptions import DropItem
+        pipeline, spider = self.open_pipeline(DJANGO_ITEM_DEPENDENCY_TIMEOUT=60)
+        child = self.process(pipeline, spider, u'c', u'p')
+        self.assertEquals(child, [])
+        self.time_out(pipeline, spider, u'p')
+        self.assertTrue(child[0].check(DropItem))
+        self.assertEquals(pipeline.spider_objs[spider].get(u'c', -1), None)
+        self.assertFalse(NullChild.objects.exists())
+        self.close_pipeline(pipeline, spider)
+
+    def test_timeout_null(self):
+        pipeline, spider = self.open_pipeline(DJANGO_ITEM_DEPENDENCY_TIMEOUT=60,
+                                              DJANGO_ITEM_DEPENDENCY_TIMEOUT_ACTION='null')
+        child = self.process(pipeline, spider, u'c', u'p')
+        self.time_out(pipeline, spider, u'p')
+        self.assertEquals(len(child), 1)
+        self.assertEquals(NullChild.objects.get(name=u'c').parent, None)
+        self.close_pipeline(pipeline, spider)
+
+    def test_report_unresolved(self):
+        from scrapy.stats import stats
+        from scrape.scrapy import pipelines
+        pipeline, spider = self.open_pipeline(DJANGO_ITEM_DEPENDENCY_TIMEOUT=60)
+        self.process(pipeline, spider, u'a', u'p')
+        self.process(pipeline, spider, u'b', u'q')
+        self.process(pipeline, spider, u'c', u'q')
+        self.time_out(pipeline, spider, u'p')
+        for dep in pipeline.spider_pending[spider].values():
+            dep.cancel()
+
+        messages = []
+        msg = pipelines.log.msg
+        pipelines.log.msg = lambda message, *args, **kwargs: messages.append(message)
+        try:
+            pipeline.report_unresolved(spider)
+        finally:
+            pipelines.log.msg = msg
+        self.assertEquals(stats.get_value('django_item/unresolved_ids', spider=spider), 2)
+        self.assertEquals(stats.get_value('django_item/unresolved_items/NullChild', spider=spider), 3)
+        self.assertTrue([m for m in messages if '"q"' in m and 'NullChild: 2' in m])
+        self.assertTrue(messages[-1].startswith('2 ID(s) were never resolved'))
+        pipeline.spider_pending[spider].clear()
+        self.close_pipeline(pipeline, spider)
+
+
+## Can DB worker threads see the test database?
+# Each connection to an in-memory SQLite database gets a database of its own.
+def shared_database():
+    return not (connection.vendor == 'sqlite' and connection.settings_dict['NAME'] in ('', ':memory:'))
+
+
+class DBThreadTestCase(PipelineTestMixin, TransactionTestCase):
+
+    @unittest.skipUnless(shared_database(), 'DB threads need a database they can share.')
+    def test_resolution_order(self):
+        from twisted.python.failure import Failure
+        from scrape.scrapy.items import DjangoItem
+        class BatchItem(DjangoItem):
+            django_model = BatchThing
+        class ChildItem(DjangoItem):
+            django_model = TxChild
+        pipeline, spider = self.open_pipeline(DJANGO_ITEM_DB_THREADS=2)
+        process = lambda cls, id, **values: self.fired(pipeline.process_item(
+            cls(id=id, scrape_url=u'http://x/%s'%id, name=id, **values), spider))
+
+        # The child waits for its parent, which is saved in a worker thread.
+        child = process(ChildItem, u'c', parent=u'p')
+        self.assertTrue(u'p' in pipeline.spider_pending[spider])
+        parent = process(BatchItem, u'p')
+        self.assertEquals(parent, [])
+        self.wait_for(parent)
+        self.wait_for(child)
+        self.assertFalse(u'p' in pipeline.spider_pending[spider])
+
+        # Once the parent is saved its children don't wait.
+        other = process(ChildItem, u'd', parent=u'p')
+        self.assertFalse(u'p' in pipeline.spider_pending[spider])
+        self.wait_for(other)
+        for result in (parent, child, other):
+            self.assertFalse(isinstance(result[0], Failure), result[0])
+        self.close_pipeline(pipeline, spider)
+        names = TxChild.objects.filter(parent__name=u'p').values_list('name', flat=True)
+        self.assertEquals(sorted(names), [u'c', u'd'])
+
+    def test_in_flight_limit(self):
+        import threading
+        pipeline, spider = self.open_pipeline(DJANGO_ITEM_DB_THREADS=2, DJANGO_ITEM_DB_MAX_IN_FLIGHT=1)
+        release = threading.Event()
+        ran = []
+        def first():
+            release.wait(10)
+            ran.append(1)
+        first_done = self.fired(pipeline.defer_db(first))
+        second_done = self.fired(pipeline.defer_db(ran.append, 2))
+
+        # The second waits its turn, even though a thread is free.
+        time.sleep(0.1)
+        self.assertEquals(ran, [])
+        self.assertEquals(len(pipeline.db_semaphore.waiting), 1)
+
+        # And runs once the first is done.
+        release.set()
+        self.wait_for(first_done)
+        self.wait_for(second_done)
+        self.assertEquals(ran, [1, 2])
+        self.close_pipeline(pipeline, spider)
+
+
+class ScrapeKeyTestCase(TestCase):
+
+    def setUp(self):
+        from scrapy.spider import BaseSpider
+        from scrape.scrapy.items import DjangoItem
+        class KeyItem(DjangoItem):
+            django_model = KeyThing
+        self.KeyItem = KeyItem
+        self.spider = BaseSpider('test')
+
+    def test_without_id(self):
+        url = u'http://example.com/list'
+        self.assertEquals(self.KeyItem(scrape_url=url, name=u'a').get_scrape_key(), None)
+        self.KeyItem(scrape_url=url, name=u'a').save(None, None)
+        self.KeyItem(scrape_url=url, name=u'b').save(None, None)
+        items = [self.KeyItem(scrape_url=url, name=u'c'), self.KeyItem(scrape_url=url, name=u'd')]
+        self.KeyItem.save_batch(items, None, self.spider)
+        self.assertEquals(sorted(KeyThing.objects.values_list('name', flat=True)), [u'a', u'b', u'c', u'd'])
+        self.assertEquals(KeyThing.objects.filter(scrape_key__isnull=False).count(), 0)
+
+    def test_batch_legacy(self):
+        legacy = KeyThing.objects.create(name=u'old', code=u'c1')
+        items = [self.KeyItem(id=u'http://example.com/1', scrape_url=u'http://example.com/1',
+                              name=u'new', code=u'c1'),
+                 self.KeyItem(id=u'http://example.com/2', scrape_url=u'http://example.com/2',
+                              name=u'other', code=u'c2')]
+        results = self.KeyItem.save_batch(items, None, self.spider)
+        self.assertEquals(results[0].pk, legacy.pk)
+        legacy = KeyThing.objects.get(pk=legacy.pk)
+        self.assertEquals(legacy.name, u'new')
+        self.assertEquals(legacy.scrape_key, items[0].get_scrape_key())
+        self.assertEquals(KeyThing.objects.count(), 2)
+
+
+class ScheduleTestCase(TestCase):
+
+    def setUp(self):
+        from scrape.scrapy.items import DjangoItem
+        class SchedItem(DjangoItem):
+            django_model = SchedThing
+        self.SchedItem = SchedItem
+
+    def save(self, name, url, **values):
+        self.SchedItem(scrape_url=url, name=name, **values).save(None, None)
+
+    def set_time(self, name, day):
+        from datetime import datetime
+        SchedThing.objects.filter(name=name).update(scrape_time=datetime(2012, 1, day))
+
+    def stale(self, **kwargs):
+        from scrape.scrapy.scheduler import StaleSources
+        return list(StaleSources([SchedThing], **kwargs))
+
+    def test_rescrape(self):
+        from scrape.scrapy.pipelines import touch_row
+        self.save(u'a', u'http://x/a', value=1)
+        self.save(u'b', u'http://x/b', value=1)
+        self.assertEquals(SchedThing.objects.get(name=u'a').scrape_url, u'http://x/a')
+        self.set_time(u'a', 1)
+        self.set_time(u'b', 2)
+        self.assertEquals(self.stale(), [u'http://x/a', u'http://x/b'])
+
+        # Scraping again, even without changes, moves an object to the back.
+        self.save(u'a', u'http://x/a', value=1)
+        self.assertEquals(self.stale(), [u'http://x/b', u'http://x/a'])
+
+        # As does skipping an unchanged item.
+        self.assertTrue(touch_row(SchedThing, SchedThing.objects.get(name=u'b').pk))
+        self.assertEquals(self.stale(), [u'http://x/a', u'http://x/b'])
+
+    def test_order_and_limits(self):
+        SchedThing.objects.create(name=u'c', value_source=u'http://x/c')
+        self.save(u'd', u'http://x/shared')
+        self.save(u'e', u'http://x/shared')
+        self.save(u'f', u'http://x/f')
+        self.set_time(u'd', 1)
+        self.set_time(u'e', 2)
+        SchedThing.objects.filter(name=u'f').update(name_valid=True, value_valid=True)
+
+        self.assertEquals(self.stale(), [u'http://x/c', u'http://x/shared'])
+        self.assertEquals(self.stale(chunk_size=1), [u'http://x/c', u'http://x/shared'])
+        self.assertEquals(self.stale(limit=1), [u'http://x/c'])
+        self.assertEquals(self.stale(limit=3), [u'http://x/c', u'http://x/shared'])
+        self.assertEquals(self.stale(fraction=0.4), [u'http://x/c', u'http://x/shared'])
+        self.assertEquals(self.stale(fraction=0.3), [u'http://x/c'])
+
+    def test_needs_schedule(self):
+        from scrape.scrapy.scheduler import StaleSources
+        self.assertRaises(TypeError, StaleSources, [ChangeThing])
+
+
+class CoverageTestCase(PipelineTestMixin, TestCase):
+
+    def setUp(self):
+        from scrape.scrapy.items import DjangoItem
+        class CovItem(DjangoItem):
+            django_model = CovThing
+        self.CovItem = CovItem
+        scrape_models.ScrapeCoverage.rebuild(CovThing)
+
+    def counts(self):
+        coverage = scrape_models.ScrapeCoverage.objects.get(model=u'scrape.CovThing')
+        return coverage.total, coverage.fully_valid, coverage.not_valid
+
+    def test_batch_counted_once(self):
+        pipeline, spider = self.open_pipeline(DJANGO_ITEM_BATCH_SIZE=3)
+        items = [self.CovItem(id=u'http://x/%d'%i, name=u'%d'%i) for i in range(3)]
+        sql = capture_sql(lambda: [pipeline.process_item(item, spider) for item in items])
+        self.assertEquals(len([q for q in sql if q.startswith('UPDATE') and 'scrapecoverage' in q]), 1)
+        self.assertEquals(self.counts(), (3, 0, 3))
+
+        # Saving again creates nothing, so counts nothing.
+        self.result_of(pipeline.process_item(self.CovItem(id=u'http://x/0', name=u'0'), spider))
+        self.close_pipeline(pipeline, spider)
+        self.assertEquals(self.counts(), (3, 0, 3))
+
+    def test_counted_delete(self):
+        from django.test.client import RequestFactory
+        from scrape.admin import make_counted_delete
+        CovThing.objects.create(name=u'a', name_valid=True)
+        CovThing.objects.create(name=u'b')
+        CovThing.objects.create(name=u'c')
+        scrape_models.ScrapeCoverage.rebuild(CovThing)
+        class FakeAdmin(object):
+            model = CovThing
+        def delete(modeladmin, request, queryset):
+            if request.POST.get('post'):
+                queryset.delete()
+            else:
+                return 'confirm'
+        action = make_counted_delete(delete)
+        qs = CovThing.objects.filter(name__in=[u'a', u'b'])
+
+        # Nothing changes until the deletion is confirmed.
+        self.assertEquals(action(FakeAdmin(), RequestFactory().post('/', {}), qs), 'confirm')
+        self.assertEquals(self.counts(), (3, 1, 2))
+        action(FakeAdmin(), RequestFactory().post('/', {'post': 'yes'}), qs)
+        self.assertEquals(self.counts(), (1, 0, 1))